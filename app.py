@@ -1,24 +1,260 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, session, jsonify, send_file
+from flask import Flask, render_template, request, redirect, url_for, flash, session, jsonify, send_file, make_response, g, abort, has_request_context, Response
 from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy.session import Session as SessaoFlask
 from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user, current_user
 from werkzeug.security import generate_password_hash, check_password_hash
+from sqlalchemy import event, Table
+from sqlalchemy.orm import Session
+from sqlalchemy.schema import CreateTable
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from datetime import datetime, timedelta, date
-import pandas as pd
+from functools import wraps
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from jinja2 import FileSystemBytecodeCache
+import click
+import hashlib
+import json
+import queue
+import gzip
+import re
+import sqlite3
+import threading
 import os
 import io
-
-app = Flask(__name__)
+import multiprocessing
+import socket
+import sys
+import time
+import zipfile
+
+# SISTEMA_FROTA_INSTANCIA permite apontar bancos e caches para outro diretório (ex.: testes de carga)
+app = Flask(__name__, instance_path=os.environ.get('SISTEMA_FROTA_INSTANCIA'))
 app.config['SECRET_KEY'] = 'sistema-frota-2025-secret-key'
 app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///sistema_frota.db'
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+app.config['EXPORT_CACHE_DIR'] = os.path.join(app.instance_path, 'cache_exportacao')
+app.config['EXPORT_CACHE_MAX_BYTES'] = 200 * 1024 * 1024
+app.config['IMPORT_CHUNK_SIZE'] = 50000
+app.config['EXTRATOS_DIR'] = os.path.join(app.instance_path, 'extratos')
+app.config['EXTRATOS_PROCESSOS'] = None  # None: um processo por CPU
+app.config['EXTRATOS_POR_TAREFA'] = 50  # extratos renderizados por tarefa enviada ao pool
+app.config['AGENDADOR_ATIVO'] = True
+app.config['AGENDADOR_INTERVALO'] = 30  # segundos entre verificações das tarefas vencidas
+app.config['ITENS_POR_PAGINA'] = 100  # linhas por página nas listagens de descontos e auditoria
+app.config['RESUMO_DIAS_REVISAO'] = 7  # dias do resumo diário da frota refeitos pela tarefa noturna
+app.config['AUDITORIA_RETENCAO_DIAS'] = 365  # registros mais antigos vão para o arquivo compactado
+app.config['AUDITORIA_ARQUIVO_DIR'] = os.path.join(app.instance_path, 'arquivo_auditoria')
+app.config['ALTERACOES_RETENCAO_DIAS'] = 30  # log de alterações mais antigo é expurgado; quem ficou para trás refaz a carga
+app.config['EVENTOS_INTERVALO'] = 1.0  # segundos entre leituras do log de alterações para os eventos ao vivo
+app.config['EVENTOS_MAXIMO_LOTE'] = 500  # acima disso as telas recarregam em vez de receber evento a evento
+app.config['EVENTOS_PULSACAO'] = 15  # segundos sem eventos até um comentário que mantém a conexão aberta
+# Filiais no formato "codigo:Nome,codigo:Nome"; a primeira (padrão) usa o banco principal
+app.config['FILIAIS'] = dict(
+    item.split(':', 1) for item in os.environ.get('FILIAIS', 'matriz:Matriz').split(',')
+)
+app.config['FILIAL_PADRAO'] = next(iter(app.config['FILIAIS']))
+
+def nome_banco_filial(codigo, snapshot=False):
+    """Nome do arquivo SQLite da filial (ou da sua cópia somente leitura)."""
+    base = 'sistema_frota' if codigo == app.config['FILIAL_PADRAO'] else f'sistema_frota_{codigo}'
+    return f'{base}_snapshot.db' if snapshot else f'{base}.db'
+
+def chave_bind_filial(codigo, snapshot=False):
+    if codigo == app.config['FILIAL_PADRAO']:
+        return 'snapshot' if snapshot else None
+    return f'snapshot_{codigo}' if snapshot else f'filial_{codigo}'
+
+# Cada filial tem seu banco e uma cópia somente leitura usada por exportações e relatórios
+app.config['SQLALCHEMY_BINDS'] = {}
+for _codigo in app.config['FILIAIS']:
+    if chave_bind_filial(_codigo) is not None:
+        app.config['SQLALCHEMY_BINDS'][chave_bind_filial(_codigo)] = f'sqlite:///{nome_banco_filial(_codigo)}'
+    app.config['SQLALCHEMY_BINDS'][chave_bind_filial(_codigo, snapshot=True)] = \
+        f'sqlite:///file:{nome_banco_filial(_codigo, snapshot=True)}?mode=ro&uri=true'
+app.config['RELATORIOS_VIA_SNAPSHOT'] = True
+app.config['SNAPSHOT_INTERVALO'] = 300  # segundos
+app.config['COMPRESSAO_MINIMA'] = 1024  # bytes; respostas HTML menores não são comprimidas
+
+os.makedirs(os.path.join(app.instance_path, 'jinja_cache'), exist_ok=True)
+app.jinja_env.bytecode_cache = FileSystemBytecodeCache(os.path.join(app.instance_path, 'jinja_cache'))
+
+# Tabelas compartilhadas por todas as filiais, mantidas no banco principal
+TABELAS_GLOBAIS = {'usuario', 'log_auditoria', 'relatorio_importacao', 'erro_importacao', 'geracao_extratos',
+                   'tarefa_agendada', 'execucao_tarefa'}
+
+class SessaoFilial(SessaoFlask):
+    """Sessão que envia as tabelas operacionais ao banco da filial corrente."""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is not None:
+            return bind
+        tabela = db.inspect(mapper).local_table if mapper is not None else getattr(clause, 'table', clause)
+        if isinstance(tabela, Table) and tabela.name in TABELAS_GLOBAIS:
+            return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+        return engine_filial()
+
+db = SQLAlchemy(app, session_options={'class_': SessaoFilial})
+
+def _configurar_sqlite(conexao_dbapi, registro):
+    # WAL permite leituras (inclusive o backup do snapshot) sem bloquear as escritas
+    cursor = conexao_dbapi.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute('PRAGMA busy_timeout=5000')
+    # Exclusões em cascata (ON DELETE) são feitas pelo próprio banco
+    cursor.execute('PRAGMA foreign_keys=ON')
+    cursor.close()
+
+with app.app_context():
+    for _codigo in app.config['FILIAIS']:
+        event.listen(db.engines[chave_bind_filial(_codigo)], 'connect', _configurar_sqlite)
+
+# Roteamento por filial
+def filial_atual():
+    """Filial do contexto corrente (definida por requisição ou por `contexto_filial`)."""
+    return g.get('filial') or app.config['FILIAL_PADRAO']
+
+def engine_filial(codigo=None, snapshot=False):
+    return db.engines[chave_bind_filial(codigo or filial_atual(), snapshot)]
+
+def tabelas_filial():
+    return [tabela for tabela in db.metadata.sorted_tables if tabela.name not in TABELAS_GLOBAIS]
+
+def definir_filial():
+    # O admin escolhe a filial de trabalho; os demais usuários ficam presos à sua
+    if not current_user.is_authenticated:
+        return
+    if is_admin():
+        g.filial = session.get('filial') if session.get('filial') in app.config['FILIAIS'] else None
+    elif current_user.filial in app.config['FILIAIS']:
+        g.filial = current_user.filial
+
+@app.context_processor
+def injetar_filiais():
+    return {'filiais': app.config['FILIAIS'], 'filial_atual': filial_atual()}
+
+@contextmanager
+def contexto_filial(codigo):
+    """Contexto de aplicação próprio (e sessão própria) apontando para a filial."""
+    with app.app_context():
+        g.filial = codigo
+        yield
+
+_executor_filiais = ThreadPoolExecutor(max_workers=len(app.config['FILIAIS']), thread_name_prefix='filial')
+
+def executar_por_filial(funcao, filiais):
+    """Executa `funcao()` em cada filial, em paralelo, e retorna {codigo: resultado}."""
+    filiais = list(filiais)
+    if filiais == [filial_atual()]:
+        return {filiais[0]: funcao()}
+
+    def tarefa(codigo):
+        with contexto_filial(codigo):
+            return funcao()
+    return dict(zip(filiais, _executor_filiais.map(tarefa, filiais)))
+
+def filiais_consolidadas():
+    """Filiais lidas pelo dashboard e exportações: todas para o admin, a própria para os demais."""
+    return list(app.config['FILIAIS']) if is_admin() else [filial_atual()]
 
-db = SQLAlchemy(app)
 login_manager = LoginManager()
 login_manager.init_app(app)
 login_manager.login_view = 'login'
 login_manager.login_message = 'Por favor, faça login para acessar esta página.'
 
+# Recursos estáticos: bundles com impressão digital e variantes gzip
+BUNDLES = {
+    'app.css': ['vendor/bootstrap/css/bootstrap.min.css', 'vendor/fontawesome/css/all.min.css', 'css/app.css'],
+    'app.js': ['vendor/popper/popper.min.js', 'vendor/bootstrap/js/bootstrap.min.js', 'js/app.js'],
+    'login.css': ['vendor/bootstrap/css/bootstrap.min.css', 'css/login.css'],
+}
+
+def construir_bundles():
+    """Concatena os arquivos de cada bundle em static/dist com o hash no nome.
+
+    Retorna o mapa nome lógico -> arquivo gerado.
+    """
+    destino = os.path.join(app.static_folder, 'dist')
+    os.makedirs(destino, exist_ok=True)
+    gerados = {}
+    for nome, arquivos in BUNDLES.items():
+        partes = []
+        for arquivo in arquivos:
+            with open(os.path.join(app.static_folder, arquivo), encoding='utf-8') as origem:
+                conteudo = origem.read()
+            # Os mapas de origem não são distribuídos
+            conteudo = re.sub(r'^\s*(//# sourceMappingURL=.*|/\*# sourceMappingURL=.*\*/)\s*$', '', conteudo, flags=re.M)
+            # URLs relativas (fontes) passam a ser resolvidas a partir de static/dist
+            pasta = os.path.dirname(arquivo)
+            conteudo = re.sub(r'url\((?![\'"]?(?:data:|https?:|/))([\'"]?)([^)\'"]+)\1\)',
+                              lambda m: f"url({m.group(1)}../{os.path.normpath(os.path.join(pasta, m.group(2)))}{m.group(1)})",
+                              conteudo)
+            partes.append(conteudo)
+        dados = '\n'.join(partes).encode('utf-8')
+        base, extensao = os.path.splitext(nome)
+        arquivo_final = f'{base}.{hashlib.sha1(dados).hexdigest()[:12]}{extensao}'
+        caminho = os.path.join(destino, arquivo_final)
+        if not os.path.exists(caminho):
+            with open(caminho, 'wb') as saida:
+                saida.write(dados)
+            with open(f'{caminho}.gz', 'wb') as saida:
+                saida.write(gzip.compress(dados, 9))
+        gerados[nome] = arquivo_final
+    return gerados
+
+ARQUIVOS_BUNDLE = construir_bundles()
+
+@app.context_processor
+def injetar_bundles():
+    return {'bundle_url': lambda nome: url_for('bundle_estatico', arquivo=ARQUIVOS_BUNDLE[nome])}
+
+@app.route('/static/dist/<arquivo>')
+def bundle_estatico(arquivo):
+    if arquivo not in ARQUIVOS_BUNDLE.values():
+        abort(404)
+    caminho = os.path.join(app.static_folder, 'dist', arquivo)
+    mimetype = 'text/css' if arquivo.endswith('.css') else 'application/javascript'
+    comprimido = 'gzip' in request.accept_encodings and os.path.exists(f'{caminho}.gz')
+    resposta = send_file(f'{caminho}.gz' if comprimido else caminho, mimetype=mimetype, max_age=31536000)
+    if comprimido:
+        resposta.headers['Content-Encoding'] = 'gzip'
+    resposta.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    resposta.vary.add('Accept-Encoding')
+    return resposta
+
+@app.after_request
+def comprimir_resposta(resposta):
+    """Comprime respostas HTML e define cache longo para os arquivos vendorizados."""
+    if request.path.startswith('/static/vendor/'):
+        resposta.cache_control.no_cache = None
+        resposta.cache_control.public = True
+        resposta.cache_control.max_age = 2592000
+        return resposta
+
+    if (resposta.status_code != 200 or resposta.direct_passthrough or resposta.is_streamed
+            or resposta.mimetype != 'text/html' or 'Content-Encoding' in resposta.headers
+            or 'gzip' not in request.accept_encodings):
+        return resposta
+    dados = resposta.get_data()
+    if len(dados) < app.config['COMPRESSAO_MINIMA']:
+        return resposta
+    resposta.set_data(gzip.compress(dados, 6))
+    resposta.headers['Content-Encoding'] = 'gzip'
+    resposta.vary.add('Accept-Encoding')
+    # O corpo comprimido difere byte a byte: a ETag passa a ser fraca
+    etag, fraca = resposta.get_etag()
+    if etag and not fraca:
+        resposta.set_etag(etag, weak=True)
+    return resposta
+
 # Modelos do Banco de Dados
+class Veiculo(db.Model):
+    """Cadastro normalizado de veículos, referenciado por Frota e Colaborador."""
+    id = db.Column(db.Integer, primary_key=True)
+    placa = db.Column(db.String(20), unique=True, nullable=False)
+    ativo = db.Column(db.Boolean, default=True)
+    criado_em = db.Column(db.DateTime, default=datetime.utcnow)
+
 class Usuario(UserMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(80), unique=True, nullable=False)
@@ -26,6 +262,7 @@ class Usuario(UserMixin, db.Model):
     nome = db.Column(db.String(100), nullable=False)
     email = db.Column(db.String(120), unique=True, nullable=False)
     ativo = db.Column(db.Boolean, default=True)
+    filial = db.Column(db.String(20))
     criado_em = db.Column(db.DateTime, default=datetime.utcnow)
 
 class Colaborador(db.Model):
@@ -33,71 +270,240 @@ class Colaborador(db.Model):
     nome = db.Column(db.String(100), nullable=False)
     matricula = db.Column(db.String(50), unique=True, nullable=False)
     cpf = db.Column(db.String(14), unique=True)
+    pis = db.Column(db.String(14), index=True)  # identifica o colaborador nos arquivos AFD dos relógios de ponto
     telefone = db.Column(db.String(20))
     email = db.Column(db.String(120))
     veiculo_vinculado = db.Column(db.String(20))
+    veiculo_vinculado_id = db.Column(db.Integer, db.ForeignKey('veiculo.id', ondelete='SET NULL'), index=True)
     ativo = db.Column(db.Boolean, default=True)
     vencimento_cnh = db.Column(db.Date)
     ultima_consulta = db.Column(db.Date)
+    arquivado_em = db.Column(db.DateTime)  # preenchido ao arquivar (exclusão lógica)
     criado_em = db.Column(db.DateTime, default=datetime.utcnow)
     
-    # Relacionamentos
-    pontos = db.relationship('Ponto', backref='colaborador', lazy=True, cascade='all, delete-orphan')
-    frotas = db.relationship('Frota', backref='motorista_obj', lazy=True)
-    descontos = db.relationship('Desconto', backref='colaborador', lazy=True)
+    # Relacionamentos: o histórico é removido pelo ON DELETE do banco, sem carregar os registros
+    pontos = db.relationship('Ponto', backref='colaborador', lazy=True, cascade='all, delete-orphan', passive_deletes=True)
+    frotas = db.relationship('Frota', backref='motorista_obj', lazy=True, cascade='all, delete-orphan', passive_deletes=True)
+    descontos = db.relationship('Desconto', backref='colaborador', lazy=True, cascade='all, delete-orphan', passive_deletes=True)
+    veiculo_vinculado_obj = db.relationship('Veiculo')
+
+    __table_args__ = (
+        db.Index('ix_colaborador_ativo_nome', 'ativo', 'nome'),
+    )
 
 class Ponto(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    colaborador_id = db.Column(db.Integer, db.ForeignKey('colaborador.id'), nullable=False)
+    colaborador_id = db.Column(db.Integer, db.ForeignKey('colaborador.id', ondelete='CASCADE'), nullable=False, index=True)
     data_hora = db.Column(db.DateTime, nullable=False)
     tipo = db.Column(db.String(10), nullable=False)  # entrada ou saida
     observacao = db.Column(db.Text)
     extraordinario = db.Column(db.Boolean, default=False)
+    rep = db.Column(db.String(17))  # número de fabricação do relógio (REP) de origem, nas marcações importadas do AFD
+    nsr = db.Column(db.Integer)  # número sequencial do registro no AFD
+    chave_importacao = db.Column(db.String(40))  # hash de matrícula+data/hora+tipo, nas marcações importadas de planilha
     criado_em = db.Column(db.DateTime, default=datetime.utcnow)
 
+    __table_args__ = (
+        db.Index('ix_ponto_colaborador_data_hora', 'colaborador_id', 'data_hora'),
+        db.Index('ix_ponto_data_hora', 'data_hora'),
+        # Uma marcação do relógio nunca é importada duas vezes
+        db.Index('uq_ponto_rep_nsr', 'rep', 'nsr', unique=True, sqlite_where=db.text('nsr IS NOT NULL')),
+        # Nem uma linha de planilha reenviada
+        db.Index('uq_ponto_chave_importacao', 'chave_importacao', unique=True,
+                 sqlite_where=db.text('chave_importacao IS NOT NULL')),
+    )
+
 class Frota(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     data = db.Column(db.Date, nullable=False)
     veiculo = db.Column(db.String(20), nullable=False)
-    motorista_id = db.Column(db.Integer, db.ForeignKey('colaborador.id'), nullable=False)
+    veiculo_id = db.Column(db.Integer, db.ForeignKey('veiculo.id', ondelete='SET NULL'))
+    motorista_id = db.Column(db.Integer, db.ForeignKey('colaborador.id', ondelete='CASCADE'), nullable=False)
     hora_saida = db.Column(db.Time)
     hora_retorno = db.Column(db.Time)
     km_inicial = db.Column(db.Float)
     km_final = db.Column(db.Float)
     observacao = db.Column(db.Text)
     status = db.Column(db.String(20), default='conforme')  # conforme ou extraordinaria
+    chave_importacao = db.Column(db.String(40))  # hash de matrícula+veículo+data+hora de saída, nas viagens importadas
     criado_em = db.Column(db.DateTime, default=datetime.utcnow)
 
+    veiculo_obj = db.relationship('Veiculo', backref='viagens')
+
+    __table_args__ = (
+        db.Index('ix_frota_veiculo_data_saida', 'veiculo_id', 'data', 'hora_saida'),
+        db.Index('ix_frota_motorista_data_saida', 'motorista_id', 'data', 'hora_saida'),
+        db.Index('ix_frota_data', 'data'),
+        db.Index('uq_frota_chave_importacao', 'chave_importacao', unique=True,
+                 sqlite_where=db.text('chave_importacao IS NOT NULL')),
+    )
+
 class Desconto(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    colaborador_id = db.Column(db.Integer, db.ForeignKey('colaborador.id'), nullable=False)
+    colaborador_id = db.Column(db.Integer, db.ForeignKey('colaborador.id', ondelete='CASCADE'), nullable=False, index=True)
     data = db.Column(db.Date, nullable=False)
     motivo = db.Column(db.Text, nullable=False)
     valor = db.Column(db.Float, nullable=False)
     status = db.Column(db.String(20), default='pendente')  # pendente, aprovado, descontado, cancelado
-    frota_id = db.Column(db.Integer, db.ForeignKey('frota.id'))
+    frota_id = db.Column(db.Integer, db.ForeignKey('frota.id', ondelete='SET NULL'), index=True)
     automatico = db.Column(db.Boolean, default=False)
     criado_em = db.Column(db.DateTime, default=datetime.utcnow)
     data_alteracao_status = db.Column(db.DateTime)
     motivo_alteracao_status = db.Column(db.Text)
     
-    frota = db.relationship('Frota', backref='descontos')
+    frota = db.relationship('Frota', backref=db.backref('descontos', passive_deletes=True))
+
+    __table_args__ = (
+        # No máximo um desconto automático por viagem (descontos manuais não entram no índice)
+        db.Index('uq_desconto_automatico_frota', 'frota_id', 'automatico', unique=True,
+                 sqlite_where=db.text('automatico = 1')),
+        db.Index('ix_desconto_data', 'data'),
+        db.Index('ix_desconto_colaborador_data', 'colaborador_id', 'data'),
+        db.Index('ix_desconto_status_criado_em', 'status', 'criado_em'),
+        db.Index('ix_desconto_status_data', 'status', 'data'),
+    )
 
 class LogAuditoria(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    usuario_id = db.Column(db.Integer, db.ForeignKey('usuario.id'))
+    usuario_id = db.Column(db.Integer, db.ForeignKey('usuario.id', ondelete='SET NULL'))
     usuario_nome = db.Column(db.String(100))
     acao = db.Column(db.String(255), nullable=False)
     detalhes = db.Column(db.Text)
-    data_hora = db.Column(db.DateTime, default=datetime.utcnow)
+    data_hora = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+
+    usuario = db.relationship('Usuario', backref=db.backref('logs_auditoria', passive_deletes=True))
+
+class RelatorioImportacao(db.Model):
+    """Resumo de uma importação (ou simulação) de arquivo."""
+    id = db.Column(db.Integer, primary_key=True)
+    usuario_id = db.Column(db.Integer, db.ForeignKey('usuario.id', ondelete='SET NULL'))
+    tipo = db.Column(db.String(20), nullable=False)
+    filial = db.Column(db.String(20))
+    arquivo = db.Column(db.String(255))
+    digest = db.Column(db.String(64))  # SHA-256 do arquivo, gravado só quando a importação termina
+    simulacao = db.Column(db.Boolean, default=False)
+    total_linhas = db.Column(db.Integer, default=0)
+    linhas_com_erro = db.Column(db.Integer, default=0)
+    adicionados = db.Column(db.Integer, default=0)
+    ignorados = db.Column(db.Integer, default=0)  # linhas já importadas anteriormente
+    criado_em = db.Column(db.DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        db.Index('ix_relatorio_importacao_digest', 'digest', 'tipo', 'filial'),
+    )
+
+    erros = db.relationship('ErroImportacao', backref='relatorio', lazy='dynamic', cascade='all, delete-orphan',
+                            passive_deletes=True)
+
+class ErroImportacao(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    relatorio_id = db.Column(db.Integer, db.ForeignKey('relatorio_importacao.id', ondelete='CASCADE'), nullable=False, index=True)
+    linha = db.Column(db.Integer, nullable=False)
+    coluna = db.Column(db.String(100))
+    motivo = db.Column(db.Text, nullable=False)
+
+class GeracaoExtratos(db.Model):
+    """Geração em segundo plano dos extratos mensais dos colaboradores de uma filial."""
+    id = db.Column(db.Integer, primary_key=True)
+    usuario_id = db.Column(db.Integer, db.ForeignKey('usuario.id', ondelete='SET NULL'))
+    filial = db.Column(db.String(20), nullable=False)
+    mes = db.Column(db.String(7), nullable=False)  # AAAA-MM
+    formato = db.Column(db.String(4), nullable=False)  # html, xlsx ou pdf
+    status = db.Column(db.String(12), default='pendente')  # pendente, processando, concluido, erro
+    processo = db.Column(db.String(80))  # host:pid do processo que executa a geração
+    total = db.Column(db.Integer, default=0)
+    processados = db.Column(db.Integer, default=0)
+    erro = db.Column(db.Text)
+    criado_em = db.Column(db.DateTime, default=datetime.utcnow)
+    concluido_em = db.Column(db.DateTime)
+
+class TarefaAgendada(db.Model):
+    """Estado de uma tarefa do agendador; a própria linha é a trava que elege quem a executa."""
+    nome = db.Column(db.String(50), primary_key=True)
+    proxima_execucao = db.Column(db.DateTime, nullable=False)  # horário local, como no cron
+    executando_em = db.Column(db.String(100))  # servidor:pid que detém a trava
+    trava_expira_em = db.Column(db.DateTime)
+
+class ExecucaoTarefa(db.Model):
+    """Histórico de execuções das tarefas agendadas."""
+    id = db.Column(db.Integer, primary_key=True)
+    tarefa = db.Column(db.String(50), nullable=False)
+    filial = db.Column(db.String(20))
+    servidor = db.Column(db.String(100))
+    iniciado_em = db.Column(db.DateTime, nullable=False)
+    duracao = db.Column(db.Float)  # segundos
+    status = db.Column(db.String(10), nullable=False)  # executando, sucesso ou erro
+    resultado = db.Column(db.Text)
+
+    __table_args__ = (
+        db.Index('ix_execucao_tarefa_tarefa_id', 'tarefa', 'id'),
+    )
+
+class ResumoDiarioFrota(db.Model):
+    """Consolidação diária da frota por veículo e motorista."""
+    id = db.Column(db.Integer, primary_key=True)
+    data = db.Column(db.Date, nullable=False)
+    veiculo_id = db.Column(db.Integer, db.ForeignKey('veiculo.id', ondelete='CASCADE'), nullable=False)
+    motorista_id = db.Column(db.Integer, db.ForeignKey('colaborador.id', ondelete='CASCADE'), nullable=False, index=True)
+    viagens = db.Column(db.Integer, default=0)
+    viagens_extraordinarias = db.Column(db.Integer, default=0)
+    km_rodado = db.Column(db.Float, default=0)
+    minutos_fora = db.Column(db.Integer, default=0)
+    descontos_gerados = db.Column(db.Integer, default=0)
+    valor_descontos = db.Column(db.Float, default=0)
+
+    __table_args__ = (
+        db.UniqueConstraint('data', 'veiculo_id', 'motorista_id', name='uq_resumo_diario_frota'),
+        db.Index('ix_resumo_diario_frota_veiculo_data', 'veiculo_id', 'data'),
+    )
 
-    usuario = db.relationship('Usuario', backref='logs_auditoria')
+class AnomaliaFrota(db.Model):
+    """Inconsistência encontrada pela varredura de viagens."""
+    id = db.Column(db.Integer, primary_key=True)
+    frota_id = db.Column(db.Integer, db.ForeignKey('frota.id', ondelete='CASCADE'), nullable=False, index=True)
+    referencia_id = db.Column(db.Integer, db.ForeignKey('frota.id', ondelete='SET NULL'), index=True)  # viagem anterior comparada
+    veiculo_id = db.Column(db.Integer, db.ForeignKey('veiculo.id', ondelete='CASCADE'), index=True)
+    motorista_id = db.Column(db.Integer, db.ForeignKey('colaborador.id', ondelete='CASCADE'), index=True)
+    tipo = db.Column(db.String(30), nullable=False)
+    detalhes = db.Column(db.Text)
+    detectado_em = db.Column(db.DateTime, default=datetime.utcnow)
+
+    frota = db.relationship('Frota', foreign_keys=[frota_id])
+    referencia = db.relationship('Frota', foreign_keys=[referencia_id])
+
+class VarreduraPendente(db.Model):
+    """Veículos e motoristas alterados desde a última varredura de anomalias."""
+    tipo = db.Column(db.String(10), primary_key=True)  # veiculo ou motorista
+    ref_id = db.Column(db.Integer, primary_key=True)
+    marcado_em = db.Column(db.DateTime, default=datetime.utcnow)
+
+class VersaoTabela(db.Model):
+    """Carimbo de versão por tabela, incrementado a cada escrita."""
+    tabela = db.Column(db.String(50), primary_key=True)
+    versao = db.Column(db.Integer, nullable=False, default=0)
+    atualizado_em = db.Column(db.DateTime, default=datetime.utcnow)
+
+class RegistroAlteracao(db.Model):
+    """Log de alterações (CDC) das tabelas operacionais, preenchido por triggers do banco."""
+    seq = db.Column(db.Integer, primary_key=True)  # AUTOINCREMENT: nunca reutilizado
+    tabela = db.Column(db.String(30), nullable=False)
+    registro_id = db.Column(db.Integer, nullable=False)
+    operacao = db.Column(db.String(6), nullable=False)  # insert, update ou delete
+    diferencas = db.Column(db.Text, nullable=False)  # JSON: linha completa ou {coluna: [antes, depois]}
+    alterado_em = db.Column(db.DateTime, nullable=False)
+
+    __table_args__ = (
+        db.Index('ix_registro_alteracao_tabela_seq', 'tabela', 'seq'),
+        {'sqlite_autoincrement': True},
+    )
 
 def registrar_log(acao, detalhes=''):
     """Registra uma ação no log de auditoria."""
+    # Fora de uma requisição (agendador, linha de comando) a ação é atribuída ao sistema
+    usuario = current_user if has_request_context() and current_user.is_authenticated else None
     log = LogAuditoria(
-        usuario_id=current_user.id,
-        usuario_nome=current_user.nome,
+        usuario_id=usuario.id if usuario else None,
+        usuario_nome=usuario.nome if usuario else 'Sistema',
         acao=acao,
         detalhes=detalhes
     )
@@ -112,69 +518,831 @@ def is_admin():
     """Verifica se o usuário logado é o administrador."""
     return current_user.is_authenticated and current_user.username == 'admin'
 
-# Funções auxiliares
-def obter_ponto_saida(motorista_id, data):
-    """Obtém o ponto de saída do motorista na data específica."""
-    inicio = datetime.combine(data, datetime.min.time())
-    fim = datetime.combine(data, datetime.max.time())
-    
-    ponto_saida = Ponto.query.filter(
+# Controle de versões das tabelas (cache condicional)
+def incrementar_versao_tabelas(tabelas, conexao=None):
+    """Incrementa a versão das tabelas alteradas na transação corrente."""
+    conexao = conexao if conexao is not None else db.session.connection()
+    agora = datetime.utcnow()
+    for tabela in sorted(set(tabelas)):
+        if tabela == VersaoTabela.__tablename__:
+            continue
+        stmt = sqlite_insert(VersaoTabela).values(tabela=tabela, versao=1, atualizado_em=agora)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=['tabela'],
+            set_={'versao': VersaoTabela.versao + 1, 'atualizado_em': agora}
+        )
+        conexao.execute(stmt)
+
+def tabelas_em_cascata(tabelas):
+    """Tabelas alcançadas pelos ON DELETE do banco ao excluir linhas das informadas."""
+    alcancadas = set(tabelas)
+    pendentes = list(alcancadas)
+    while pendentes:
+        origem = pendentes.pop()
+        for tabela in db.metadata.sorted_tables:
+            if tabela.name not in alcancadas and any(
+                    fk.ondelete and fk.column.table.name == origem for fk in tabela.foreign_keys):
+                alcancadas.add(tabela.name)
+                pendentes.append(tabela.name)
+    return alcancadas
+
+@event.listens_for(db.session, 'after_flush')
+def _versionar_flush(sessao, contexto):
+    tabelas = {obj.__tablename__ for obj in sessao.new}
+    tabelas |= tabelas_em_cascata({obj.__tablename__ for obj in sessao.deleted})
+    tabelas |= {obj.__tablename__ for obj in sessao.dirty if sessao.is_modified(obj)}
+    # Versões ficam no banco da filial; tabelas globais não são cacheadas
+    tabelas -= TABELAS_GLOBAIS
+    if tabelas:
+        incrementar_versao_tabelas(tabelas, sessao.connection())
+
+@event.listens_for(db.session, 'do_orm_execute')
+def _versionar_escrita_em_massa(estado):
+    # INSERT/UPDATE/DELETE em massa (session.execute, query.update/delete) não passam pelo flush
+    if (estado.is_insert or estado.is_update or estado.is_delete) and estado.bind_mapper is not None:
+        tabelas = {estado.bind_mapper.local_table.name}
+        if estado.is_delete:
+            tabelas = tabelas_em_cascata(tabelas)
+        tabelas -= TABELAS_GLOBAIS
+        if tabelas:
+            incrementar_versao_tabelas(tabelas, estado.session.connection())
+
+def obter_versoes(tabelas, sessao=None):
+    """Retorna (assinatura, última alteração) das tabelas informadas."""
+    sessao = sessao if sessao is not None else db.session
+    registros = sessao.query(VersaoTabela).filter(VersaoTabela.tabela.in_(tabelas)).all()
+    versoes = {r.tabela: r for r in registros}
+    assinatura = ';'.join(f"{t}:{versoes[t].versao if t in versoes else 0}" for t in sorted(tabelas))
+    datas = [r.atualizado_em for r in registros if r.atualizado_em]
+    ultima_alteracao = max(datas).replace(microsecond=0) if datas else None
+    return assinatura, ultima_alteracao
+
+def obter_versoes_filiais(tabelas, filiais, relatorio=False):
+    """Combina as versões das tabelas em várias filiais (uma assinatura por filial)."""
+    versoes = executar_por_filial(
+        lambda: obter_versoes(tabelas, sessao_relatorios() if relatorio else None), filiais
+    )
+    assinatura = '|'.join(f"{codigo}={assinatura}" for codigo, (assinatura, _) in versoes.items())
+    datas = [ultima for _, ultima in versoes.values() if ultima]
+    return assinatura, max(datas) if datas else None
+
+def cache_condicional(*tabelas, por_tipo=None, relatorio=False, consolidado=False):
+    """Emite ETag/Last-Modified e responde 304 quando as tabelas não mudaram.
+
+    Com `por_tipo`, as tabelas são escolhidas pelo argumento `tipo` da rota.
+    Rotas com `relatorio=True` leem as versões da mesma base que seus dados
+    (o snapshot, quando habilitado); com `consolidado=True`, de todas as
+    filiais que a rota agrega.
+    """
+    def decorador(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            tabelas_rota = por_tipo.get(kwargs.get('tipo'), ()) if por_tipo is not None else tabelas
+            # Mensagens flash pendentes precisam ser renderizadas na página
+            if request.method != 'GET' or not tabelas_rota or session.get('_flashes'):
+                return view(*args, **kwargs)
+
+            filiais = filiais_consolidadas() if consolidado else [filial_atual()]
+            assinatura, ultima_alteracao = obter_versoes_filiais(tabelas_rota, filiais, relatorio)
+            chave = f"{assinatura}|{current_user.get_id()}|{request.full_path}|{date.today().isoformat()}"
+            etag = hashlib.sha1(chave.encode('utf-8')).hexdigest()
+
+            nao_modificado = False
+            if request.if_none_match:
+                nao_modificado = request.if_none_match.contains_weak(etag)
+            elif request.if_modified_since and ultima_alteracao:
+                nao_modificado = ultima_alteracao <= request.if_modified_since.replace(tzinfo=None)
+
+            if nao_modificado:
+                resposta = make_response('', 304)
+            else:
+                resposta = make_response(view(*args, **kwargs))
+                if resposta.status_code != 200:
+                    return resposta
+            resposta.set_etag(etag)
+            if ultima_alteracao:
+                resposta.last_modified = ultima_alteracao
+            resposta.headers['Cache-Control'] = 'private, no-cache'
+            return resposta
+        return wrapper
+    return decorador
+
+# Log de alterações (CDC) para sincronização incremental
+TABELAS_ALTERACOES = ('colaborador', 'ponto', 'frota', 'desconto')
+
+# Mesmo formato de DateTime gravado pelo SQLAlchemy (microssegundos com 6 dígitos)
+SQL_AGORA = "strftime('%Y-%m-%d %H:%M:%f000', 'now')"
+
+def sql_triggers_alteracoes(tabela):
+    """DDL dos triggers que registram inserções, atualizações e exclusões da tabela.
+
+    Por serem do banco, também capturam escritas em massa e exclusões em cascata.
+    """
+    colunas = [coluna.name for coluna in tabela.columns]
+    linha = lambda prefixo: 'json_object(' + ', '.join(f"'{c}', {prefixo}.{c}" for c in colunas) + ')'
+    alteradas = ' || '.join(
+        f"""CASE WHEN OLD.{c} IS NOT NEW.{c} THEN '"{c}":' || json_array(OLD.{c}, NEW.{c}) || ',' ELSE '' END"""
+        for c in colunas
+    )
+    inserir = ("INSERT INTO registro_alteracao (tabela, registro_id, operacao, diferencas, alterado_em) "
+               "VALUES ('{tabela}', {registro}, '{operacao}', {diferencas}, " + SQL_AGORA + ");")
+    nome = tabela.name
+    return [
+        f"CREATE TRIGGER alteracoes_{nome}_insert AFTER INSERT ON {nome} BEGIN "
+        + inserir.format(tabela=nome, registro='NEW.id', operacao='insert', diferencas=linha('NEW')) + " END",
+        f"CREATE TRIGGER alteracoes_{nome}_update AFTER UPDATE ON {nome} "
+        f"WHEN {' OR '.join(f'OLD.{c} IS NOT NEW.{c}' for c in colunas)} BEGIN "
+        + inserir.format(tabela=nome, registro='NEW.id', operacao='update',
+                         diferencas=f"'{{' || rtrim({alteradas}, ',') || '}}'") + " END",
+        f"CREATE TRIGGER alteracoes_{nome}_delete AFTER DELETE ON {nome} BEGIN "
+        + inserir.format(tabela=nome, registro='OLD.id', operacao='delete', diferencas=linha('OLD')) + " END",
+    ]
+
+def instalar_triggers_alteracoes(engine):
+    """(Re)cria os triggers de CDC: as colunas capturadas acompanham o schema atual."""
+    with engine.begin() as conexao:
+        for nome in TABELAS_ALTERACOES:
+            for operacao in ('insert', 'update', 'delete'):
+                conexao.exec_driver_sql(f'DROP TRIGGER IF EXISTS alteracoes_{nome}_{operacao}')
+            for ddl in sql_triggers_alteracoes(db.metadata.tables[nome]):
+                conexao.exec_driver_sql(ddl)
+
+# Registro de veículos e resumo diário da frota
+def normalizar_placa(placa):
+    placa = (placa or '').strip().upper()
+    return placa or None
+
+def obter_ou_criar_veiculo(sessao, placa):
+    """Retorna o veículo da placa, criando-o no cadastro se ainda não existir."""
+    placa = normalizar_placa(placa)
+    if not placa:
+        return None
+    novos = sessao.info.setdefault('veiculos_novos', {})
+    if placa in novos:
+        return novos[placa]
+    with sessao.no_autoflush:
+        veiculo = sessao.query(Veiculo).filter_by(placa=placa).first()
+    if veiculo is None:
+        veiculo = Veiculo(placa=placa)
+        sessao.add(veiculo)
+        novos[placa] = veiculo
+    return veiculo
+
+@event.listens_for(db.session, 'before_flush')
+def _vincular_veiculos(sessao, contexto, instancias):
+    for obj in list(sessao.new) + list(sessao.dirty):
+        if isinstance(obj, Frota):
+            if db.inspect(obj).attrs.veiculo.history.has_changes() or obj.veiculo_id is None:
+                obj.veiculo_obj = obter_ou_criar_veiculo(sessao, obj.veiculo)
+        elif isinstance(obj, Colaborador):
+            if db.inspect(obj).attrs.veiculo_vinculado.history.has_changes():
+                obj.veiculo_vinculado_obj = obter_ou_criar_veiculo(sessao, obj.veiculo_vinculado)
+
+@event.listens_for(db.session, 'after_flush_postexec')
+def _limpar_veiculos_novos(sessao, contexto):
+    sessao.info.pop('veiculos_novos', None)
+
+def _chaves_resumo(obj):
+    """Chaves (data, veículo, motorista) atuais e anteriores de uma viagem."""
+    estado = db.inspect(obj)
+    chaves = {(obj.data, obj.veiculo_id, obj.motorista_id)}
+    anteriores = {}
+    for atributo in ('data', 'veiculo_id', 'motorista_id'):
+        historico = estado.attrs[atributo].history
+        anteriores[atributo] = historico.deleted[0] if historico.deleted else getattr(obj, atributo)
+    chaves.add((anteriores['data'], anteriores['veiculo_id'], anteriores['motorista_id']))
+    return chaves
+
+@event.listens_for(db.session, 'after_flush')
+def _atualizar_resumo_flush(sessao, contexto):
+    chaves = set()
+    frota_ids = set()
+    for obj in list(sessao.new) + list(sessao.dirty) + list(sessao.deleted):
+        if isinstance(obj, Frota):
+            chaves |= _chaves_resumo(obj)
+        elif isinstance(obj, Desconto):
+            frota_ids.add(obj.frota_id)
+            historico = db.inspect(obj).attrs.frota_id.history
+            frota_ids.update(historico.deleted)
+    chaves |= chaves_das_viagens(sessao.connection(), frota_ids)
+    if chaves:
+        recalcular_resumo_diario(sessao.connection(), chaves)
+        marcar_varredura_pendente(sessao.connection(), chaves)
+
+def chaves_das_viagens(conexao, frota_ids):
+    """Chaves (data, veículo, motorista) do resumo diário das viagens informadas."""
+    frota_ids = set(frota_ids) - {None}
+    if not frota_ids:
+        return set()
+    tabela = Frota.__table__
+    linhas = conexao.execute(
+        db.select(tabela.c.data, tabela.c.veiculo_id, tabela.c.motorista_id).where(tabela.c.id.in_(frota_ids))
+    )
+    return {tuple(linha) for linha in linhas}
+
+def recalcular_resumo_diario(conexao, chaves):
+    """Recalcula as linhas do resumo diário apenas para as chaves afetadas."""
+    frota = Frota.__table__
+    desconto = Desconto.__table__
+    resumo = ResumoDiarioFrota.__table__
+    for data_ref, veiculo_id, motorista_id in chaves:
+        if data_ref is None or veiculo_id is None or motorista_id is None:
+            continue
+        filtro_chave = (resumo.c.data == data_ref) & (resumo.c.veiculo_id == veiculo_id) & (resumo.c.motorista_id == motorista_id)
+        viagens = conexao.execute(
+            db.select(frota.c.id, frota.c.hora_saida, frota.c.hora_retorno, frota.c.km_inicial, frota.c.km_final, frota.c.status)
+            .where(frota.c.data == data_ref, frota.c.veiculo_id == veiculo_id, frota.c.motorista_id == motorista_id)
+        ).all()
+        if not viagens:
+            conexao.execute(resumo.delete().where(filtro_chave))
+            continue
+
+        valores = {
+            'viagens': len(viagens),
+            'viagens_extraordinarias': sum(1 for v in viagens if v.status == 'extraordinaria'),
+            'km_rodado': sum(v.km_final - v.km_inicial for v in viagens
+                             if v.km_inicial is not None and v.km_final is not None and v.km_final > v.km_inicial),
+            'minutos_fora': sum(minutos_entre(v.hora_saida, v.hora_retorno) for v in viagens),
+        }
+        valores['descontos_gerados'], valores['valor_descontos'] = conexao.execute(
+            db.select(db.func.count(desconto.c.id), db.func.coalesce(db.func.sum(desconto.c.valor), 0))
+            .where(desconto.c.frota_id.in_([v.id for v in viagens]))
+        ).one()
+
+        stmt = sqlite_insert(resumo).values(data=data_ref, veiculo_id=veiculo_id, motorista_id=motorista_id, **valores)
+        conexao.execute(stmt.on_conflict_do_update(index_elements=['data', 'veiculo_id', 'motorista_id'], set_=valores))
+    incrementar_versao_tabelas([ResumoDiarioFrota.__tablename__], conexao)
+
+def minutos_entre(hora_saida, hora_retorno):
+    if not hora_saida or not hora_retorno or hora_retorno <= hora_saida:
+        return 0
+    diferenca = datetime.combine(date.min, hora_retorno) - datetime.combine(date.min, hora_saida)
+    return int(diferenca.total_seconds() // 60)
+
+def reconstruir_resumo_diario(desde=None):
+    """Reconstrói o resumo diário a partir das viagens: todo (carga inicial) ou de `desde` em diante.
+
+    Um único INSERT ... SELECT ... GROUP BY, com as mesmas regras de
+    recalcular_resumo_diario: a trava de escrita dura duas instruções, e não
+    duas consultas por chave.
+    """
+    frota = Frota.__table__
+    desconto = Desconto.__table__
+    resumo = ResumoDiarioFrota.__table__
+    descontos = db.select(
+        desconto.c.frota_id, db.func.count().label('quantidade'), db.func.sum(desconto.c.valor).label('valor')
+    ).where(desconto.c.frota_id.isnot(None)).group_by(desconto.c.frota_id).subquery()
+    segundos = lambda hora: db.cast(db.func.strftime('%s', hora), db.Integer)
+    chave = (frota.c.data, frota.c.veiculo_id, frota.c.motorista_id)
+    consulta = db.select(
+        *chave,
+        db.func.count(frota.c.id),
+        db.func.sum(db.case((frota.c.status == 'extraordinaria', 1), else_=0)),
+        db.func.sum(db.case((frota.c.km_final > frota.c.km_inicial, frota.c.km_final - frota.c.km_inicial), else_=0)),
+        db.func.sum(db.case((frota.c.hora_retorno > frota.c.hora_saida,
+                             (segundos(frota.c.hora_retorno) - segundos(frota.c.hora_saida)) // 60), else_=0)),
+        db.func.coalesce(db.func.sum(descontos.c.quantidade), 0),
+        db.func.coalesce(db.func.sum(descontos.c.valor), 0),
+    ).select_from(frota.outerjoin(descontos, descontos.c.frota_id == frota.c.id)).where(
+        frota.c.veiculo_id.isnot(None), frota.c.motorista_id.isnot(None)
+    ).group_by(*chave)
+    remover = resumo.delete()
+    if desde is not None:
+        consulta = consulta.where(frota.c.data >= desde)
+        remover = remover.where(resumo.c.data >= desde)
+
+    conexao = db.session.connection()
+    conexao.execute(remover)
+    conexao.execute(resumo.insert().from_select(
+        ['data', 'veiculo_id', 'motorista_id', 'viagens', 'viagens_extraordinarias', 'km_rodado', 'minutos_fora',
+         'descontos_gerados', 'valor_descontos'], consulta))
+    incrementar_versao_tabelas([ResumoDiarioFrota.__tablename__], conexao)
+    db.session.commit()
+
+def popular_veiculos():
+    """Cria o cadastro de veículos a partir dos textos livres já existentes."""
+    placas = {normalizar_placa(v) for (v,) in db.session.query(Frota.veiculo).distinct()}
+    placas |= {normalizar_placa(v) for (v,) in db.session.query(Colaborador.veiculo_vinculado).distinct()}
+    placas.discard(None)
+    for placa in placas:
+        obter_ou_criar_veiculo(db.session, placa)
+    db.session.flush()
+    ids = dict(db.session.query(Veiculo.placa, Veiculo.id).all())
+    for placa_original, in db.session.query(Frota.veiculo).distinct():
+        Frota.query.filter(Frota.veiculo == placa_original).update(
+            {'veiculo_id': ids.get(normalizar_placa(placa_original))}, synchronize_session=False)
+    for placa_original, in db.session.query(Colaborador.veiculo_vinculado).distinct():
+        Colaborador.query.filter(Colaborador.veiculo_vinculado == placa_original).update(
+            {'veiculo_vinculado_id': ids.get(normalizar_placa(placa_original))}, synchronize_session=False)
+    db.session.commit()
+
+def atualizar_schema(engine, tabelas):
+    """Adiciona colunas e índices novos às tabelas já existentes no banco.
+
+    O `create_all` só cria tabelas ausentes; retorna as colunas adicionadas.
+    """
+    adicionadas = set()
+    inspetor = db.inspect(engine)
+    with engine.begin() as conexao:
+        for tabela in tabelas:
+            existentes = {c['name'] for c in inspetor.get_columns(tabela.name)}
+            for coluna in tabela.columns:
+                if coluna.name in existentes:
+                    continue
+                ddl = f'ALTER TABLE {tabela.name} ADD COLUMN {coluna.name} {coluna.type.compile(dialect=engine.dialect)}'
+                for fk in coluna.foreign_keys:
+                    ddl += f' REFERENCES {fk.column.table.name} ({fk.column.name})'
+                conexao.execute(db.text(ddl))
+                adicionadas.add((tabela.name, coluna.name))
+            for indice in tabela.indexes:
+                indice.create(conexao, checkfirst=True)
+    reconstruir_tabelas(engine, [tabela for tabela in tabelas if _chaves_divergentes(inspetor, tabela)])
+    return adicionadas
+
+def _chaves_divergentes(inspetor, tabela):
+    """Indica se as chaves estrangeiras do banco diferem das do modelo (ex.: ON DELETE)."""
+    existentes = {
+        (tuple(fk['constrained_columns']), ((fk.get('options') or {}).get('ondelete') or '').upper())
+        for fk in inspetor.get_foreign_keys(tabela.name)
+    }
+    esperadas = {((fk.parent.name,), (fk.ondelete or '').upper()) for fk in tabela.foreign_keys}
+    return existentes != esperadas
+
+# Colunas que saíram do modelo: removidas dos bancos existentes ao inicializar
+COLUNAS_REMOVIDAS = {
+    'colaborador': ('situacao_cnh',),  # a situação da CNH é calculada na hora, pela data do dia
+}
+
+def remover_colunas_obsoletas(engine):
+    inspetor = db.inspect(engine)
+    with engine.begin() as conexao:
+        for tabela, colunas in COLUNAS_REMOVIDAS.items():
+            existentes = {c['name'] for c in inspetor.get_columns(tabela)}
+            obsoletas = [coluna for coluna in colunas if coluna in existentes]
+            if not obsoletas:
+                continue
+            # Os triggers de CDC citam todas as colunas; são recriados em seguida por instalar_triggers_alteracoes
+            for operacao in ('insert', 'update', 'delete'):
+                conexao.exec_driver_sql(f'DROP TRIGGER IF EXISTS alteracoes_{tabela}_{operacao}')
+            for coluna in obsoletas:
+                conexao.exec_driver_sql(f'ALTER TABLE {tabela} DROP COLUMN {coluna}')
+
+def remover_descontos_automaticos_duplicados(engine):
+    """Mantém só o primeiro desconto automático de cada viagem, antes de criar o índice único."""
+    if any(indice['name'] == 'uq_desconto_automatico_frota' for indice in db.inspect(engine).get_indexes('desconto')):
+        return
+    with engine.begin() as conexao:
+        conexao.execute(db.text(
+            "DELETE FROM desconto WHERE automatico = 1 AND frota_id IS NOT NULL AND id NOT IN ("
+            "SELECT MIN(id) FROM desconto WHERE automatico = 1 AND frota_id IS NOT NULL GROUP BY frota_id)"
+        ))
+
+def reconstruir_tabelas(engine, tabelas):
+    """Recria as tabelas com o DDL atual do modelo, preservando dados e índices.
+
+    O SQLite não altera chaves estrangeiras com ALTER TABLE: a tabela nova é
+    criada, recebe os dados e assume o nome da antiga, com as FKs desligadas.
+    """
+    if not tabelas:
+        return
+    with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conexao:
+        conexao.exec_driver_sql('PRAGMA foreign_keys=OFF')
+        conexao.exec_driver_sql('BEGIN')
+        try:
+            for tabela in tabelas:
+                colunas = ', '.join(coluna.name for coluna in tabela.columns)
+                ddl = str(CreateTable(tabela).compile(dialect=engine.dialect)).strip()
+                ddl = ddl.replace(f'CREATE TABLE {tabela.name} ', f'CREATE TABLE {tabela.name}_nova ', 1)
+                conexao.exec_driver_sql(ddl)
+                conexao.exec_driver_sql(f'INSERT INTO {tabela.name}_nova ({colunas}) SELECT {colunas} FROM {tabela.name}')
+                conexao.exec_driver_sql(f'DROP TABLE {tabela.name}')
+                conexao.exec_driver_sql(f'ALTER TABLE {tabela.name}_nova RENAME TO {tabela.name}')
+                for indice in tabela.indexes:
+                    indice.create(conexao)
+            conexao.exec_driver_sql('COMMIT')
+        except Exception:
+            conexao.exec_driver_sql('ROLLBACK')
+            raise
+        finally:
+            conexao.exec_driver_sql('PRAGMA foreign_keys=ON')
+
+# Situação da CNH: calculada na hora, nunca gravada, já que o simples passar dos
+# dias muda a situação (em Python por colaborador ou como condição SQL)
+CNH_DIAS_AVISO_VENCIMENTO = 30
+CNH_DIAS_VALIDADE_CONSULTA = 180
+
+def calcular_situacao_cnh(vencimento_cnh, ultima_consulta, hoje=None):
+    """'em_dia' com CNH válida além do aviso e consulta recente; 'atencao' caso contrário."""
+    hoje = hoje or date.today()
+    if (vencimento_cnh and vencimento_cnh > hoje + timedelta(days=CNH_DIAS_AVISO_VENCIMENTO)
+            and ultima_consulta and ultima_consulta >= hoje - timedelta(days=CNH_DIAS_VALIDADE_CONSULTA)):
+        return 'em_dia'
+    return 'atencao'
+
+def condicao_cnh_em_dia(hoje=None):
+    """Regra de calcular_situacao_cnh como condição SQL (datas nulas não contam como em dia)."""
+    hoje = hoje or date.today()
+    return db.and_(Colaborador.vencimento_cnh > hoje + timedelta(days=CNH_DIAS_AVISO_VENCIMENTO),
+                   Colaborador.ultima_consulta >= hoje - timedelta(days=CNH_DIAS_VALIDADE_CONSULTA))
+
+def condicao_cnh_atencao(hoje=None):
+    return db.or_(Colaborador.vencimento_cnh.is_(None), Colaborador.ultima_consulta.is_(None),
+                  db.not_(condicao_cnh_em_dia(hoje)))
+
+# Varredura de anomalias da frota
+LIMITES_ANOMALIA = {
+    'tolerancia_km': 0.5,         # diferença aceita entre KM final anterior e KM inicial
+    'km_maximo_viagem': 1000.0,
+    'velocidade_maxima': 150.0,   # km/h médio entre saída e retorno
+}
+
+TIPOS_ANOMALIA = {
+    'hodometro_divergente': 'Hodômetro divergente',
+    'km_regressivo': 'KM final menor que o inicial',
+    'km_implausivel': 'Quilometragem implausível',
+    'sobreposicao_veiculo': 'Viagens sobrepostas (veículo)',
+    'sobreposicao_motorista': 'Viagens sobrepostas (motorista)',
+}
+
+# Uma passada por veículo em ordem (data, hora_saida): cada viagem é comparada
+# com a anterior via funções de janela, sem carregar registros no Python.
+SQL_ANOMALIAS_VEICULO = """
+INSERT INTO anomalia_frota (frota_id, referencia_id, veiculo_id, motorista_id, tipo, detalhes, detectado_em)
+WITH ordenadas AS (
+    SELECT id, veiculo_id, motorista_id, data, hora_saida, hora_retorno, km_inicial, km_final,
+           LAG(id) OVER janela AS anterior_id,
+           LAG(km_final) OVER janela AS anterior_km_final,
+           MAX(hora_retorno) OVER (PARTITION BY veiculo_id, data ORDER BY hora_saida, id
+                                   ROWS BETWEEN UNBOUNDED PRECEDING AND 1 PRECEDING) AS retorno_anterior,
+           (julianday('2000-01-01 ' || hora_retorno) - julianday('2000-01-01 ' || hora_saida)) * 24 AS horas
+    FROM frota
+    WHERE veiculo_id IS NOT NULL AND {filtro}
+    WINDOW janela AS (PARTITION BY veiculo_id ORDER BY data, hora_saida, id)
+)
+SELECT id, anterior_id, veiculo_id, motorista_id, 'hodometro_divergente',
+       printf('KM inicial %.1f difere do KM final %.1f da viagem anterior', km_inicial, anterior_km_final), :agora
+FROM ordenadas
+WHERE km_inicial IS NOT NULL AND anterior_km_final IS NOT NULL AND abs(km_inicial - anterior_km_final) > :tolerancia_km
+UNION ALL
+SELECT id, NULL, veiculo_id, motorista_id, 'km_regressivo',
+       printf('KM final %.1f menor que o KM inicial %.1f', km_final, km_inicial), :agora
+FROM ordenadas
+WHERE km_final < km_inicial
+UNION ALL
+SELECT id, NULL, veiculo_id, motorista_id, 'km_implausivel',
+       printf('%.1f km rodados', km_final - km_inicial), :agora
+FROM ordenadas
+WHERE km_final - km_inicial > :km_maximo_viagem
+   OR (horas > 0 AND (km_final - km_inicial) / horas > :velocidade_maxima)
+UNION ALL
+SELECT id, anterior_id, veiculo_id, motorista_id, 'sobreposicao_veiculo',
+       'Saída antes do retorno de outra viagem do mesmo veículo no dia', :agora
+FROM ordenadas
+WHERE hora_saida IS NOT NULL AND retorno_anterior IS NOT NULL AND hora_saida < retorno_anterior
+"""
+
+SQL_ANOMALIAS_MOTORISTA = """
+INSERT INTO anomalia_frota (frota_id, referencia_id, veiculo_id, motorista_id, tipo, detalhes, detectado_em)
+WITH ordenadas AS (
+    SELECT id, veiculo_id, motorista_id, hora_saida,
+           LAG(id) OVER janela AS anterior_id,
+           MAX(hora_retorno) OVER (janela ROWS BETWEEN UNBOUNDED PRECEDING AND 1 PRECEDING) AS retorno_anterior
+    FROM frota
+    WHERE {filtro}
+    WINDOW janela AS (PARTITION BY motorista_id, data ORDER BY hora_saida, id)
+)
+SELECT id, anterior_id, veiculo_id, motorista_id, 'sobreposicao_motorista',
+       'Saída antes do retorno de outra viagem do mesmo motorista no dia', :agora
+FROM ordenadas
+WHERE hora_saida IS NOT NULL AND retorno_anterior IS NOT NULL AND hora_saida < retorno_anterior
+"""
+
+def marcar_varredura_pendente(conexao, chaves):
+    """Marca veículos e motoristas das viagens alteradas para a próxima varredura."""
+    agora = datetime.utcnow()
+    linhas = {('veiculo', veiculo_id) for _, veiculo_id, _ in chaves if veiculo_id is not None}
+    linhas |= {('motorista', motorista_id) for _, _, motorista_id in chaves if motorista_id is not None}
+    if not linhas:
+        return
+    stmt = sqlite_insert(VarreduraPendente).values(
+        [{'tipo': tipo, 'ref_id': ref_id, 'marcado_em': agora} for tipo, ref_id in linhas]
+    )
+    conexao.execute(stmt.on_conflict_do_update(index_elements=['tipo', 'ref_id'], set_={'marcado_em': agora}))
+
+def varrer_anomalias_frota(incremental=True):
+    """Executa a varredura de anomalias e retorna quantas foram registradas.
+
+    No modo incremental só são reprocessados os veículos/motoristas marcados
+    como pendentes até o início da execução.
+    """
+    inicio = datetime.utcnow()
+    conexao = db.session.connection()
+    parametros = dict(LIMITES_ANOMALIA, agora=inicio, inicio=inicio)
+    tipos_veiculo = [t for t in TIPOS_ANOMALIA if t != 'sobreposicao_motorista']
+
+    if incremental:
+        pendentes = "SELECT ref_id FROM varredura_pendente WHERE tipo = '{tipo}' AND marcado_em <= :inicio"
+        filtro_veiculo = f"veiculo_id IN ({pendentes.format(tipo='veiculo')})"
+        filtro_motorista = f"motorista_id IN ({pendentes.format(tipo='motorista')})"
+    else:
+        filtro_veiculo = filtro_motorista = '1 = 1'
+
+    anomalia = AnomaliaFrota.__table__
+    conexao.execute(anomalia.delete().where(anomalia.c.tipo.in_(tipos_veiculo), db.text(filtro_veiculo)), parametros)
+    conexao.execute(anomalia.delete().where(anomalia.c.tipo == 'sobreposicao_motorista', db.text(filtro_motorista)),
+                    parametros)
+
+    total = conexao.execute(db.text(SQL_ANOMALIAS_VEICULO.format(filtro=filtro_veiculo)), parametros).rowcount
+    total += conexao.execute(db.text(SQL_ANOMALIAS_MOTORISTA.format(filtro=filtro_motorista)), parametros).rowcount
+
+    pendente = VarreduraPendente.__table__
+    conexao.execute(pendente.delete().where(pendente.c.marcado_em <= inicio))
+    incrementar_versao_tabelas([AnomaliaFrota.__tablename__], conexao)
+    db.session.commit()
+    return total
+
+# Snapshot de leitura para exportações e relatórios
+_travas_snapshot = {codigo: threading.Lock() for codigo in app.config['FILIAIS']}
+
+def caminho_snapshot(codigo=None):
+    return os.path.join(app.instance_path, nome_banco_filial(codigo or filial_atual(), snapshot=True))
+
+def criar_snapshot(codigo=None):
+    """Gera uma cópia consistente do banco da filial via API de backup online do SQLite."""
+    codigo = codigo or filial_atual()
+    destino = caminho_snapshot(codigo)
+    temporario = f'{destino}.{os.getpid()}.{threading.get_ident()}.tmp'
+    origem = engine_filial(codigo).raw_connection()
+    try:
+        copia = sqlite3.connect(temporario)
+        try:
+            origem.driver_connection.backup(copia)
+            # A cópia é aberta somente leitura: sem WAL, não precisa de arquivos -wal/-shm
+            copia.execute('PRAGMA journal_mode=DELETE')
+        finally:
+            copia.close()
+    finally:
+        origem.close()
+    os.replace(temporario, destino)
+    engine_filial(codigo, snapshot=True).dispose()
+
+def atualizar_snapshot_se_necessario():
+    """Recria o snapshot da filial quando ausente ou mais antigo que SNAPSHOT_INTERVALO."""
+    codigo = filial_atual()
+    trava = _travas_snapshot[codigo]
+    try:
+        idade = datetime.now().timestamp() - os.path.getmtime(caminho_snapshot(codigo))
+    except FileNotFoundError:
+        with trava:
+            if not os.path.exists(caminho_snapshot(codigo)):
+                criar_snapshot(codigo)
+        return
+    # Enquanto outra thread atualiza, as leituras seguem no snapshot atual
+    if idade > app.config['SNAPSHOT_INTERVALO'] and trava.acquire(blocking=False):
+        try:
+            criar_snapshot(codigo)
+        finally:
+            trava.release()
+
+def sessao_relatorios():
+    """Sessão para leituras pesadas: o snapshot da filial, se habilitado, ou a sessão principal."""
+    if not app.config['RELATORIOS_VIA_SNAPSHOT']:
+        return db.session
+    if 'sessao_snapshot' not in g:
+        atualizar_snapshot_se_necessario()
+        g.sessao_snapshot = Session(bind=engine_filial(snapshot=True))
+    return g.sessao_snapshot
+
+@app.teardown_appcontext
+def fechar_sessao_snapshot(excecao=None):
+    sessao = g.pop('sessao_snapshot', None)
+    if sessao is not None:
+        sessao.close()
+
+def sem_arquivados(query, coluna_colaborador):
+    """Esconde o histórico de colaboradores arquivados das telas, contadores e exportações.
+
+    Os colaboradores arquivados são poucos: a subconsulta vira uma lista e os
+    índices de cada consulta continuam valendo. Registros sem colaborador ficam.
+    """
+    arquivados = db.select(Colaborador.id).where(Colaborador.arquivado_em.isnot(None))
+    return query.filter(db.or_(coluna_colaborador.is_(None), coluna_colaborador.not_in(arquivados)))
+
+# Consultas quentes: construídas aqui e usadas pelas rotas, para que
+# `flask verificar-consultas` inspecione exatamente o SQL que vai para o banco
+CONSULTAS_QUENTES = {}
+
+def consulta_quente(*variantes, ordenacao_aceita=None):
+    """Registra o construtor de uma consulta quente.
+
+    Cada variante são argumentos de exemplo (um conjunto de filtros da rota);
+    sem variantes, o construtor é chamado sem argumentos. `ordenacao_aceita`
+    documenta por que uma ordenação em B-tree temporária é aceitável nessa
+    consulta; a verificação a relata como aceita em vez de alerta.
+    """
+    def registrar(construtor):
+        CONSULTAS_QUENTES[construtor.__name__] = (construtor, variantes or ({},), ordenacao_aceita)
+        return construtor
+    return registrar
+
+def paginar(query, pagina):
+    """Limita a consulta à página pedida (a partir de 1), com uma linha a mais para indicar se há próxima página."""
+    por_pagina = app.config['ITENS_POR_PAGINA']
+    return query.limit(por_pagina + 1).offset((max(1, pagina) - 1) * por_pagina)
+
+def separar_pagina(linhas):
+    """Corta a linha extra de `paginar`; retorna as linhas da página e se há próxima."""
+    por_pagina = app.config['ITENS_POR_PAGINA']
+    return linhas[:por_pagina], len(linhas) > por_pagina
+
+def intervalo_do_dia(data):
+    """Primeiro e último instante da data, para filtrar colunas DateTime pelo índice."""
+    return datetime.combine(data, datetime.min.time()), datetime.combine(data, datetime.max.time())
+
+def contagem_cnh_atencao(hoje=None):
+    """Colaboradores ativos com CNH em atenção, pela regra calculada na data (consulta sem executar)."""
+    return Colaborador.query.filter_by(ativo=True).filter(condicao_cnh_atencao(hoje))
+
+@consulta_quente()
+def consultas_dashboard(hoje=None):
+    """Contagens e últimos registros do dashboard (consultas sem executar)."""
+    hoje = hoje or date.today()
+    inicio, fim = intervalo_do_dia(hoje)
+    return {
+        'total_colaboradores': Colaborador.query.filter_by(ativo=True),
+        # Intervalo em vez de date(data_hora): a função na coluna impediria o uso do índice
+        'total_pontos_hoje': sem_arquivados(Ponto.query.filter(Ponto.data_hora >= inicio, Ponto.data_hora <= fim),
+                                            Ponto.colaborador_id),
+        'total_descontos_pendentes': sem_arquivados(Desconto.query.filter_by(status='pendente'), Desconto.colaborador_id),
+        'total_frota_hoje': sem_arquivados(Frota.query.filter_by(data=hoje), Frota.motorista_id),
+        # CNH em atenção: mesma regra e mesmos colaboradores (ativos) da tela de habilitados
+        'total_cnh_atencao': contagem_cnh_atencao(hoje),
+        # Últimos registros (com o colaborador já carregado: a sessão da filial é fechada em seguida)
+        'ultimos_pontos': sem_arquivados(Ponto.query.options(db.joinedload(Ponto.colaborador)), Ponto.colaborador_id)
+            .order_by(Ponto.data_hora.desc()).limit(5),
+        'ultimos_descontos': sem_arquivados(Desconto.query.options(db.joinedload(Desconto.colaborador)),
+                                            Desconto.colaborador_id)
+            .filter_by(status='pendente').order_by(Desconto.criado_em.desc()).limit(5),
+    }
+
+@consulta_quente({'motorista_id': 1, 'data': date.today()})
+def consulta_ponto_saida(motorista_id, data):
+    inicio, fim = intervalo_do_dia(data)
+    return Ponto.query.filter(
         Ponto.colaborador_id == motorista_id,
         Ponto.data_hora >= inicio,
         Ponto.data_hora <= fim,
         Ponto.tipo == 'saida'
-    ).order_by(Ponto.data_hora.desc()).first()
-    
-    return ponto_saida
+    ).order_by(Ponto.data_hora.desc())
+
+@consulta_quente({'chaves': {(1, date.today() - timedelta(days=1)), (2, date.today())}},
+                 ordenacao_aceita='agrupa só as saídas dos motoristas e dias da página, '
+                                  'já localizadas por ix_ponto_colaborador_data_hora')
+def consulta_saidas(chaves):
+    datas = [data for _, data in chaves]
+    dia = db.func.date(Ponto.data_hora)
+    return db.session.query(Ponto.colaborador_id, dia, db.func.max(Ponto.data_hora)).filter(
+        Ponto.tipo == 'saida',
+        Ponto.colaborador_id.in_({motorista_id for motorista_id, _ in chaves}),
+        Ponto.data_hora >= intervalo_do_dia(min(datas))[0],
+        Ponto.data_hora <= intervalo_do_dia(max(datas))[1]
+    ).group_by(Ponto.colaborador_id, dia)
+
+@consulta_quente(
+    {},
+    {'colaborador_id': 1},
+    {'status': 'pendente'},
+    {'data_inicio': date.today() - timedelta(days=30), 'data_fim': date.today()},
+    {'pagina': 3},
+)
+def consulta_descontos(colaborador_id=None, status=None, data_inicio=None, data_fim=None, pagina=1):
+    query = sem_arquivados(Desconto.query, Desconto.colaborador_id).order_by(Desconto.data.desc())
+    if colaborador_id is not None:
+        query = query.filter_by(colaborador_id=colaborador_id)
+    if status is not None:
+        query = query.filter_by(status=status)
+    if data_inicio is not None:
+        query = query.filter(Desconto.data >= data_inicio)
+    if data_fim is not None:
+        query = query.filter(Desconto.data <= data_fim)
+    return paginar(query, pagina)
+
+@consulta_quente({}, {'nome': 'Silva'}, {'matricula': '0001'})
+def consulta_habilitados(nome=None, matricula=None):
+    query = Colaborador.query.filter_by(ativo=True).order_by(Colaborador.nome.asc())
+    if nome:
+        query = query.filter(Colaborador.nome.ilike(f'%{nome}%'))
+    if matricula:
+        query = query.filter(Colaborador.matricula.ilike(f'%{matricula}%'))
+    return query
 
-def gerar_desconto_automatico(frota_registro):
-    """Gera desconto automático com base em regras de negócio."""
-    desconto_existente = Desconto.query.filter_by(
-        frota_id=frota_registro.id,
-        automatico=True
-    ).first()
-    
-    if desconto_existente:
-        return None
-    
-    ponto_saida = obter_ponto_saida(frota_registro.motorista_id, frota_registro.data)
-    
+@consulta_quente({}, {'pagina': 3})
+def consulta_auditoria(pagina=1):
+    return paginar(LogAuditoria.query.order_by(LogAuditoria.data_hora.desc()), pagina)
+
+# Funções auxiliares
+def obter_ponto_saida(motorista_id, data):
+    """Obtém o ponto de saída do motorista na data específica."""
+    return consulta_ponto_saida(motorista_id, data).first()
+
+def obter_saidas(chaves):
+    """Horário do último ponto de saída por (motorista, data), em uma única consulta."""
+    chaves = {(int(motorista_id), data) for motorista_id, data in chaves if motorista_id is not None and data}
+    if len(chaves) == 1:
+        (motorista_id, data), = chaves
+        ponto_saida = obter_ponto_saida(motorista_id, data)
+        return {(motorista_id, data): ponto_saida.data_hora} if ponto_saida else {}
+    if not chaves:
+        return {}
+
+    saidas = {(motorista_id, date.fromisoformat(data)): saida for motorista_id, data, saida in consulta_saidas(chaves)}
+    return {chave: saidas[chave] for chave in chaves if chave in saidas}
+
+def calcular_desconto_automatico(frota_registro, saida):
+    """Aplica as regras de negócio à viagem; retorna os valores do desconto ou None."""
     motivo = None
     
     # Regra 1: Vinculação de uso de veículo sem marcação de ponto de saída
-    if not ponto_saida:
+    if not saida:
         motivo = f'Ausência de registro de ponto de saída - Veículo {frota_registro.veiculo}'
     
     # Regra 2: Utilização excedente a mais de 10 minutos
-    elif frota_registro.hora_retorno and ponto_saida.data_hora:
+    elif frota_registro.hora_retorno:
         ponto_retorno_datetime = datetime.combine(frota_registro.data, frota_registro.hora_retorno)
-        diferenca_tempo = ponto_retorno_datetime - ponto_saida.data_hora
+        diferenca_tempo = ponto_retorno_datetime - saida
         if diferenca_tempo > timedelta(minutes=10):
             motivo = f'Uso excedente de veículo - Veículo {frota_registro.veiculo} excedeu 10min'
 
-    if motivo:
-        valor_desconto = 50.00
-        if frota_registro.km_inicial and frota_registro.km_final:
-            km_rodado = frota_registro.km_final - frota_registro.km_inicial
-            if km_rodado > 0:
-                valor_desconto += km_rodado * 0.50
-        
-        desconto = Desconto(
-            colaborador_id=frota_registro.motorista_id,
-            data=frota_registro.data,
-            motivo=motivo,
-            valor=valor_desconto,
-            status='pendente',
-            frota_id=frota_registro.id,
-            automatico=True
-        )
-        
-        db.session.add(desconto)
-        db.session.commit()
-        registrar_log(f"Gerou desconto automático para a frota ID {frota_registro.id}", f"Motivo: {motivo}")
-        return desconto
-    
-    return None
+    if not motivo:
+        return None
+
+    valor_desconto = 50.00
+    if frota_registro.km_inicial and frota_registro.km_final:
+        km_rodado = frota_registro.km_final - frota_registro.km_inicial
+        if km_rodado > 0:
+            valor_desconto += km_rodado * 0.50
+
+    return {
+        'colaborador_id': int(frota_registro.motorista_id),
+        'data': frota_registro.data,
+        'motivo': motivo,
+        'valor': valor_desconto,
+        'status': 'pendente',
+        'frota_id': frota_registro.id,
+        'automatico': True,
+        'criado_em': datetime.utcnow(),
+    }
+
+def inserir_descontos_automaticos(valores, tamanho_lote=1000):
+    """Cria descontos automáticos com INSERT … ON CONFLICT DO NOTHING; retorna os frota_id criados.
+
+    O índice único parcial garante um desconto automático por viagem, mesmo com
+    edições, importações e reprocessamentos concorrentes: quem chega depois
+    simplesmente não insere.
+    """
+    criados = set()
+    for inicio in range(0, len(valores), tamanho_lote):
+        stmt = sqlite_insert(Desconto).values(valores[inicio:inicio + tamanho_lote])
+        stmt = stmt.on_conflict_do_nothing(
+            index_elements=['frota_id', 'automatico'], index_where=db.text('automatico = 1')
+        ).returning(Desconto.frota_id)
+        criados.update(frota_id for (frota_id,) in db.session.execute(stmt))
+    if criados:
+        # Inserção fora do flush: o resumo diário é atualizado aqui
+        chaves = chaves_das_viagens(db.session.connection(), criados)
+        recalcular_resumo_diario(db.session.connection(), chaves)
+    return criados
+
+def gerar_descontos_automaticos(registros):
+    """Gera os descontos automáticos das viagens (já gravadas) em lote; retorna os frota_id criados."""
+    saidas = obter_saidas((r.motorista_id, r.data) for r in registros)
+    valores = [
+        desconto for desconto in (
+            calcular_desconto_automatico(r, saidas.get((int(r.motorista_id), r.data))) for r in registros
+        ) if desconto
+    ]
+    criados = inserir_descontos_automaticos(valores)
+    if len(criados) == 1:
+        desconto, = [v for v in valores if v['frota_id'] in criados]
+        registrar_log(f"Gerou desconto automático para a frota ID {desconto['frota_id']}", f"Motivo: {desconto['motivo']}")
+    elif criados:
+        registrar_log(f"Gerou {len(criados)} descontos automáticos",
+                      f"Frotas: {', '.join(str(frota_id) for frota_id in sorted(criados))}")
+    return criados
+
+def reprocessar_descontos():
+    """Reavalia todas as viagens da filial; retorna quantos descontos foram gerados."""
+    registros = Frota.query.all()
+    criados = gerar_descontos_automaticos(registros)
+    for registro in registros:
+        if registro.id in criados:
+            registro.status = 'extraordinaria'
+    db.session.commit()
+    return len(criados)
+
+def gerar_desconto_automatico(frota_registro):
+    """Gera desconto automático com base em regras de negócio; indica se foi criado."""
+    return bool(gerar_descontos_automaticos([frota_registro]))
 
 # Rotas de Autenticação
 @app.route('/login', methods=['GET', 'POST'])
@@ -207,45 +1375,61 @@ def logout():
     return redirect(url_for('login'))
 
 # Rotas Principais
+def consultar_dashboard():
+    """Totais e últimos registros do dashboard na filial corrente."""
+    dados = {
+        chave: consulta.all() if chave.startswith('ultimos_') else consulta.count()
+        for chave, consulta in consultas_dashboard().items()
+    }
+    for registro in dados['ultimos_pontos'] + dados['ultimos_descontos']:
+        registro.filial = filial_atual()
+    return dados
+
 @app.route('/')
 @login_required
+@cache_condicional('colaborador', 'ponto', 'desconto', 'frota', consolidado=True)
 def index():
-    # Estatísticas do dashboard
-    total_colaboradores = Colaborador.query.filter_by(ativo=True).count()
-    total_pontos_hoje = Ponto.query.filter(
-        db.func.date(Ponto.data_hora) == date.today()
-    ).count()
-    total_descontos_pendentes = Desconto.query.filter_by(status='pendente').count()
-    total_frota_hoje = Frota.query.filter_by(data=date.today()).count()
-    
-    # CNH em atenção
-    data_limite_consulta = date.today() - timedelta(days=180)
-    data_vencimento_proximo = date.today() + timedelta(days=30)
-    total_cnh_atencao = Colaborador.query.filter(
-        (Colaborador.vencimento_cnh <= date.today()) | 
-        (Colaborador.ultima_consulta <= data_limite_consulta) |
-        (Colaborador.vencimento_cnh <= data_vencimento_proximo)
-    ).count()
-
-    # Últimos registros
-    ultimos_pontos = Ponto.query.order_by(Ponto.data_hora.desc()).limit(5).all()
-    ultimos_descontos = Desconto.query.filter_by(status='pendente').order_by(Desconto.criado_em.desc()).limit(5).all()
-    
+    # O admin vê todas as filiais: cada uma é consultada em paralelo e os resultados somados
+    por_filial = executar_por_filial(consultar_dashboard, filiais_consolidadas())
+    totais = {
+        chave: sum(dados[chave] for dados in por_filial.values())
+        for chave in ('total_colaboradores', 'total_pontos_hoje', 'total_descontos_pendentes',
+                      'total_frota_hoje', 'total_cnh_atencao')
+    }
+    ultimos_pontos = sorted((p for dados in por_filial.values() for p in dados['ultimos_pontos']),
+                            key=lambda p: p.data_hora, reverse=True)[:5]
+    ultimos_descontos = sorted((d for dados in por_filial.values() for d in dados['ultimos_descontos']),
+                               key=lambda d: d.criado_em or datetime.min, reverse=True)[:5]
+
     return render_template('index.html',
-                         total_colaboradores=total_colaboradores,
-                         total_pontos_hoje=total_pontos_hoje,
-                         total_descontos_pendentes=total_descontos_pendentes,
-                         total_frota_hoje=total_frota_hoje,
-                         total_cnh_atencao=total_cnh_atencao,
                          ultimos_pontos=ultimos_pontos,
-                         ultimos_descontos=ultimos_descontos)
+                         ultimos_descontos=ultimos_descontos,
+                         consolidado=len(por_filial) > 1,
+                         **totais)
+
+@app.route('/filial/<codigo>')
+@login_required
+def trocar_filial(codigo):
+    if not is_admin():
+        flash('Acesso negado.', 'error')
+        return redirect(url_for('index'))
+    if codigo not in app.config['FILIAIS']:
+        flash('Filial inválida!', 'error')
+        return redirect(url_for('index'))
+    session['filial'] = codigo
+    flash(f'Filial de trabalho alterada para {app.config["FILIAIS"][codigo]}.', 'success')
+    return redirect(request.referrer or url_for('index'))
 
 # Rotas de Colaboradores
 @app.route('/colaboradores')
 @login_required
 def colaboradores():
-    colaboradores = Colaborador.query.all()
-    return render_template('colaboradores.html', colaboradores=colaboradores)
+    mostrar_arquivados = request.args.get('arquivados') == '1'
+    query = Colaborador.query
+    if not mostrar_arquivados:
+        query = query.filter(Colaborador.arquivado_em.is_(None))
+    colaboradores = query.all()
+    return render_template('colaboradores.html', colaboradores=colaboradores, mostrar_arquivados=mostrar_arquivados)
 
 @app.route('/colaborador/novo', methods=['GET', 'POST'])
 @login_required
@@ -259,6 +1443,7 @@ def novo_colaborador():
                 nome=request.form['nome'],
                 matricula=request.form['matricula'],
                 cpf=request.form.get('cpf'),
+                pis=request.form.get('pis') or None,
                 telefone=request.form.get('telefone'),
                 email=request.form.get('email'),
                 veiculo_vinculado=request.form.get('veiculo_vinculado'),
@@ -288,6 +1473,7 @@ def editar_colaborador(id):
             colaborador.nome = request.form['nome']
             colaborador.matricula = request.form['matricula']
             colaborador.cpf = request.form.get('cpf')
+            colaborador.pis = request.form.get('pis') or None
             colaborador.telefone = request.form.get('telefone')
             colaborador.email = request.form.get('email')
             colaborador.veiculo_vinculado = request.form.get('veiculo_vinculado')
@@ -313,6 +1499,15 @@ def excluir_colaborador(id):
     
     try:
         nome_colaborador = colaborador.nome
+        # Os veículos usados pelo colaborador perdem viagens: entram na próxima varredura de anomalias
+        db.session.execute(
+            sqlite_insert(VarreduraPendente).from_select(
+                ['tipo', 'ref_id', 'marcado_em'],
+                db.select(db.literal('veiculo'), Frota.veiculo_id, db.literal(datetime.utcnow()))
+                .where(Frota.motorista_id == id, Frota.veiculo_id.isnot(None)).distinct()
+            ).on_conflict_do_nothing()
+        )
+        # Pontos, viagens, descontos e resumos são removidos pelo ON DELETE CASCADE do banco
         db.session.delete(colaborador)
         db.session.commit()
         registrar_log(f"Excluiu o colaborador: {nome_colaborador}")
@@ -323,11 +1518,47 @@ def excluir_colaborador(id):
     
     return redirect(url_for('colaboradores'))
 
+@app.route('/colaborador/arquivar/<int:id>')
+@login_required
+def arquivar_colaborador(id):
+    colaborador = Colaborador.query.get_or_404(id)
+
+    try:
+        # Exclusão lógica: uma única atualização. O histórico continua no banco, mas sai das
+        # listagens, contadores e exportações (sem_arquivados) e volta ao restaurar
+        Colaborador.query.filter_by(id=id).update(
+            {'ativo': False, 'arquivado_em': datetime.utcnow()}, synchronize_session=False)
+        db.session.commit()
+        registrar_log(f"Arquivou o colaborador: {colaborador.nome}")
+        flash('Colaborador arquivado com sucesso!', 'success')
+    except Exception as e:
+        db.session.rollback()
+        flash(f'Erro ao arquivar colaborador: {str(e)}', 'error')
+
+    return redirect(url_for('colaboradores'))
+
+@app.route('/colaborador/restaurar/<int:id>')
+@login_required
+def restaurar_colaborador(id):
+    colaborador = Colaborador.query.get_or_404(id)
+
+    try:
+        Colaborador.query.filter_by(id=id).update({'ativo': True, 'arquivado_em': None}, synchronize_session=False)
+        db.session.commit()
+        registrar_log(f"Restaurou o colaborador: {colaborador.nome}")
+        flash('Colaborador restaurado com sucesso!', 'success')
+    except Exception as e:
+        db.session.rollback()
+        flash(f'Erro ao restaurar colaborador: {str(e)}', 'error')
+
+    return redirect(url_for('colaboradores', arquivados=1))
+
 # Rotas de Ponto
 @app.route('/pontos')
 @login_required
+@cache_condicional('ponto', 'colaborador')
 def pontos():
-    pontos = Ponto.query.order_by(Ponto.data_hora.desc()).all()
+    pontos = sem_arquivados(Ponto.query, Ponto.colaborador_id).order_by(Ponto.data_hora.desc()).all()
     colaboradores = Colaborador.query.filter_by(ativo=True).all()
     return render_template('pontos.html', pontos=pontos, colaboradores=colaboradores)
 
@@ -404,8 +1635,9 @@ def excluir_ponto(id):
 # Rotas de Frota
 @app.route('/frota')
 @login_required
+@cache_condicional('frota', 'colaborador')
 def frota():
-    registros = Frota.query.order_by(Frota.data.desc()).all()
+    registros = sem_arquivados(Frota.query, Frota.motorista_id).order_by(Frota.data.desc()).all()
     colaboradores = Colaborador.query.filter_by(ativo=True).all()
     return render_template('frota.html', registros=registros, colaboradores=colaboradores)
 
@@ -427,14 +1659,7 @@ def verificar_desconto_frota(id):
 @app.route('/frota/reprocessar-descontos')
 @login_required
 def reprocessar_descontos_frota():
-    registros = Frota.query.all()
-    descontos_gerados = 0
-    for registro in registros:
-        desconto = gerar_desconto_automatico(registro)
-        if desconto:
-            descontos_gerados += 1
-            registro.status = 'extraordinaria'
-    db.session.commit()
+    descontos_gerados = reprocessar_descontos()
     registrar_log(f"Reprocessou descontos de frota, gerando {descontos_gerados} novos descontos")
     flash(f'Reprocessamento concluído. {descontos_gerados} descontos automáticos gerados.', 'success')
     return redirect(url_for('frota'))
@@ -456,6 +1681,10 @@ def novo_frota():
                 observacao=request.form.get('observacao', '')
             )
             
+            # Grava antes de avaliar: o desconto referencia a viagem pelo frota_id
+            db.session.add(frota_registro)
+            db.session.flush()
+
             # Reavalia status e gera desconto se necessário
             desconto = gerar_desconto_automatico(frota_registro)
             if desconto:
@@ -464,7 +1693,6 @@ def novo_frota():
             else:
                 frota_registro.status = 'conforme'
             
-            db.session.add(frota_registro)
             db.session.commit()
             registrar_log(f"Criou novo registro de frota para o veículo {frota_registro.veiculo}")
             
@@ -532,36 +1760,112 @@ def excluir_frota(id):
     
     return redirect(url_for('frota'))
 
+def consultar_analise_frota(data_inicio, data_fim, sessao):
+    """Totaliza o resumo diário do período por veículo e por motorista."""
+    totais = [
+        db.func.sum(ResumoDiarioFrota.viagens).label('viagens'),
+        db.func.sum(ResumoDiarioFrota.viagens_extraordinarias).label('viagens_extraordinarias'),
+        db.func.sum(ResumoDiarioFrota.km_rodado).label('km_rodado'),
+        db.func.sum(ResumoDiarioFrota.minutos_fora).label('minutos_fora'),
+        db.func.sum(ResumoDiarioFrota.descontos_gerados).label('descontos_gerados'),
+        db.func.sum(ResumoDiarioFrota.valor_descontos).label('valor_descontos'),
+    ]
+    periodo = (ResumoDiarioFrota.data >= data_inicio, ResumoDiarioFrota.data <= data_fim)
+
+    por_veiculo = sessao.query(Veiculo.placa.label('veiculo'), *totais).join(
+        Veiculo, Veiculo.id == ResumoDiarioFrota.veiculo_id
+    ).filter(*periodo).group_by(Veiculo.id).order_by(db.desc('km_rodado')).all()
+
+    por_motorista = sessao.query(Colaborador.nome.label('motorista'), *totais).join(
+        Colaborador, Colaborador.id == ResumoDiarioFrota.motorista_id
+    ).filter(*periodo).group_by(Colaborador.id).order_by(db.desc('km_rodado')).all()
+
+    return {
+        'data_inicio': data_inicio.isoformat(),
+        'data_fim': data_fim.isoformat(),
+        'por_veiculo': [linha._asdict() for linha in por_veiculo],
+        'por_motorista': [linha._asdict() for linha in por_motorista],
+    }
+
+def periodo_analise():
+    """Período dos filtros da análise (padrão: últimos 30 dias)."""
+    data_fim = request.args.get('data_fim')
+    data_inicio = request.args.get('data_inicio')
+    data_fim = datetime.strptime(data_fim, '%Y-%m-%d').date() if data_fim else date.today()
+    data_inicio = datetime.strptime(data_inicio, '%Y-%m-%d').date() if data_inicio else data_fim - timedelta(days=30)
+    return data_inicio, data_fim
+
+@app.route('/frota/analise')
+@login_required
+@cache_condicional('resumo_diario_frota', 'veiculo', 'colaborador', relatorio=True)
+def analise_frota():
+    try:
+        analise = consultar_analise_frota(*periodo_analise(), sessao_relatorios())
+    except ValueError:
+        flash('Período inválido.', 'error')
+        return redirect(url_for('analise_frota'))
+    return render_template('frota_analise.html', analise=analise)
+
+@app.route('/api/frota/analise')
+@login_required
+@cache_condicional('resumo_diario_frota', 'veiculo', 'colaborador', relatorio=True)
+def api_analise_frota():
+    try:
+        return jsonify(consultar_analise_frota(*periodo_analise(), sessao_relatorios()))
+    except ValueError:
+        return jsonify({'erro': 'Período inválido.'}), 400
+
+@app.route('/frota/anomalias')
+@login_required
+@cache_condicional('anomalia_frota', 'frota', 'colaborador')
+def anomalias_frota():
+    tipo = request.args.get('tipo')
+    query = AnomaliaFrota.query.order_by(AnomaliaFrota.detectado_em.desc(), AnomaliaFrota.id.desc())
+    if tipo and tipo != 'all':
+        query = query.filter_by(tipo=tipo)
+    anomalias = query.limit(500).all()
+    return render_template('frota_anomalias.html', anomalias=anomalias, tipos=TIPOS_ANOMALIA, selected_tipo=tipo)
+
+@app.route('/frota/anomalias/varrer')
+@login_required
+def varrer_anomalias():
+    completa = request.args.get('modo') == 'completo'
+    try:
+        total = varrer_anomalias_frota(incremental=not completa)
+        registrar_log(f"Executou varredura {'completa' if completa else 'incremental'} de anomalias da frota",
+                      f"{total} anomalias registradas")
+        flash(f'Varredura concluída. {total} anomalias registradas.', 'success')
+    except Exception as e:
+        db.session.rollback()
+        flash(f'Erro na varredura de anomalias: {str(e)}', 'error')
+    return redirect(url_for('anomalias_frota'))
+
 # Rotas de Descontos
 @app.route('/descontos', methods=['GET'])
 @login_required
+@cache_condicional('desconto', 'colaborador')
 def descontos():
-    query = Desconto.query.order_by(Desconto.data.desc())
-    colaboradores = Colaborador.query.all()
+    colaboradores = Colaborador.query.filter(Colaborador.arquivado_em.is_(None)).all()
     
     # Filtros
     colaborador_id = request.args.get('colaborador_id')
     status = request.args.get('status')
     data_inicio = request.args.get('data_inicio')
     data_fim = request.args.get('data_fim')
-
-    if colaborador_id and colaborador_id != 'all':
-        query = query.filter_by(colaborador_id=int(colaborador_id))
-    
-    if status and status != 'all':
-        query = query.filter_by(status=status)
-
-    if data_inicio:
-        query = query.filter(Desconto.data >= datetime.strptime(data_inicio, '%Y-%m-%d').date())
-
-    if data_fim:
-        query = query.filter(Desconto.data <= datetime.strptime(data_fim, '%Y-%m-%d').date())
-    
-    descontos = query.all()
+    pagina = max(1, request.args.get('pagina', 1, type=int))
+
+    descontos, tem_proxima = separar_pagina(consulta_descontos(
+        colaborador_id=int(colaborador_id) if colaborador_id and colaborador_id != 'all' else None,
+        status=status if status and status != 'all' else None,
+        data_inicio=datetime.strptime(data_inicio, '%Y-%m-%d').date() if data_inicio else None,
+        data_fim=datetime.strptime(data_fim, '%Y-%m-%d').date() if data_fim else None,
+        pagina=pagina,
+    ).all())
     
     return render_template('descontos.html', descontos=descontos, colaboradores=colaboradores,
                            selected_colaborador_id=colaborador_id, selected_status=status,
-                           selected_data_inicio=data_inicio, selected_data_fim=data_fim)
+                           selected_data_inicio=data_inicio, selected_data_fim=data_fim,
+                           pagina=pagina, tem_proxima=tem_proxima)
 
 @app.route('/desconto/novo', methods=['GET', 'POST'])
 @login_required
@@ -715,6 +2019,7 @@ def novo_usuario():
             nome = request.form['nome']
             email = request.form['email']
             ativo = 'ativo' in request.form
+            filial = request.form.get('filial') or app.config['FILIAL_PADRAO']
             
             password_hash = generate_password_hash(password)
             
@@ -723,7 +2028,8 @@ def novo_usuario():
                 password_hash=password_hash,
                 nome=nome,
                 email=email,
-                ativo=ativo
+                ativo=ativo,
+                filial=filial if filial in app.config['FILIAIS'] else app.config['FILIAL_PADRAO']
             )
             db.session.add(novo_usuario)
             db.session.commit()
@@ -751,6 +2057,8 @@ def editar_usuario(id):
             usuario.nome = request.form['nome']
             usuario.email = request.form['email']
             usuario.ativo = 'ativo' in request.form
+            if request.form.get('filial') in app.config['FILIAIS']:
+                usuario.filial = request.form['filial']
             
             nova_senha = request.form.get('password')
             if nova_senha:
@@ -792,6 +2100,220 @@ def excluir_usuario(id):
     return redirect(url_for('usuarios'))
 
 # Rotas de Importação
+# A leitura e validação das planilhas (pandas) fica no módulo planilhas, importado sob demanda
+TIPOS_PLANILHA = ('colaboradores', 'pontos', 'frota')
+EXTENSOES_IMPORTACAO = ('.xlsx', '.csv', '.parquet')
+
+def _adicionar_erro(erros, indice, coluna, motivo):
+    erros.setdefault(indice, []).append((coluna, motivo))
+
+# Arquivo-fonte de dados (AFD) dos relógios de ponto (REP), Portarias 1510/2009 e 671/2021
+EXTENSOES_AFD = ('.txt', '.afd')
+
+def normalizar_documento(valor):
+    """Só os dígitos significativos de um PIS/CPF ('012.345...' e '12345...' coincidem)."""
+    return re.sub(r'\D', '', valor or '').lstrip('0') or None
+
+def buscar_colaboradores_por_documento():
+    """Mapeia PIS e CPF (normalizados) -> id do colaborador."""
+    documentos = {}
+    for colaborador_id, cpf, pis in db.session.query(Colaborador.id, Colaborador.cpf, Colaborador.pis):
+        for documento in (cpf, pis):
+            if normalizar_documento(documento):
+                documentos[normalizar_documento(documento)] = colaborador_id
+    return documentos
+
+def ler_registros_afd(linhas):
+    """Lê o AFD linha a linha, sem carregá-lo inteiro.
+
+    Gera ('rep', numero_fabricacao) para o cabeçalho e
+    ('marcacao', numero_linha, nsr, data_hora, documento) para cada marcação
+    (registros tipo 3 e 7); linhas ilegíveis geram ('erro', numero_linha, motivo).
+    Os demais tipos de registro são ignorados.
+    """
+    for numero, linha in enumerate(linhas, start=1):
+        linha = linha.decode('latin-1') if isinstance(linha, bytes) else linha
+        linha = linha.rstrip('\r\n')
+        if len(linha) < 10:
+            continue
+        tipo = linha[9]
+        if tipo == '1':
+            # O cabeçalho da Portaria 671 é mais longo e desloca o número de fabricação do REP
+            yield ('rep', (linha[189:206] if len(linha) > 232 else linha[187:204]).strip())
+        elif tipo in ('3', '7'):  # 7: marcação de REP-P, mesmo início de linha do tipo 3 da Portaria 671
+            try:
+                # Fatiamento em vez de strptime: é o trecho mais repetido da importação
+                nsr = int(linha[:9])
+                if linha[14:15] == '-':  # Portaria 671: AAAA-MM-DDThh:mm:00-0300 seguido do CPF
+                    data_hora = datetime(int(linha[10:14]), int(linha[15:17]), int(linha[18:20]),
+                                         int(linha[21:23]), int(linha[24:26]))
+                    documento = linha[34:46]
+                else:  # Portaria 1510: DDMMAAAA hhmm seguido do PIS
+                    data_hora = datetime(int(linha[14:18]), int(linha[12:14]), int(linha[10:12]),
+                                         int(linha[18:20]), int(linha[20:22]))
+                    documento = linha[22:34]
+            except ValueError:
+                yield ('erro', numero, 'Marcação com NSR ou data/hora inválida.')
+                continue
+            yield ('marcacao', numero, nsr, data_hora, documento)
+
+def _marcacoes_no_banco(marcacoes):
+    """Quantas marcações cada (colaborador, dia) do lote já tem no banco."""
+    colaboradores = {colaborador_id for colaborador_id, _ in marcacoes}
+    datas = [data for _, data in marcacoes]
+    dia = db.func.date(Ponto.data_hora)
+    linhas = db.session.query(Ponto.colaborador_id, dia, db.func.count()).filter(
+        Ponto.colaborador_id.in_(colaboradores),
+        Ponto.data_hora >= intervalo_do_dia(min(datas))[0],
+        Ponto.data_hora <= intervalo_do_dia(max(datas))[1]
+    ).group_by(Ponto.colaborador_id, dia)
+    quantidades = {(colaborador_id, date.fromisoformat(data)): total for colaborador_id, data, total in linhas}
+    return {chave: quantidades.get(chave, 0) for chave in marcacoes}
+
+def _gravar_lote_afd(lote, rep, marcacoes_por_dia):
+    """Define entrada/saída pela alternância do dia e insere o lote em uma única instrução."""
+    novas = {(colaborador_id, data_hora.date()) for _, colaborador_id, data_hora in lote} - marcacoes_por_dia.keys()
+    if novas:
+        marcacoes_por_dia.update(_marcacoes_no_banco(novas))
+    linhas = []
+    for nsr, colaborador_id, data_hora in lote:
+        chave = (colaborador_id, data_hora.date())
+        linhas.append({'colaborador_id': colaborador_id, 'data_hora': data_hora, 'rep': rep, 'nsr': nsr,
+                       'tipo': 'entrada' if marcacoes_por_dia[chave] % 2 == 0 else 'saida',
+                       'observacao': '', 'extraordinario': False, 'criado_em': datetime.utcnow()})
+        marcacoes_por_dia[chave] += 1
+    # O índice único (rep, nsr) descarta o que outra importação já gravou; pela tabela
+    # (e não pelo modelo) a execução em lote informa quantas linhas entraram
+    resultado = db.session.execute(
+        sqlite_insert(Ponto.__table__).on_conflict_do_nothing(index_elements=['rep', 'nsr'], index_where=db.text('nsr IS NOT NULL')),
+        linhas
+    )
+    if resultado.rowcount:
+        # Instrução sobre a tabela não passa pelo versionamento das escritas em massa do ORM
+        incrementar_versao_tabelas(['ponto'], db.session.connection())
+    return resultado.rowcount
+
+def _nsrs_importados(rep, lote):
+    """NSRs do lote que já estão no banco (uma busca por faixa no índice único)."""
+    nsrs = [nsr for nsr, _, _ in lote]
+    return {nsr for (nsr,) in db.session.query(Ponto.nsr).filter(
+        Ponto.rep == rep, Ponto.nsr.isnot(None), Ponto.nsr.between(min(nsrs), max(nsrs)))}
+
+def importar_afd(linhas, relatorio, simular=False, tamanho_lote=None):
+    """Importa as marcações de um AFD em lotes.
+
+    Marcações cujo NSR já está gravado para o mesmo REP são puladas (e contadas
+    em `relatorio.ignorados`), de modo que um acumulado do mês pode ser
+    reenviado. Cada lote é gravado e confirmado junto com seus erros no relatório.
+    """
+    tamanho_lote = tamanho_lote or app.config['IMPORT_CHUNK_SIZE']
+    documentos = buscar_colaboradores_por_documento()
+    colaborador_do_campo = {}  # o mesmo PIS/CPF se repete a cada marcação: normaliza uma vez só
+    rep = ''
+    marcacoes_por_dia = {}
+    lote, erros = [], {}
+    lidas = 0
+
+    def fechar_lote():
+        nonlocal lidas
+        relatorio.total_linhas += lidas
+        lidas = 0
+        if lote:
+            importados = _nsrs_importados(rep, lote)
+            novas = [marcacao for marcacao in lote if marcacao[0] not in importados]
+            relatorio.ignorados += len(lote) - len(novas)
+            if simular:
+                relatorio.adicionados += len(novas)
+            elif novas:
+                relatorio.adicionados += _gravar_lote_afd(novas, rep, marcacoes_por_dia)
+        gravar_erros_importacao(relatorio, erros, 0)
+        relatorio.linhas_com_erro += len(erros)
+        db.session.commit()
+        lote.clear()
+        erros.clear()
+
+    for registro in ler_registros_afd(linhas):
+        if registro[0] == 'rep':
+            fechar_lote()
+            rep = registro[1]
+            continue
+        lidas += 1
+        if registro[0] == 'erro':
+            _adicionar_erro(erros, registro[1], 'REGISTRO', registro[2])
+            continue
+        _, numero, nsr, data_hora, documento = registro
+        if documento not in colaborador_do_campo:
+            colaborador_do_campo[documento] = documentos.get(normalizar_documento(documento))
+        colaborador_id = colaborador_do_campo[documento]
+        if colaborador_id is None:
+            _adicionar_erro(erros, numero, 'PIS/CPF', f'Colaborador com PIS/CPF {documento.strip()} não encontrado.')
+            continue
+        lote.append((nsr, colaborador_id, data_hora))
+        if len(lote) >= tamanho_lote:
+            fechar_lote()
+    fechar_lote()
+
+def resumo_arquivo(fluxo):
+    """SHA-256 do conteúdo do arquivo, lido em blocos; o fluxo volta ao início."""
+    resumo = hashlib.sha256()
+    for bloco in iter(lambda: fluxo.read(1 << 20), b''):
+        resumo.update(bloco)
+    fluxo.seek(0)
+    return resumo.hexdigest()
+
+def importacao_anterior(tipo, digest):
+    """Importação completa (sem erros) do mesmo arquivo na filial corrente, se houver."""
+    return RelatorioImportacao.query.filter_by(
+        digest=digest, tipo=tipo, filial=filial_atual(), simulacao=False, linhas_com_erro=0).order_by(
+        RelatorioImportacao.id.desc()).first()
+
+def concluir_importacao(relatorio, digest):
+    """Registra o digest do arquivo: reenvios idênticos passam a ser recusados sem leitura.
+
+    Só importações sem nenhuma linha com erro recebem o digest. Importações
+    interrompidas ou parciais (ex.: matrícula ainda não cadastrada) podem ser
+    reenviadas depois de corrigido o cadastro; as linhas já gravadas são
+    puladas pela chave de cada uma.
+    """
+    if not relatorio.simulacao and relatorio.linhas_com_erro == 0:
+        relatorio.digest = digest
+        db.session.commit()
+
+@app.cli.command('importar-afd')
+@click.argument('arquivo', type=click.Path(exists=True, dir_okay=False))
+@click.option('--filial', default=None, help='Código da filial (padrão: a primeira).')
+@click.option('--simular', is_flag=True, help='Apenas valida o arquivo.')
+def importar_afd_comando(arquivo, filial, simular):
+    """Importa as marcações de um AFD do disco (ex.: coleta agendada dos relógios)."""
+    if filial is not None and filial not in app.config['FILIAIS']:
+        raise click.BadParameter(f'filial desconhecida: {filial}', param_hint='--filial')
+    inicializar_banco()
+    with contexto_filial(filial or app.config['FILIAL_PADRAO']), open(arquivo, 'rb') as linhas:
+        digest = resumo_arquivo(linhas)
+        anterior = importacao_anterior('afd', digest)
+        if anterior:
+            click.echo(f'Arquivo já importado em {anterior.criado_em:%d/%m/%Y %H:%M} (relatório {anterior.id}); nada a fazer.')
+            return
+        relatorio = RelatorioImportacao(tipo='afd', filial=filial_atual(), arquivo=os.path.basename(arquivo),
+                                        simulacao=simular, total_linhas=0, linhas_com_erro=0, adicionados=0, ignorados=0)
+        db.session.add(relatorio)
+        db.session.flush()
+        importar_afd(linhas, relatorio, simular)
+        concluir_importacao(relatorio, digest)
+        click.echo(f'{relatorio.total_linhas} marcações lidas, {relatorio.adicionados} adicionadas, '
+                   f'{relatorio.ignorados} já importadas, {relatorio.linhas_com_erro} com erro (relatório {relatorio.id}).')
+
+def gravar_erros_importacao(relatorio, erros, deslocamento):
+    """Grava os erros {índice: [(coluna, motivo)]} do bloco; linha = índice + deslocamento."""
+    # Os erros ficam no banco, não na sessão (cookie) do usuário
+    linhas_erro = [
+        {'relatorio_id': relatorio.id, 'linha': indice + deslocamento, 'coluna': coluna, 'motivo': motivo}
+        for indice, problemas in sorted(erros.items())
+        for coluna, motivo in problemas
+    ]
+    if linhas_erro:
+        db.session.execute(db.insert(ErroImportacao), linhas_erro)
+
 @app.route('/importar', methods=['GET', 'POST'])
 @login_required
 def importar():
@@ -811,111 +2333,88 @@ def importar():
             flash('Nenhum arquivo selecionado.', 'error')
             return redirect(request.url)
 
-        if file and file.filename.endswith('.xlsx'):
+        if tipo not in TIPOS_PLANILHA and tipo != 'afd':
+            flash('Tipo de importação inválido!', 'error')
+            return redirect(request.url)
+
+        if file and file.filename.lower().endswith(EXTENSOES_AFD if tipo == 'afd' else EXTENSOES_IMPORTACAO):
+            simular = 'simular' in request.form
+            digest = resumo_arquivo(file.stream)
+            anterior = importacao_anterior(tipo, digest)
+            if anterior:
+                flash(f'Este arquivo já foi importado em {anterior.criado_em:%d/%m/%Y %H:%M} '
+                      f'({anterior.adicionados} registros adicionados). Nenhum dado foi gravado.', 'error')
+                return render_template('importar.html', relatorio=anterior)
+            relatorio = RelatorioImportacao(
+                usuario_id=current_user.id,
+                tipo=tipo,
+                filial=filial_atual(),
+                arquivo=file.filename,
+                simulacao=simular,
+                total_linhas=0,
+                linhas_com_erro=0,
+                adicionados=0,
+                ignorados=0
+            )
             try:
-                df = pd.read_excel(file)
-                df = df.fillna('')
-                if tipo == 'colaboradores':
-                    colaboradores_adicionados = 0
-                    for index, row in df.iterrows():
-                        try:
-                            # Converte '1' para True e '0' para False
-                            ativo = str(row.get('ATIVO', '')).strip() == '1'
-                            
-                            # Tenta converter as datas, tratando células vazias
-                            vencimento_cnh_str = str(row.get('VENCIMENTO CNH', '')).strip()
-                            vencimento_cnh = pd.to_datetime(vencimento_cnh_str).date() if vencimento_cnh_str else None
-                            
-                            ultima_consulta_str = str(row.get('ULTIMA CONSULTA', '')).strip()
-                            ultima_consulta = pd.to_datetime(ultima_consulta_str).date() if ultima_consulta_str else None
-
-                            colaborador_existente = Colaborador.query.filter_by(matricula=str(row['MATRÍCULA'])).first()
-                            if colaborador_existente:
-                                flash(f"Erro na linha {index + 2}: Colaborador com matrícula {row['MATRÍCULA']} já existe. Registro ignorado.", 'error')
-                                continue
-                            
-                            colaborador = Colaborador(
-                                nome=row['NOME COMPLETO'],
-                                matricula=row['MATRÍCULA'],
-                                cpf=row['CPF'],
-                                telefone=row['TELEFONE'],
-                                email=row['EMAIL'],
-                                veiculo_vinculado=row['VEÍCULO VINCULADO'],
-                                ativo=ativo,
-                                vencimento_cnh=vencimento_cnh,
-                                ultima_consulta=ultima_consulta
-                            )
-                            db.session.add(colaborador)
-                            colaboradores_adicionados += 1
-                        except Exception as e:
-                            flash(f"Erro na linha {index + 2}: {e}. Registro ignorado.", 'error')
-                    db.session.commit()
-                    registrar_log(f"Importou {colaboradores_adicionados} colaboradores via Excel")
-                    flash(f"Importação de colaboradores concluída. {colaboradores_adicionados} registros adicionados.", 'success')
-
-                elif tipo == 'pontos':
-                    pontos_adicionados = 0
-                    for index, row in df.iterrows():
-                        colaborador = Colaborador.query.filter_by(matricula=str(row['MATRÍCULA DO COLABORADOR'])).first()
-                        if colaborador:
-                            try:
-                                data_hora = datetime.strptime(str(row['DATA E HORA']), '%Y-%m-%d %H:%M:%S')
-                                ponto = Ponto(
-                                    colaborador_id=colaborador.id,
-                                    data_hora=data_hora,
-                                    tipo=row['TIPO (entrada ou saida)'],
-                                    observacao=row['OBSERVACAO'],
-                                    extraordinario=bool(row['EXTRAORDINÁRIO'])
-                                )
-                                db.session.add(ponto)
-                                pontos_adicionados += 1
-                            except Exception as e:
-                                flash(f"Erro na linha {index + 2}: {e}", 'error')
-                        else:
-                            flash(f"Erro na linha {index + 2}: Colaborador com matrícula {row['MATRÍCULA DO COLABORADOR']} não encontrado.", 'error')
-                    db.session.commit()
-                    registrar_log(f"Importou {pontos_adicionados} pontos via Excel")
-                    flash(f"Importação de pontos concluída. {pontos_adicionados} registros adicionados.", 'success')
-
-                elif tipo == 'frota':
-                    frotas_adicionadas = 0
-                    for index, row in df.iterrows():
-                        motorista = Colaborador.query.filter_by(matricula=str(row['MATRÍCULA DO MOTORISTA'])).first()
-                        if motorista:
-                            try:
-                                frota_data = datetime.strptime(str(row['DATA']), '%Y-%m-%d %H:%M:%S').date()
-                                frota_registro = Frota(
-                                    data=frota_data,
-                                    veiculo=row['VEÍCULO'],
-                                    motorista_id=motorista.id,
-                                    hora_saida=datetime.strptime(str(row['HORA SAÍDA']), '%H:%M:%S').time() if row['HORA SAÍDA'] else None,
-                                    hora_retorno=datetime.strptime(str(row['HORA RETORNO']), '%H:%M:%S').time() if row['HORA RETORNO'] else None,
-                                    km_inicial=float(row['KM INICIAL']) if row['KM INICIAL'] else None,
-                                    km_final=float(row['KM FINAL']) if row['KM FINAL'] else None,
-                                    observacao=row['OBSERVACAO']
-                                )
-                                # Reavalia status e gera desconto se necessário
-                                desconto = gerar_desconto_automatico(frota_registro)
-                                if desconto:
-                                    frota_registro.status = 'extraordinaria'
-                                else:
-                                    frota_registro.status = 'conforme'
-                                
-                                db.session.add(frota_registro)
-                                frotas_adicionadas += 1
-                            except Exception as e:
-                                flash(f"Erro na linha {index + 2}: {e}", 'error')
-                        else:
-                            flash(f"Erro na linha {index + 2}: Motorista com matrícula {row['MATRÍCULA DO MOTORISTA']} não encontrado.", 'error')
-                    db.session.commit()
-                    registrar_log(f"Importou {frotas_adicionadas} registros de frota via Excel")
-                    flash(f"Importação de frota concluída. {frotas_adicionadas} registros adicionados.", 'success')
+                db.session.add(relatorio)
+                db.session.flush()
+                if tipo == 'afd':
+                    # Lido direto do upload, linha a linha: arquivos de milhões de marcações
+                    importar_afd(file.stream, relatorio, simular)
+                else:
+                    import planilhas
+                    planilhas.importar_planilha(file, tipo, relatorio, simular)
+                concluir_importacao(relatorio, digest)
+
+                if relatorio.ignorados:
+                    flash(f'{relatorio.ignorados} registros repetidos ou já importados anteriormente foram ignorados.', 'success')
+                if simular:
+                    flash(f"Simulação de importação de {tipo} concluída: {relatorio.adicionados} registros válidos, "
+                          f"{relatorio.linhas_com_erro} linhas com erro. Nenhum dado foi gravado.",
+                          'success' if not relatorio.linhas_com_erro else 'error')
+                else:
+                    registrar_log(f"Importou {relatorio.adicionados} registros de {tipo} via arquivo",
+                                  f"Arquivo: {file.filename}; linhas com erro: {relatorio.linhas_com_erro}")
+                    flash(f"Importação de {tipo} concluída. {relatorio.adicionados} registros adicionados, "
+                          f"{relatorio.linhas_com_erro} linhas com erro.",
+                          'success' if not relatorio.linhas_com_erro else 'error')
+                return render_template('importar.html', relatorio=relatorio)
 
             except Exception as e:
                 db.session.rollback()
                 flash(f'Erro ao processar o arquivo: {str(e)}', 'error')
+        else:
+            flash('Formato de arquivo não suportado. Use .txt (AFD).' if tipo == 'afd' else
+                  'Formato de arquivo não suportado. Use .xlsx, .csv ou .parquet.', 'error')
+
+    return render_template('importar.html', relatorio=None)
+
+
+@app.route('/importar/relatorio/<int:id>/<formato>')
+@login_required
+def download_relatorio_importacao(id, formato):
+    if not is_admin():
+        flash('Acesso negado.', 'error')
+        return redirect(url_for('index'))
 
-    return render_template('importar.html')
+    relatorio = RelatorioImportacao.query.get_or_404(id)
+    if formato not in ('csv', 'xlsx'):
+        flash('Formato de relatório inválido!', 'error')
+        return redirect(url_for('importar'))
+
+    erros = db.session.query(ErroImportacao.linha, ErroImportacao.coluna, ErroImportacao.motivo).filter_by(
+        relatorio_id=relatorio.id).order_by(ErroImportacao.linha, ErroImportacao.id).all()
+    import planilhas
+    conteudo = planilhas.relatorio_erros_importacao(erros, formato)
+    mimetype = 'text/csv' if formato == 'csv' else 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+
+    return send_file(
+        io.BytesIO(conteudo),
+        mimetype=mimetype,
+        as_attachment=True,
+        download_name=f'relatorio_importacao_{relatorio.id}.{formato}'
+    )
 
 
 @app.route('/download/template/<tipo>')
@@ -925,33 +2424,16 @@ def download_template(tipo):
         flash('Acesso negado.', 'error')
         return redirect(url_for('index'))
 
-    output = io.BytesIO()
-
-    if tipo == 'colaboradores':
-        template_columns = ['NOME COMPLETO', 'MATRÍCULA', 'CPF', 'TELEFONE', 'EMAIL', 'VEÍCULO VINCULADO', 'ATIVO', 'VENCIMENTO CNH', 'ULTIMA CONSULTA']
-        df = pd.DataFrame(columns=template_columns)
-        filename = 'template_colaboradores.xlsx'
-    elif tipo == 'pontos':
-        template_columns = ['MATRÍCULA DO COLABORADOR', 'DATA E HORA', 'TIPO (entrada ou saida)', 'OBSERVACAO', 'EXTRAORDINÁRIO']
-        df = pd.DataFrame(columns=template_columns)
-        filename = 'template_pontos.xlsx'
-    elif tipo == 'frota':
-        template_columns = ['DATA', 'VEÍCULO', 'MATRÍCULA DO MOTORISTA', 'HORA SAÍDA', 'HORA RETORNO', 'KM INICIAL', 'KM FINAL', 'OBSERVACAO']
-        df = pd.DataFrame(columns=template_columns)
-        filename = 'template_frota.xlsx'
-    else:
+    if tipo not in TIPOS_PLANILHA:
         flash('Tipo de template inválido!', 'error')
         return redirect(url_for('importar'))
 
-    with pd.ExcelWriter(output, engine='openpyxl') as writer:
-        df.to_excel(writer, sheet_name='Modelo', index=False)
-    output.seek(0)
-
+    import planilhas
     return send_file(
-        output,
+        io.BytesIO(planilhas.modelo_importacao(tipo)),
         mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
         as_attachment=True,
-        download_name=filename
+        download_name=f'template_{tipo}.xlsx'
     )
 
 
@@ -959,27 +2441,17 @@ def download_template(tipo):
 @app.route('/habilitados', methods=['GET'])
 @login_required
 def habilitados():
-    query = Colaborador.query.filter_by(ativo=True).order_by(Colaborador.nome.asc())
-    
     # Filtros
     nome = request.args.get('nome')
     matricula = request.args.get('matricula')
     
-    if nome:
-        query = query.filter(Colaborador.nome.ilike(f'%{nome}%'))
-    
-    if matricula:
-        query = query.filter(Colaborador.matricula.ilike(f'%{matricula}%'))
-    
-    colaboradores = query.all()
-    
-    # Apenas colaboradores com CNH válida e consulta recente
-    data_limite_consulta = date.today() - timedelta(days=180)
-    data_vencimento_proximo = date.today() + timedelta(days=30)
-
-    habilitados_em_dia = [c for c in colaboradores if c.vencimento_cnh and c.vencimento_cnh > data_vencimento_proximo and c.ultima_consulta and c.ultima_consulta >= data_limite_consulta]
+    colaboradores = consulta_habilitados(nome, matricula).all()
     
-    cnh_atencao = [c for c in colaboradores if c not in habilitados_em_dia]
+    # Situação calculada na hora, pela data do dia
+    data_vencimento_proximo = date.today() + timedelta(days=CNH_DIAS_AVISO_VENCIMENTO)
+    situacoes = {c.id: calcular_situacao_cnh(c.vencimento_cnh, c.ultima_consulta) for c in colaboradores}
+    habilitados_em_dia = [c for c in colaboradores if situacoes[c.id] == 'em_dia']
+    cnh_atencao = [c for c in colaboradores if situacoes[c.id] != 'em_dia']
     
     return render_template('habilitados.html', habilitados_em_dia=habilitados_em_dia, cnh_atencao=cnh_atencao,
                            selected_nome=nome, selected_matricula=matricula, now=date.today(), data_vencimento_proximo=data_vencimento_proximo)
@@ -1002,89 +2474,598 @@ def confirmar_consulta_cnh(id):
 
 
 # Exportar dados
+TABELAS_EXPORTACAO = {
+    'colaboradores': ('colaborador',),
+    'pontos': ('ponto', 'colaborador'),
+    'frota': ('frota', 'colaborador'),
+    'descontos': ('desconto', 'colaborador'),
+}
+
+def chave_cache_exportacao(tipo, parametros, assinatura):
+    """Chave do cache: tipo, parâmetros de filtro e versão das tabelas."""
+    filtros = '&'.join(f"{k}={v}" for k, v in sorted(parametros.items(multi=True)))
+    return hashlib.sha256(f"{tipo}|{filtros}|{assinatura}".encode('utf-8')).hexdigest()
+
+def obter_arquivo_cache(chave):
+    """Retorna o caminho do arquivo em cache (marcando o uso) ou None."""
+    caminho = os.path.join(app.config['EXPORT_CACHE_DIR'], f'{chave}.xlsx')
+    try:
+        os.utime(caminho)
+    except FileNotFoundError:
+        return None
+    return caminho
+
+def salvar_arquivo_cache(chave, conteudo):
+    """Grava o arquivo no cache e aplica o limite de tamanho (LRU)."""
+    diretorio = app.config['EXPORT_CACHE_DIR']
+    os.makedirs(diretorio, exist_ok=True)
+    caminho = os.path.join(diretorio, f'{chave}.xlsx')
+    temporario = f'{caminho}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with open(temporario, 'wb') as arquivo:
+        arquivo.write(conteudo)
+    os.replace(temporario, caminho)
+    limitar_cache_exportacao()
+    return caminho
+
+def limitar_cache_exportacao():
+    """Remove os arquivos usados há mais tempo até o cache caber no limite."""
+    diretorio = app.config['EXPORT_CACHE_DIR']
+    arquivos = []
+    for entrada in os.scandir(diretorio):
+        if entrada.is_file() and entrada.name.endswith('.xlsx'):
+            info = entrada.stat()
+            arquivos.append((info.st_mtime, info.st_size, entrada.path))
+    total = sum(tamanho for _, tamanho, _ in arquivos)
+    for _, tamanho, caminho in sorted(arquivos):
+        if total <= app.config['EXPORT_CACHE_MAX_BYTES']:
+            break
+        try:
+            os.remove(caminho)
+        except FileNotFoundError:
+            pass
+        total -= tamanho
+
 @app.route('/exportar/<tipo>')
 @login_required
+@cache_condicional(por_tipo=TABELAS_EXPORTACAO, relatorio=True, consolidado=True)
 def exportar(tipo):
+    if tipo not in TABELAS_EXPORTACAO:
+        flash('Tipo de exportação inválido!', 'error')
+        return redirect(url_for('index'))
+
     try:
-        if tipo == 'colaboradores':
-            data = Colaborador.query.all()
-            df = pd.DataFrame([{
-                'ID': c.id,
-                'Nome': c.nome,
-                'Matrícula': c.matricula,
-                'CPF': c.cpf,
-                'Telefone': c.telefone,
-                'Email': c.email,
-                'Veículo': c.veiculo_vinculado,
-                'Ativo': 'Sim' if c.ativo else 'Não',
-                'Vencimento CNH': c.vencimento_cnh,
-                'Última Consulta CNH': c.ultima_consulta
-            } for c in data])
-            filename = 'colaboradores.xlsx'
-            
-        elif tipo == 'pontos':
-            data = Ponto.query.all()
-            df = pd.DataFrame([{
-                'ID': p.id,
-                'Colaborador': p.colaborador.nome if p.colaborador else '',
-                'Data/Hora': p.data_hora.strftime('%d/%m/%Y %H:%M'),
-                'Tipo': p.tipo,
-                'Extraordinário': 'Sim' if p.extraordinario else 'Não',
-                'Observação': p.observacao
-            } for p in data])
-            filename = 'pontos.xlsx'
-            
-        elif tipo == 'frota':
-            data = Frota.query.all()
-            df = pd.DataFrame([{
-                'ID': f.id,
-                'Data': f.data.strftime('%d/%m/%Y'),
-                'Veículo': f.veiculo,
-                'Motorista': f.motorista_obj.nome if f.motorista_obj else '',
-                'Hora Saída': f.hora_saida.strftime('%H:%M') if f.hora_saida else '',
-                'Hora Retorno': f.hora_retorno.strftime('%H:%M') if f.hora_retorno else '',
-                'KM Inicial': f.km_inicial,
-                'KM Final': f.km_final,
-                'KM Rodado': (f.km_final - f.km_inicial) if f.km_final and f.km_inicial else 0,
-                'Status': f.status,
-                'Observação': f.observacao
-            } for f in data])
-            filename = 'frota.xlsx'
-            
-        elif tipo == 'descontos':
-            data = Desconto.query.all()
-            df = pd.DataFrame([{
-                'ID': d.id,
-                'Colaborador': d.colaborador.nome if d.colaborador else '',
-                'Data': d.data.strftime('%d/%m/%Y'),
-                'Motivo': d.motivo,
-                'Valor': f'R$ {d.valor:.2f}',
-                'Status': d.status,
-                'Automático': 'Sim' if d.automatico else 'Não'
-            } for d in data])
-            filename = 'descontos.xlsx'
-            
-        else:
-            flash('Tipo de exportação inválido!', 'error')
-            return redirect(url_for('index'))
-        
-        # Criar arquivo Excel em memória
-        output = io.BytesIO()
-        with pd.ExcelWriter(output, engine='openpyxl') as writer:
-            df.to_excel(writer, sheet_name='Dados', index=False)
-        output.seek(0)
-        
+        # Arquivos idênticos (mesmo tipo, filtros e versão das tabelas) saem do cache
+        filiais = filiais_consolidadas()
+        assinatura, _ = obter_versoes_filiais(TABELAS_EXPORTACAO[tipo], filiais, relatorio=True)
+        chave = chave_cache_exportacao(tipo, request.args, assinatura)
+        caminho = obter_arquivo_cache(chave)
+        if caminho is None:
+            import planilhas
+            caminho = salvar_arquivo_cache(chave, planilhas.gerar_planilha_exportacao(tipo, filiais))
+
         return send_file(
-            output,
+            caminho,
             mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
             as_attachment=True,
-            download_name=filename
+            download_name=f'{tipo}.xlsx'
         )
         
     except Exception as e:
         flash(f'Erro ao exportar dados: {str(e)}', 'error')
         return redirect(url_for('index'))
 
+# Extratos mensais por colaborador
+FORMATOS_EXTRATO = {'html': 'HTML', 'xlsx': 'Excel', 'pdf': 'PDF'}
+
+# A coordenação roda fora do worker web; a renderização vai para um pool de processos
+_executor_extratos = ThreadPoolExecutor(max_workers=1, thread_name_prefix='extratos')
+
+def periodo_do_mes(mes):
+    """Primeiro e último dia do mês 'AAAA-MM'."""
+    inicio = datetime.strptime(mes, '%Y-%m').date()
+    proximo = (inicio.replace(day=28) + timedelta(days=4)).replace(day=1)
+    return inicio, proximo - timedelta(days=1)
+
+def coletar_dados_extratos(inicio, fim, sessao):
+    """Dados do período em uma consulta por tabela, separados por colaborador.
+
+    Retorna dicionários simples, que seguem serializados para os processos do pool.
+    Entram os colaboradores ativos e os que tiveram movimento no período.
+    """
+    de, ate = intervalo_do_dia(inicio)[0], intervalo_do_dia(fim)[1]
+    extratos = {
+        linha.id: {'colaborador': dict(linha._mapping), 'pontos': [], 'viagens': [], 'descontos': []}
+        for linha in sessao.execute(db.select(Colaborador.id, Colaborador.nome, Colaborador.matricula, Colaborador.ativo))
+    }
+    consultas = (
+        ('pontos', Ponto.colaborador_id, db.select(
+            Ponto.colaborador_id, Ponto.data_hora, Ponto.tipo, Ponto.extraordinario, Ponto.observacao
+        ).where(Ponto.data_hora >= de, Ponto.data_hora <= ate).order_by(Ponto.data_hora)),
+        ('viagens', Frota.motorista_id, db.select(
+            Frota.motorista_id, Frota.data, Frota.veiculo, Frota.hora_saida, Frota.hora_retorno,
+            Frota.km_inicial, Frota.km_final, Frota.status
+        ).where(Frota.data >= inicio, Frota.data <= fim).order_by(Frota.data, Frota.hora_saida)),
+        ('descontos', Desconto.colaborador_id, db.select(
+            Desconto.colaborador_id, Desconto.data, Desconto.motivo, Desconto.valor, Desconto.status, Desconto.automatico
+        ).where(Desconto.data >= inicio, Desconto.data <= fim).order_by(Desconto.data)),
+    )
+    for chave, coluna, consulta in consultas:
+        for linha in sessao.execute(consulta):
+            registro = dict(linha._mapping)
+            extratos[registro.pop(coluna.key)][chave].append(registro)
+    return [
+        extrato for extrato in extratos.values()
+        if extrato['colaborador']['ativo'] or extrato['pontos'] or extrato['viagens'] or extrato['descontos']
+    ]
+
+def totalizar_extrato(extrato):
+    """Totais do extrato: horas entre entrada e saída do mesmo dia, km e descontos."""
+    minutos, entrada = 0, None
+    for ponto in extrato['pontos']:
+        if ponto['tipo'] == 'entrada':
+            entrada = ponto['data_hora']
+        elif entrada is not None and entrada.date() == ponto['data_hora'].date():
+            minutos += (ponto['data_hora'] - entrada).total_seconds() // 60
+            entrada = None
+    validos = [d for d in extrato['descontos'] if d['status'] != 'cancelado']
+    return {
+        'marcacoes': len(extrato['pontos']),
+        'horas_trabalhadas': f'{int(minutos // 60)}:{int(minutos % 60):02d}',
+        'viagens': len(extrato['viagens']),
+        'viagens_extraordinarias': sum(1 for v in extrato['viagens'] if v['status'] == 'extraordinaria'),
+        'km_rodado': sum((v['km_final'] or 0) - (v['km_inicial'] or 0) for v in extrato['viagens']
+                         if v['km_final'] and v['km_inicial']),
+        'descontos_automaticos': sum(d['valor'] for d in validos if d['automatico']),
+        'descontos_manuais': sum(d['valor'] for d in validos if not d['automatico']),
+        'total_descontos': sum(d['valor'] for d in validos),
+    }
+
+def renderizar_extrato(extrato, formato, mes):
+    """Conteúdo (bytes) do extrato no formato pedido."""
+    totais = totalizar_extrato(extrato)
+    if formato == 'xlsx':
+        # openpyxl em modo de escrita direta: um DataFrame por aba custaria mais que o próprio conteúdo
+        from openpyxl import Workbook
+        livro = Workbook(write_only=True)
+        resumo = {'colaborador': extrato['colaborador']['nome'], 'matricula': extrato['colaborador']['matricula'],
+                  'mes': mes, **totais}
+        for aba, linhas in (('Resumo', [resumo]), ('Pontos', extrato['pontos']),
+                            ('Viagens', extrato['viagens']), ('Descontos', extrato['descontos'])):
+            planilha = livro.create_sheet(aba)
+            if linhas:
+                planilha.append(list(linhas[0]))
+            for linha in linhas:
+                planilha.append(list(linha.values()))
+        output = io.BytesIO()
+        livro.save(output)
+        return output.getvalue()
+
+    html = app.jinja_env.get_template('extrato.html').render(extrato=extrato, totais=totais, mes=mes)
+    if formato == 'pdf':
+        try:
+            from weasyprint import HTML
+        except ImportError:
+            raise ValueError('A geração de extratos em PDF requer o pacote weasyprint.')
+        return HTML(string=html).write_pdf()
+    return html.encode('utf-8')
+
+def nome_arquivo_extrato(extrato, formato):
+    nome = re.sub(r'\W+', '_', extrato['colaborador']['nome']).strip('_')
+    return f"{extrato['colaborador']['matricula']}_{nome}.{formato}"
+
+def renderizar_lote_extratos(extratos, formato, mes):
+    """Executada nos processos do pool: retorna [(nome do arquivo, conteúdo)]."""
+    return [(nome_arquivo_extrato(extrato, formato), renderizar_extrato(extrato, formato, mes)) for extrato in extratos]
+
+def gerar_extratos(mes, formato, destino, progresso=None):
+    """Gera o zip com os extratos do mês da filial corrente; retorna quantos foram gerados.
+
+    `progresso(feitos, total)` é chamado a cada lote concluído.
+    """
+    inicio, fim = periodo_do_mes(mes)
+    extratos = coletar_dados_extratos(inicio, fim, sessao_relatorios())
+    tamanho = app.config['EXTRATOS_POR_TAREFA']
+    lotes = [extratos[i:i + tamanho] for i in range(0, len(extratos), tamanho)]
+    if progresso:
+        progresso(0, len(extratos))
+
+    # HTML comprime bem; xlsx e pdf já são comprimidos
+    compressao = zipfile.ZIP_DEFLATED if formato == 'html' else zipfile.ZIP_STORED
+    temporario = f'{destino}.{os.getpid()}.tmp'
+    feitos = 0
+    # forkserver: um fork deste processo, que já roda threads (requisições, agendador, eventos),
+    # poderia herdar uma trava presa e travar o filho
+    with ProcessPoolExecutor(max_workers=app.config['EXTRATOS_PROCESSOS'],
+                             mp_context=multiprocessing.get_context('forkserver')) as pool, \
+            zipfile.ZipFile(temporario, 'w', compressao) as arquivo:
+        for futuro in as_completed([pool.submit(renderizar_lote_extratos, lote, formato, mes) for lote in lotes]):
+            renderizados = futuro.result()
+            for nome, conteudo in renderizados:
+                arquivo.writestr(nome, conteudo)
+            feitos += len(renderizados)
+            if progresso:
+                progresso(feitos, len(extratos))
+    os.replace(temporario, destino)
+    return len(extratos)
+
+def processo_ativo(identidade):
+    """Se o processo host:pid ainda existe (só verificável no mesmo host; nos outros, presume que sim)."""
+    host, _, pid = identidade.rpartition(':')
+    if host != socket.gethostname():
+        return True
+    if identidade == identidade_processo():
+        # Este processo acabou de subir: nada dele está em andamento (reinício com o mesmo pid, ex.: contêiner)
+        return False
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except (PermissionError, ValueError):
+        return True
+    return True
+
+def falhar_geracoes_interrompidas():
+    """Marca como erro as gerações cujo processo morreu (reinício ou queda): ficariam 'processando' para sempre."""
+    interrompidas = [geracao for geracao in GeracaoExtratos.query.filter(GeracaoExtratos.status.in_(('pendente', 'processando')))
+                     if not geracao.processo or not processo_ativo(geracao.processo)]
+    for geracao in interrompidas:
+        geracao.status = 'erro'
+        geracao.erro = 'Geração interrompida: o processo que a executava foi encerrado.'
+        geracao.concluido_em = datetime.utcnow()
+    db.session.commit()
+
+def caminho_extratos(geracao):
+    return os.path.join(app.config['EXTRATOS_DIR'], f'extratos_{geracao.filial}_{geracao.mes}_{geracao.id}.zip')
+
+def executar_geracao_extratos(geracao_id, filial):
+    """Tarefa em segundo plano: gera o zip e registra andamento e resultado."""
+    with contexto_filial(filial):
+        geracao = db.session.get(GeracaoExtratos, geracao_id)
+        geracao.status = 'processando'
+        db.session.commit()
+
+        def progresso(feitos, total):
+            geracao.processados, geracao.total = feitos, total
+            db.session.commit()
+
+        try:
+            os.makedirs(app.config['EXTRATOS_DIR'], exist_ok=True)
+            gerar_extratos(geracao.mes, geracao.formato, caminho_extratos(geracao), progresso)
+            geracao.status = 'concluido'
+        except Exception as e:
+            db.session.rollback()
+            geracao.status = 'erro'
+            geracao.erro = str(e)
+        geracao.concluido_em = datetime.utcnow()
+        db.session.commit()
+
+@app.route('/extratos', methods=['GET', 'POST'])
+@login_required
+def extratos():
+    if not is_admin():
+        flash('Acesso negado. Apenas administradores podem gerar extratos.', 'error')
+        return redirect(url_for('index'))
+
+    if request.method == 'POST':
+        mes = request.form.get('mes', '')
+        formato = request.form.get('formato')
+        try:
+            periodo_do_mes(mes)
+        except ValueError:
+            flash('Mês inválido.', 'error')
+            return redirect(url_for('extratos'))
+        if formato not in FORMATOS_EXTRATO:
+            flash('Formato de extrato inválido!', 'error')
+            return redirect(url_for('extratos'))
+
+        geracao = GeracaoExtratos(usuario_id=current_user.id, filial=filial_atual(), mes=mes, formato=formato,
+                                  processo=identidade_processo())
+        db.session.add(geracao)
+        db.session.commit()
+        _executor_extratos.submit(executar_geracao_extratos, geracao.id, geracao.filial)
+        registrar_log(f"Solicitou os extratos de {mes} ({FORMATOS_EXTRATO[formato]})")
+        flash('Geração de extratos iniciada. Acompanhe o andamento abaixo.', 'success')
+        return redirect(url_for('extratos'))
+
+    geracoes = GeracaoExtratos.query.filter_by(filial=filial_atual()).order_by(GeracaoExtratos.id.desc()).limit(20).all()
+    mes_anterior = (date.today().replace(day=1) - timedelta(days=1)).strftime('%Y-%m')
+    return render_template('extratos.html', geracoes=geracoes, formatos=FORMATOS_EXTRATO, mes_anterior=mes_anterior)
+
+@app.route('/extratos/<int:id>/progresso')
+@login_required
+def progresso_extratos(id):
+    if not is_admin():
+        abort(403)
+    geracao = GeracaoExtratos.query.get_or_404(id)
+    return jsonify({'status': geracao.status, 'total': geracao.total, 'processados': geracao.processados,
+                    'erro': geracao.erro})
+
+@app.route('/extratos/<int:id>/download')
+@login_required
+def download_extratos(id):
+    if not is_admin():
+        flash('Acesso negado. Apenas administradores podem gerar extratos.', 'error')
+        return redirect(url_for('index'))
+    geracao = GeracaoExtratos.query.get_or_404(id)
+    if geracao.status != 'concluido' or not os.path.exists(caminho_extratos(geracao)):
+        flash('Os extratos ainda não estão disponíveis.', 'error')
+        return redirect(url_for('extratos'))
+    return send_file(caminho_extratos(geracao), mimetype='application/zip', as_attachment=True,
+                     download_name=f'extratos_{geracao.mes}.zip')
+
+@app.cli.command('gerar-extratos')
+@click.argument('mes')
+@click.option('--formato', type=click.Choice(list(FORMATOS_EXTRATO)), default='html', show_default=True)
+@click.option('--filial', default=None, help='Código da filial (padrão: a primeira).')
+@click.option('--saida', default=None, help='Arquivo zip de destino (padrão: extratos_<mes>.zip).')
+def gerar_extratos_comando(mes, formato, filial, saida):
+    """Gera os extratos do mês (AAAA-MM) de todos os colaboradores em um zip."""
+    if filial is not None and filial not in app.config['FILIAIS']:
+        raise click.BadParameter(f'filial desconhecida: {filial}', param_hint='--filial')
+    inicializar_banco()
+    with contexto_filial(filial or app.config['FILIAL_PADRAO']):
+        total = gerar_extratos(mes, formato, os.path.abspath(saida or f'extratos_{mes}.zip'),
+                               lambda feitos, total: click.echo(f'\r{feitos}/{total} extratos', nl=False, err=True))
+    click.echo(f'\n{total} extratos gerados.')
+
+@app.route('/snapshot/atualizar')
+@login_required
+def atualizar_snapshot():
+    if not is_admin():
+        flash('Acesso negado.', 'error')
+        return redirect(url_for('index'))
+
+    try:
+        for codigo in app.config['FILIAIS']:
+            with _travas_snapshot[codigo]:
+                criar_snapshot(codigo)
+        registrar_log("Atualizou o snapshot de relatórios")
+        flash('Snapshot de relatórios atualizado com sucesso!', 'success')
+    except Exception as e:
+        flash(f'Erro ao atualizar o snapshot: {str(e)}', 'error')
+    return redirect(request.referrer or url_for('index'))
+
+# Feed de alterações para sincronização incremental
+def primeiro_seq_disponivel():
+    """Menor seq ainda no log de alterações da filial (com o log vazio, o próximo a ser emitido)."""
+    primeiro = db.session.query(db.func.min(RegistroAlteracao.seq)).scalar()
+    if primeiro is not None:
+        return primeiro
+    emitido = db.session.execute(db.text(
+        "SELECT seq FROM sqlite_sequence WHERE name = 'registro_alteracao'")).scalar()
+    return (emitido or 0) + 1
+
+@app.route('/changes')
+@login_required
+def alteracoes():
+    """Alterações da filial com seq maior que `since`, em páginas ordenadas por seq."""
+    # Linhas completas de colaboradores e descontos: só para o administrador (sincronização)
+    if not is_admin():
+        abort(403)
+    desde = request.args.get('since', 0, type=int)
+    limite = max(1, min(request.args.get('limit', 1000, type=int), 10000))
+    tabela = RegistroAlteracao.__table__
+    primeiro = primeiro_seq_disponivel()
+    if desde < primeiro - 1:
+        # O trecho entre `since` (inclusive 0: carga inicial) e o primeiro disponível foi expurgado.
+        # O consumidor refaz a carga completa e segue com since = primeiro_seq - 1
+        return jsonify({'erro': 'Alterações expurgadas pela retenção do log; refaça a carga completa.',
+                        'primeiro_seq': primeiro}), 410
+    consulta = db.select(tabela).where(tabela.c.seq > desde)
+    if request.args.get('tabela'):
+        consulta = consulta.where(tabela.c.tabela == request.args['tabela'])
+    # Uma linha a mais indica se há próxima página
+    linhas = db.session.execute(consulta.order_by(tabela.c.seq).limit(limite + 1)).all()
+    tem_mais = len(linhas) > limite
+    linhas = linhas[:limite]
+
+    return jsonify({
+        'filial': filial_atual(),
+        'since': desde,
+        'proximo': linhas[-1].seq if linhas else desde,
+        'tem_mais': tem_mais,
+        'alteracoes': [{
+            'seq': linha.seq,
+            'tabela': linha.tabela,
+            'id': linha.registro_id,
+            'operacao': linha.operacao,
+            'diferencas': json.loads(linha.diferencas),
+            'alterado_em': linha.alterado_em.isoformat(),
+        } for linha in linhas],
+    })
+
+# Eventos ao vivo (server-sent events) para o dashboard e as listagens
+# Uma thread por processo lê o log de alterações das filiais com telas abertas e
+# distribui eventos compactos a todas elas: N telas custam uma consulta por intervalo.
+_assinantes_eventos = {}  # fila da conexão -> filiais assinadas
+_ultimo_seq_eventos = {}  # filial -> último seq do log já publicado
+_cnh_atencao_eventos = {}  # filial -> total de CNH em atenção já publicado
+_trava_eventos = threading.Lock()
+_publicador_eventos = None
+
+def _no_dia(valor, hoje):
+    return valor is not None and str(valor)[:10] == hoje
+
+def _delta(operacao, diferencas, coluna, condicao):
+    """Quanto a linha passou a contar (+1), deixou de contar (-1) ou nada (0) para um contador."""
+    if operacao == 'insert':
+        return int(condicao(diferencas.get(coluna)))
+    if operacao == 'delete':
+        return -int(condicao(diferencas.get(coluna)))
+    if coluna not in diferencas:
+        return 0
+    antes, depois = diferencas[coluna]
+    return int(condicao(depois)) - int(condicao(antes))
+
+def eventos_das_alteracoes(linhas, variacao_cnh_atencao=0):
+    """Traduz as linhas do log de alterações da filial corrente em eventos compactos.
+
+    Gera ('contadores', deltas dos totais do dashboard), ('ponto', marcação),
+    ('ponto_removido', id), ('desconto', desconto novo ou de volta a pendente) e
+    ('status', transição de status de desconto ou viagem). Arquivar ou restaurar
+    um colaborador gera só ('recarregar', {}). O total de CNH em atenção depende
+    da data de hoje, não só das colunas alteradas: chega já recontado.
+    """
+    hoje = date.today().isoformat()
+    contadores = dict.fromkeys(('total_colaboradores', 'total_pontos_hoje', 'total_descontos_pendentes',
+                                'total_frota_hoje'), 0)
+    contadores['total_cnh_atencao'] = variacao_cnh_atencao
+    eventos, pontos, descontos = [], [], []
+    for linha in linhas:
+        diferencas = json.loads(linha.diferencas)
+        operacao = linha.operacao
+        if linha.tabela == 'colaborador' and operacao == 'update' and 'arquivado_em' in diferencas:
+            # Arquivar ou restaurar tira ou devolve todo o histórico do colaborador das telas
+            return [('recarregar', {})]
+        if linha.tabela == 'colaborador':
+            contadores['total_colaboradores'] += _delta(operacao, diferencas, 'ativo', bool)
+        elif linha.tabela == 'ponto':
+            contadores['total_pontos_hoje'] += _delta(operacao, diferencas, 'data_hora', lambda valor: _no_dia(valor, hoje))
+            if operacao == 'delete':
+                eventos.append(('ponto_removido', {'id': linha.registro_id}))
+            else:
+                pontos.append(linha.registro_id)
+        elif linha.tabela == 'frota':
+            contadores['total_frota_hoje'] += _delta(operacao, diferencas, 'data', lambda valor: _no_dia(valor, hoje))
+            if operacao == 'update' and 'status' in diferencas:
+                antes, depois = diferencas['status']
+                eventos.append(('status', {'tabela': 'frota', 'id': linha.registro_id, 'de': antes, 'para': depois}))
+        elif linha.tabela == 'desconto':
+            contadores['total_descontos_pendentes'] += _delta(operacao, diferencas, 'status',
+                                                              lambda status: status == 'pendente')
+            if operacao == 'insert' or (operacao == 'update' and diferencas.get('status', [None, None])[1] == 'pendente'):
+                descontos.append(linha.registro_id)
+            if operacao == 'update' and 'status' in diferencas:
+                antes, depois = diferencas['status']
+                eventos.append(('status', {'tabela': 'desconto', 'id': linha.registro_id, 'de': antes, 'para': depois}))
+            elif operacao == 'delete':
+                eventos.append(('status', {'tabela': 'desconto', 'id': linha.registro_id,
+                                           'de': diferencas.get('status'), 'para': None}))
+
+    # Dados atuais das marcações e descontos citados (o log só traz as colunas alteradas)
+    if pontos:
+        for ponto in Ponto.query.options(db.joinedload(Ponto.colaborador)).filter(Ponto.id.in_(pontos)):
+            eventos.append(('ponto', {
+                'id': ponto.id, 'colaborador': ponto.colaborador.nome if ponto.colaborador else '',
+                'data_hora': ponto.data_hora.isoformat(timespec='minutes'), 'tipo': ponto.tipo,
+                'extraordinario': bool(ponto.extraordinario), 'observacao': ponto.observacao or '',
+            }))
+    if descontos:
+        for desconto in Desconto.query.options(db.joinedload(Desconto.colaborador)).filter(Desconto.id.in_(descontos)):
+            eventos.append(('desconto', {
+                'id': desconto.id, 'colaborador': desconto.colaborador.nome if desconto.colaborador else '',
+                'valor': desconto.valor, 'motivo': desconto.motivo, 'data': desconto.data.isoformat(),
+                'status': desconto.status, 'automatico': bool(desconto.automatico),
+            }))
+    deltas = {chave: valor for chave, valor in contadores.items() if valor}
+    if deltas:
+        eventos.insert(0, ('contadores', deltas))
+    return eventos
+
+def _variacao_cnh_atencao(codigo):
+    """Diferença entre o total de CNH em atenção de agora e o último publicado na filial."""
+    atual = contagem_cnh_atencao().count()
+    anterior = _cnh_atencao_eventos.get(codigo, atual)
+    _cnh_atencao_eventos[codigo] = atual
+    return atual - anterior
+
+def ler_eventos_filial(codigo):
+    """Eventos das alterações da filial desde a última leitura."""
+    tabela = RegistroAlteracao.__table__
+    with contexto_filial(codigo):
+        desde = _ultimo_seq_eventos.get(codigo)
+        if desde is None:
+            # Primeira tela aberta na filial: publica só o que vier daqui em diante
+            _ultimo_seq_eventos[codigo] = db.session.query(db.func.coalesce(db.func.max(tabela.c.seq), 0)).scalar()
+            _cnh_atencao_eventos[codigo] = contagem_cnh_atencao().count()
+            return []
+        maximo = app.config['EVENTOS_MAXIMO_LOTE']
+        linhas = db.session.execute(db.select(tabela).where(tabela.c.seq > desde).where(
+            tabela.c.tabela.in_(('colaborador', 'ponto', 'frota', 'desconto'))
+        ).order_by(tabela.c.seq).limit(maximo + 1)).all()
+        if not linhas:
+            return []
+        if len(linhas) > maximo:
+            # Importação ou reprocessamento em massa: uma recarga sai mais barato que milhares de eventos
+            _ultimo_seq_eventos[codigo] = db.session.query(db.func.max(tabela.c.seq)).scalar()
+            _variacao_cnh_atencao(codigo)
+            return [('recarregar', {})]
+        _ultimo_seq_eventos[codigo] = linhas[-1].seq
+        variacao = _variacao_cnh_atencao(codigo) if any(linha.tabela == 'colaborador' for linha in linhas) else 0
+        return eventos_das_alteracoes(linhas, variacao)
+
+def publicar_eventos():
+    """Uma leitura do publicador: entrega os eventos novos de cada filial às filas assinantes."""
+    with _trava_eventos:
+        assinaturas = list(_assinantes_eventos.items())
+    for codigo in {codigo for _, filiais in assinaturas for codigo in filiais}:
+        eventos = [(tipo, dict(dados, filial=codigo)) for tipo, dados in ler_eventos_filial(codigo)]
+        for fila, filiais in assinaturas:
+            if codigo not in filiais:
+                continue
+            for evento in eventos:
+                try:
+                    fila.put_nowait(evento)
+                except queue.Full:
+                    # Tela que não acompanha o ritmo: descarta o acumulado e pede recarga
+                    while not fila.empty():
+                        fila.get_nowait()
+                    fila.put_nowait(('recarregar', {'filial': codigo}))
+                    break
+
+def _laco_publicador_eventos():
+    while True:
+        try:
+            publicar_eventos()
+        except Exception:
+            app.logger.exception('Falha ao publicar eventos ao vivo')
+        time.sleep(app.config['EVENTOS_INTERVALO'])
+
+def assinar_eventos(filiais):
+    """Registra uma conexão; o publicador do processo é iniciado na primeira."""
+    global _publicador_eventos
+    fila = queue.Queue(maxsize=1000)
+    with _trava_eventos:
+        _assinantes_eventos[fila] = set(filiais)
+        if _publicador_eventos is None:
+            _publicador_eventos = threading.Thread(target=_laco_publicador_eventos, name='eventos', daemon=True)
+            _publicador_eventos.start()
+    return fila
+
+def cancelar_eventos(fila):
+    with _trava_eventos:
+        _assinantes_eventos.pop(fila, None)
+
+def formatar_evento(tipo, dados):
+    return f'event: {tipo}\ndata: {json.dumps(dados, ensure_ascii=False)}\n\n'
+
+@app.route('/eventos')
+@login_required
+def eventos():
+    """Fluxo text/event-stream das alterações da filial (ou de todas, no dashboard consolidado)."""
+    filiais = filiais_consolidadas() if request.args.get('consolidado') else [filial_atual()]
+    reconexao = request.headers.get('Last-Event-ID') is not None
+    fila = assinar_eventos(filiais)
+    pulsacao = app.config['EVENTOS_PULSACAO']
+
+    def fluxo():
+        try:
+            # O id faz o navegador informar Last-Event-ID ao reconectar. O que mudou
+            # enquanto a conexão estava caída não é reenviado: a tela recarrega
+            yield 'retry: 5000\nid: 1\n' + (formatar_evento('recarregar', {}) if reconexao else '\n')
+            while True:
+                try:
+                    tipo, dados = fila.get(timeout=pulsacao)
+                except queue.Empty:
+                    yield ': pulsacao\n\n'
+                    continue
+                yield formatar_evento(tipo, dados)
+        finally:
+            cancelar_eventos(fila)
+
+    return Response(fluxo(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
 # Rota para Logs de Auditoria
 @app.route('/auditoria')
 @login_required
@@ -1092,13 +3073,378 @@ def auditoria():
     if not is_admin():
         flash('Acesso negado. Apenas administradores podem ver os logs de auditoria.', 'error')
         return redirect(url_for('index'))
-    logs = LogAuditoria.query.order_by(LogAuditoria.data_hora.desc()).all()
-    return render_template('auditoria.html', logs=logs)
+    pagina = max(1, request.args.get('pagina', 1, type=int))
+    logs, tem_proxima = separar_pagina(consulta_auditoria(pagina).all())
+    return render_template('auditoria.html', logs=logs, pagina=pagina, tem_proxima=tem_proxima)
+
+# Agendador de tarefas de manutenção
+# Cada processo da aplicação roda um laço que verifica as tarefas vencidas; a
+# trava na tabela tarefa_agendada garante que só um deles execute cada tarefa.
+TAREFAS_AGENDADAS = {}
+
+LIMITES_CRON = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 7))
+
+def interpretar_cron(expressao):
+    """Converte 'minuto hora dia mês dia-da-semana' nos conjuntos de valores aceitos.
+
+    Aceita '*', números, listas (1,15), faixas (1-5) e passos (*/10). O dia da
+    semana vai de 0 (domingo) a 6, com 7 também valendo domingo. Diferente do
+    cron, dia do mês e dia da semana precisam coincidir ambos.
+    """
+    campos = expressao.split()
+    if len(campos) != 5:
+        raise ValueError(f'Expressão cron inválida: {expressao}')
+    conjuntos = []
+    for campo, (minimo, maximo) in zip(campos, LIMITES_CRON):
+        valores = set()
+        for parte in campo.split(','):
+            faixa, _, passo = parte.partition('/')
+            if faixa == '*':
+                inicio, fim = minimo, maximo
+            elif '-' in faixa:
+                inicio, fim = (int(valor) for valor in faixa.split('-'))
+            else:
+                inicio = fim = int(faixa)
+            valores.update(range(inicio, fim + 1, int(passo or 1)))
+        if not valores or min(valores) < minimo or max(valores) > maximo:
+            raise ValueError(f'Expressão cron inválida: {expressao}')
+        conjuntos.append(valores)
+    if 7 in conjuntos[4]:
+        conjuntos[4] = (conjuntos[4] - {7}) | {0}
+    return conjuntos
+
+def proxima_execucao(conjuntos, depois):
+    """Primeiro minuto após `depois` que satisfaz a expressão interpretada."""
+    minutos, horas, dias, meses, dias_semana = conjuntos
+    momento = depois.replace(second=0, microsecond=0) + timedelta(minutes=1)
+    limite = momento + timedelta(days=366 * 8)
+    while momento < limite:
+        if momento.month not in meses:
+            momento = (momento.replace(day=28, hour=0, minute=0) + timedelta(days=4)).replace(day=1)
+        elif momento.day not in dias or (momento.weekday() + 1) % 7 not in dias_semana:
+            momento = momento.replace(hour=0, minute=0) + timedelta(days=1)
+        elif momento.hour not in horas:
+            momento = momento.replace(minute=0) + timedelta(hours=1)
+        elif momento.minute not in minutos:
+            momento += timedelta(minutes=1)
+        else:
+            return momento
+    raise ValueError('A expressão cron nunca é satisfeita.')
+
+def tarefa_agendada(cron, por_filial=True, duracao_maxima=3600):
+    """Registra uma tarefa de manutenção.
+
+    `por_filial` executa a tarefa em cada filial; `duracao_maxima` (segundos) é
+    a validade da trava: só depois dela outro processo assume uma execução
+    que pareça abandonada.
+    """
+    conjuntos = interpretar_cron(cron)
+    def registrar(funcao):
+        TAREFAS_AGENDADAS[funcao.__name__] = {
+            'funcao': funcao, 'cron': cron, 'conjuntos': conjuntos,
+            'por_filial': por_filial, 'duracao_maxima': duracao_maxima,
+            'descricao': (funcao.__doc__ or '').strip().splitlines()[0] if funcao.__doc__ else funcao.__name__,
+        }
+        return funcao
+    return registrar
+
+@tarefa_agendada('30 2 * * *')
+def reprocessar_descontos_agendado():
+    """Reavalia todas as viagens e gera os descontos automáticos que faltarem."""
+    return f'{reprocessar_descontos()} descontos automáticos gerados'
+
+@tarefa_agendada('30 3 * * *')
+def atualizar_resumos():
+    """Refaz o resumo diário dos últimos dias e varre as anomalias pendentes."""
+    # Só os dias recentes: o resumo é mantido incrementalmente; aqui se corrige o que escapou
+    reconstruir_resumo_diario(desde=date.today() - timedelta(days=app.config['RESUMO_DIAS_REVISAO']))
+    return f'{varrer_anomalias_frota(incremental=True)} anomalias registradas'
+
+@tarefa_agendada('15 4 * * *')
+def expurgar_alteracoes():
+    """Remove do log de alterações (CDC) o que passou da retenção.
+
+    Os triggers gravam uma linha por registro alterado (uma importação de AFD
+    dobra as escritas): sem expurgo o log cresceria para sempre. Consumidores
+    de /changes que ficarem para trás recebem 410 e refazem a carga completa.
+    """
+    limite = datetime.utcnow() - timedelta(days=app.config['ALTERACOES_RETENCAO_DIAS'])
+    total = RegistroAlteracao.query.filter(RegistroAlteracao.alterado_em < limite).delete(synchronize_session=False)
+    db.session.commit()
+    return f'{total} alterações expurgadas'
+
+@tarefa_agendada('0 4 * * 0', por_filial=False)
+def arquivar_auditoria():
+    """Move o log de auditoria mais antigo que a retenção para um arquivo compactado."""
+    limite = datetime.utcnow() - timedelta(days=app.config['AUDITORIA_RETENCAO_DIAS'])
+    antigos = LogAuditoria.query.filter(LogAuditoria.data_hora < limite).order_by(LogAuditoria.id)
+    diretorio = app.config['AUDITORIA_ARQUIVO_DIR']
+    os.makedirs(diretorio, exist_ok=True)
+    caminho = os.path.join(diretorio, f"auditoria_{datetime.now():%Y%m%d%H%M%S}.jsonl.gz")
+    total = 0
+    with gzip.open(caminho, 'wt', encoding='utf-8') as arquivo:
+        for log in antigos.yield_per(5000):
+            arquivo.write(json.dumps({
+                'id': log.id, 'usuario_id': log.usuario_id, 'usuario_nome': log.usuario_nome, 'acao': log.acao,
+                'detalhes': log.detalhes, 'data_hora': log.data_hora.isoformat() if log.data_hora else None,
+            }, ensure_ascii=False) + '\n')
+            total += 1
+    if not total:
+        os.remove(caminho)
+        return 'nenhum registro a arquivar'
+    # Registros novos nunca ficam antes do limite: o DELETE remove exatamente o que foi arquivado
+    LogAuditoria.query.filter(LogAuditoria.data_hora < limite).delete(synchronize_session=False)
+    db.session.commit()
+    return f'{total} registros arquivados em {os.path.basename(caminho)}'
+
+def identidade_processo():
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+def registrar_tarefas_agendadas():
+    """Cria o estado das tarefas novas, com a primeira execução pelo cron."""
+    agora = datetime.now()
+    db.session.execute(sqlite_insert(TarefaAgendada.__table__).on_conflict_do_nothing(), [
+        {'nome': nome, 'proxima_execucao': proxima_execucao(tarefa['conjuntos'], agora)}
+        for nome, tarefa in TAREFAS_AGENDADAS.items()
+    ])
+    db.session.commit()
+
+def adquirir_tarefa(nome, agora):
+    """Assume a tarefa vencida e livre; o UPDATE condicional garante um único vencedor."""
+    tabela = TarefaAgendada.__table__
+    assumida = db.session.execute(tabela.update().where(
+        tabela.c.nome == nome,
+        tabela.c.proxima_execucao <= agora,
+        db.or_(tabela.c.executando_em.is_(None), tabela.c.trava_expira_em < agora)
+    ).values(
+        executando_em=identidade_processo(),
+        trava_expira_em=agora + timedelta(seconds=TAREFAS_AGENDADAS[nome]['duracao_maxima'])
+    )).rowcount == 1
+    db.session.commit()
+    return assumida
+
+def liberar_tarefa(nome):
+    tabela = TarefaAgendada.__table__
+    db.session.execute(tabela.update().where(
+        tabela.c.nome == nome, tabela.c.executando_em == identidade_processo()
+    ).values(
+        executando_em=None, trava_expira_em=None,
+        proxima_execucao=proxima_execucao(TAREFAS_AGENDADAS[nome]['conjuntos'], datetime.now())
+    ))
+    db.session.commit()
+
+def executar_tarefa(nome):
+    """Executa a tarefa (em cada filial, se for o caso), registrando duração e resultado."""
+    tarefa = TAREFAS_AGENDADAS[nome]
+    filiais = list(app.config['FILIAIS']) if tarefa['por_filial'] else [app.config['FILIAL_PADRAO']]
+    for codigo in filiais:
+        with contexto_filial(codigo):
+            execucao = ExecucaoTarefa(tarefa=nome, filial=codigo if tarefa['por_filial'] else None,
+                                      servidor=identidade_processo(), iniciado_em=datetime.now(), status='executando')
+            db.session.add(execucao)
+            db.session.commit()
+            inicio = time.perf_counter()
+            try:
+                execucao.resultado = tarefa['funcao']()
+                execucao.status = 'sucesso'
+            except Exception as e:
+                db.session.rollback()
+                app.logger.exception('Falha na tarefa agendada %s', nome)
+                execucao.status, execucao.resultado = 'erro', str(e)
+            execucao.duracao = round(time.perf_counter() - inicio, 3)
+            db.session.commit()
+
+def verificar_tarefas_agendadas():
+    """Uma passada do agendador: executa as tarefas vencidas que este processo conseguir assumir."""
+    with app.app_context():
+        for nome in TAREFAS_AGENDADAS:
+            if not adquirir_tarefa(nome, datetime.now()):
+                continue
+            try:
+                executar_tarefa(nome)
+            finally:
+                liberar_tarefa(nome)
+
+_agendador = None
+
+def iniciar_agendador():
+    """Inicia (uma vez por processo) a thread que verifica as tarefas periodicamente."""
+    global _agendador
+    if _agendador is not None or not app.config['AGENDADOR_ATIVO']:
+        return
+
+    def laco():
+        while True:
+            try:
+                verificar_tarefas_agendadas()
+            except Exception:
+                app.logger.exception('Falha no agendador de tarefas')
+            time.sleep(app.config['AGENDADOR_INTERVALO'])
+
+    _agendador = threading.Thread(target=laco, name='agendador', daemon=True)
+    _agendador.start()
+
+def agendar_agora(nome):
+    """Antecipa a próxima execução da tarefa; o agendador a executa na próxima verificação."""
+    tabela = TarefaAgendada.__table__
+    db.session.execute(tabela.update().where(tabela.c.nome == nome).values(proxima_execucao=datetime.now()))
+    db.session.commit()
+
+@app.route('/agendador')
+@login_required
+def agendador():
+    if not is_admin():
+        flash('Acesso negado. Apenas administradores podem ver as tarefas agendadas.', 'error')
+        return redirect(url_for('index'))
+    estados = {tarefa.nome: tarefa for tarefa in TarefaAgendada.query.all()}
+    metricas = {
+        nome: (total, media, maxima) for nome, total, media, maxima in db.session.query(
+            ExecucaoTarefa.tarefa, db.func.count(), db.func.avg(ExecucaoTarefa.duracao), db.func.max(ExecucaoTarefa.duracao)
+        ).filter(ExecucaoTarefa.status != 'executando').group_by(ExecucaoTarefa.tarefa)
+    }
+    historico = ExecucaoTarefa.query.order_by(ExecucaoTarefa.id.desc()).limit(50).all()
+    return render_template('agendador.html', tarefas=TAREFAS_AGENDADAS, estados=estados, metricas=metricas,
+                           historico=historico, ativo=app.config['AGENDADOR_ATIVO'])
+
+@app.route('/agendador/executar/<nome>')
+@login_required
+def executar_tarefa_agora(nome):
+    if not is_admin():
+        flash('Acesso negado. Apenas administradores podem executar tarefas.', 'error')
+        return redirect(url_for('index'))
+    if nome not in TAREFAS_AGENDADAS:
+        abort(404)
+    agendar_agora(nome)
+    registrar_log(f"Antecipou a tarefa agendada {nome}")
+    flash(f"Tarefa '{TAREFAS_AGENDADAS[nome]['descricao']}' agendada para execução imediata.", 'success')
+    return redirect(url_for('agendador'))
+
+@app.cli.command('executar-tarefa')
+@click.argument('nome', type=click.Choice(list(TAREFAS_AGENDADAS)))
+def executar_tarefa_comando(nome):
+    """Executa agora uma tarefa agendada, respeitando a trava (ex.: cron do sistema)."""
+    inicializar_banco()
+    agendar_agora(nome)
+    if not adquirir_tarefa(nome, datetime.now()):
+        raise click.ClickException(f'A tarefa {nome} já está em execução em outro processo.')
+    try:
+        executar_tarefa(nome)
+    finally:
+        liberar_tarefa(nome)
+    for execucao in ExecucaoTarefa.query.filter_by(tarefa=nome).order_by(ExecucaoTarefa.id.desc()).limit(
+            len(app.config['FILIAIS']) if TAREFAS_AGENDADAS[nome]['por_filial'] else 1):
+        click.echo(f'[{execucao.filial or "-"}] {execucao.status} em {execucao.duracao}s: {execucao.resultado}')
+
+# Verificação dos planos de execução das consultas quentes
+# Tabelas que crescem com o uso: uma varredura completa nelas é regressão de índice
+TABELAS_GRANDES = {'ponto', 'frota', 'desconto', 'log_auditoria', 'registro_alteracao', 'resumo_diario_frota'}
+
+def explicar_consulta(consulta):
+    """Linhas do EXPLAIN QUERY PLAN da consulta, no banco para onde ela seria enviada."""
+    entidade = consulta.column_descriptions[0]['entity']
+    engine = db.session.get_bind(mapper=db.inspect(entidade))
+    sql = consulta.statement.compile(dialect=engine.dialect, compile_kwargs={'literal_binds': True})
+    with engine.connect() as conexao:
+        return [detalhe for _, _, _, detalhe in conexao.exec_driver_sql(f'EXPLAIN QUERY PLAN {sql}')]
+
+def avaliar_plano(plano, limitada=False):
+    """Separa as varreduras completas em tabelas grandes (falhas) das ordenações em B-tree temporária (alertas).
+
+    SCAN percorre a tabela ou o índice inteiro, sem busca por faixa. Só é aceito
+    com índice de cobertura, que não lê as linhas da tabela, ou quando a consulta
+    tem LIMIT e percorre um índice: a leitura na ordem do índice para nas
+    primeiras linhas. Buscas (SEARCH) não são varreduras.
+    """
+    falhas, alertas = [], []
+    for detalhe in plano:
+        varredura = re.match(r'SCAN (?:TABLE )?(\w+)( USING COVERING INDEX| USING INDEX)?', detalhe)
+        aceita = varredura and (varredura.group(2) == ' USING COVERING INDEX' or (limitada and varredura.group(2)))
+        if varredura and not aceita and varredura.group(1) in TABELAS_GRANDES:
+            falhas.append(detalhe)
+        elif 'USE TEMP B-TREE' in detalhe:
+            alertas.append(detalhe)
+    return falhas, alertas
+
+def verificar_planos_consultas():
+    """Executa EXPLAIN QUERY PLAN em cada variante das consultas quentes da filial corrente."""
+    resultados = []
+    for nome, (construtor, variantes, ordenacao_aceita) in CONSULTAS_QUENTES.items():
+        for argumentos in variantes:
+            rotulo = f"{nome}({', '.join(f'{k}={v!r}' for k, v in argumentos.items())})"
+            consultas = construtor(**argumentos)
+            if not isinstance(consultas, dict):
+                consultas = {None: consultas}
+            for chave, consulta in consultas.items():
+                plano = explicar_consulta(consulta)
+                falhas, alertas = avaliar_plano(plano, limitada=' LIMIT ' in str(consulta.statement))
+                resultados.append({'consulta': f'{rotulo}.{chave}' if chave else rotulo,
+                                   'plano': plano, 'falhas': falhas,
+                                   'alertas': [] if ordenacao_aceita else alertas,
+                                   'aceitos': [f'{alerta} (aceita: {ordenacao_aceita})' for alerta in alertas]
+                                   if ordenacao_aceita else []})
+    return resultados
+
+def relatar_planos_consultas(resultados, detalhado=False, escrever=click.echo):
+    """Escreve a situação de cada consulta verificada; retorna quantas têm varredura completa."""
+    for resultado in resultados:
+        situacao = 'FALHA' if resultado['falhas'] else 'ALERTA' if resultado['alertas'] else 'ok'
+        escrever(f"[{situacao}] {resultado['consulta']}")
+        for detalhe in resultado['plano'] if detalhado else resultado['falhas'] + resultado['alertas'] + resultado['aceitos']:
+            escrever(f'    {detalhe}')
+    falhas = sum(1 for resultado in resultados if resultado['falhas'])
+    escrever(f'{len(resultados)} consultas, {falhas} com varredura completa, '
+             f"{sum(1 for resultado in resultados if resultado['alertas'])} com ordenação temporária "
+             f"({sum(1 for resultado in resultados if resultado['aceitos'])} aceitas)")
+    return falhas
+
+@app.cli.command('verificar-consultas')
+@click.option('--detalhado', is_flag=True, help='Mostra o plano completo de cada consulta.')
+def verificar_consultas_comando(detalhado):
+    """Falha se alguma consulta quente fizer varredura completa em tabela grande.
+
+    Verifica o banco configurado, sem alterá-lo. Para verificar sobre dados
+    sintéticos, em um banco temporário: python semeadura.py
+    """
+    inicializar_banco()
+    if relatar_planos_consultas(verificar_planos_consultas(), detalhado):
+        raise SystemExit(1)
 
 # Inicialização do banco de dados e criação de usuário admin
+_banco_inicializado = False
+
+def inicializar_banco():
+    """Cria/atualiza o schema de todos os bancos e executa as cargas iniciais pendentes."""
+    # Os binds 'snapshot*' são cópias somente leitura, geradas a partir dos bancos das filiais
+    db.create_all(bind_key=None)
+    atualizar_schema(db.engine, [tabela for tabela in db.metadata.sorted_tables if tabela.name in TABELAS_GLOBAIS])
+    registrar_tarefas_agendadas()
+    falhar_geracoes_interrompidas()
+    for codigo in app.config['FILIAIS']:
+        with contexto_filial(codigo):
+            inicializar_filial()
+
+def inicializar_filial():
+    """Cria/atualiza o schema do banco da filial corrente e suas cargas iniciais."""
+    engine = engine_filial()
+    db.metadata.create_all(engine, tables=tabelas_filial())
+    remover_colunas_obsoletas(engine)
+    remover_descontos_automaticos_duplicados(engine)
+    adicionadas = atualizar_schema(engine, tabelas_filial())
+    instalar_triggers_alteracoes(engine)
+    if ('frota', 'veiculo_id') in adicionadas or ('colaborador', 'veiculo_vinculado_id') in adicionadas:
+        popular_veiculos()
+    if ResumoDiarioFrota.query.first() is None and Frota.query.first() is not None:
+        reconstruir_resumo_diario()
+    if app.config['RELATORIOS_VIA_SNAPSHOT']:
+        # O schema pode ter mudado: o snapshot precisa refletir o banco atual
+        criar_snapshot()
+
 @app.before_request
 def create_tables():
-    db.create_all()
+    global _banco_inicializado
+    if _banco_inicializado:
+        return
+    inicializar_banco()
     
     # Criar usuário admin se não existir
     if not Usuario.query.filter_by(username='admin').first():
@@ -1112,10 +3458,17 @@ def create_tables():
         db.session.add(admin)
         db.session.commit()
         print("Usuário admin criado: username='admin', senha='admin123'")
+    _banco_inicializado = True
+    iniciar_agendador()
+
+# Registrado depois de create_tables: a filial vem do usuário, cuja tabela pode ter acabado de ser migrada
+app.before_request(definir_filial)
 
 if __name__ == '__main__':
+    # Executado como script: os módulos carregados sob demanda (planilhas) importam 'app' e precisam achar este mesmo módulo
+    sys.modules.setdefault('app', sys.modules[__name__])
     with app.app_context():
-        db.create_all()
+        inicializar_banco()
         # Criar usuário admin se não existir
         if not Usuario.query.filter_by(username='admin').first():
             admin = Usuario(
@@ -0,0 +1,308 @@
+"""Teste de carga do Sistema de Frota.
+
+Sobe a aplicação em um processo separado, sobre um banco semeado em um
+diretório temporário, e dispara clientes concorrentes: supervisores com uma
+mistura configurável de cenários e terminais de ponto registrando marcações.
+Ao final imprime (ou grava) um JSON com vazão, latências p50/p95/p99 e erros
+por cenário, para comparar versões.
+
+Uso:
+    python carga.py --supervisores 50 --terminais 200 --duracao 60 \\
+        --mistura "login=1,dashboard=4,frota=2,descontos=3,exportar=1" --saida carga.json
+"""
+import argparse
+import http.cookiejar
+import json
+import math
+import os
+import random
+import re
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from collections import defaultdict
+from datetime import date, datetime
+
+SENHA = 'carga123'
+MISTURA_PADRAO = 'login=1,dashboard=4,frota=2,descontos=3,exportar=1'
+
+
+# Servidor
+def servir(porta, colaboradores, dias, supervisores, terminais):
+    """Inicializa e semeia o banco da instância configurada e atende na porta.
+
+    Os ids dos colaboradores semeados ficam disponíveis em /_semeadura.
+    """
+    import logging
+    from flask import jsonify
+    from app import app, inicializar_banco
+    from semeadura import semear_banco
+
+    with app.app_context():
+        inicializar_banco()
+        semeados = semear_banco(colaboradores, dias, supervisores, terminais, senha=SENHA)
+
+    @app.route('/_semeadura')
+    def dados_semeados():
+        return jsonify(colaboradores=semeados['ids_colaboradores'])
+
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    app.run(host='127.0.0.1', port=porta, threaded=True, debug=False, use_reloader=False)
+
+def porta_livre():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def iniciar_servidor(argumentos, instancia):
+    porta = porta_livre()
+    ambiente = dict(os.environ, SISTEMA_FROTA_INSTANCIA=instancia)
+    processo = subprocess.Popen(
+        [sys.executable, os.path.abspath(__file__), '--servidor', str(porta),
+         '--colaboradores', str(argumentos.colaboradores), '--dias', str(argumentos.dias),
+         '--supervisores', str(argumentos.supervisores), '--terminais', str(argumentos.terminais)],
+        cwd=os.path.dirname(os.path.abspath(__file__)), env=ambiente,
+    )
+    base = f'http://127.0.0.1:{porta}'
+    limite = time.monotonic() + argumentos.espera_servidor
+    while time.monotonic() < limite:
+        if processo.poll() is not None:
+            raise RuntimeError(f'O servidor terminou durante a inicialização (código {processo.returncode}).')
+        try:
+            urllib.request.urlopen(f'{base}/login', timeout=2).read()
+            return processo, base
+        except (urllib.error.URLError, ConnectionError, socket.timeout):
+            time.sleep(0.5)
+    processo.terminate()
+    raise RuntimeError('O servidor não respondeu a tempo.')
+
+
+# Clientes
+class Cliente:
+    """Sessão HTTP de um usuário (cookies próprios, redirecionamentos seguidos)."""
+
+    def __init__(self, base, usuario):
+        self.base = base
+        self.usuario = usuario
+        self.abridor = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()))
+
+    def requisitar(self, caminho, dados=None):
+        corpo = urllib.parse.urlencode(dados).encode() if dados is not None else None
+        try:
+            with self.abridor.open(f'{self.base}{caminho}', data=corpo, timeout=60) as resposta:
+                return resposta.status, resposta.read()
+        except urllib.error.HTTPError as erro:
+            return erro.code, erro.read()
+
+    def entrar(self):
+        return self.requisitar('/login', {'username': self.usuario, 'password': SENHA})
+
+
+def cenario_login(cliente, aleatorio, contexto):
+    cliente.abridor = Cliente(cliente.base, cliente.usuario).abridor
+    return cliente.entrar()
+
+def cenario_dashboard(cliente, aleatorio, contexto):
+    return cliente.requisitar('/')
+
+def cenario_ponto(cliente, aleatorio, contexto):
+    agora = datetime.now()
+    return cliente.requisitar('/ponto/novo', {
+        'colaborador_id': aleatorio.choice(contexto['colaboradores']),
+        'data': agora.strftime('%Y-%m-%d'),
+        'hora': agora.strftime('%H:%M'),
+        'tipo': aleatorio.choice(['entrada', 'saida']),
+    })
+
+def cenario_frota(cliente, aleatorio, contexto):
+    km_inicial = aleatorio.randint(1000, 90000)
+    saida = aleatorio.randint(6, 16)
+    return cliente.requisitar('/frota/novo', {
+        'data': date.today().isoformat(),
+        'veiculo': f'CRG{aleatorio.randint(0, 49):04d}',
+        'motorista_id': aleatorio.choice(contexto['colaboradores']),
+        'hora_saida': f'{saida:02d}:00',
+        'hora_retorno': f'{saida + 1:02d}:{aleatorio.randint(0, 59):02d}',
+        'km_inicial': km_inicial,
+        'km_final': km_inicial + aleatorio.randint(5, 200),
+    })
+
+def cenario_descontos(cliente, aleatorio, contexto):
+    filtros = {'status': aleatorio.choice(['all', 'pendente', 'aprovado'])}
+    if aleatorio.random() < 0.5:
+        filtros['colaborador_id'] = aleatorio.choice(contexto['colaboradores'])
+    return cliente.requisitar(f'/descontos?{urllib.parse.urlencode(filtros)}')
+
+def cenario_exportar(cliente, aleatorio, contexto):
+    return cliente.requisitar(f"/exportar/{aleatorio.choice(['descontos', 'pontos', 'frota'])}")
+
+CENARIOS = {
+    'login': cenario_login,
+    'dashboard': cenario_dashboard,
+    'ponto': cenario_ponto,
+    'frota': cenario_frota,
+    'descontos': cenario_descontos,
+    'exportar': cenario_exportar,
+}
+
+def classificar_erro(status, corpo):
+    """Tipo de erro da resposta (None quando bem-sucedida).
+
+    As rotas tratam exceções com flash + redirecionamento: a mensagem aparece
+    na página seguinte, que é inspecionada aqui.
+    """
+    if b'database is locked' in corpo:
+        return 'database_is_locked'
+    if status >= 400:
+        return f'http_{status}'
+    if b'alert-danger' in corpo and re.search(rb'Erro ao [^<]*', corpo):
+        return 'erro_aplicacao'
+    return None
+
+
+# Execução
+def interpretar_mistura(texto):
+    mistura = {}
+    for item in texto.split(','):
+        nome, _, peso = item.partition('=')
+        nome = nome.strip()
+        if nome not in CENARIOS:
+            raise SystemExit(f'Cenário desconhecido: {nome} (disponíveis: {", ".join(CENARIOS)})')
+        mistura[nome] = float(peso or 1)
+    return mistura
+
+def executar_cliente(cliente, mistura, fim, semente, contexto, resultados, trava, pausa):
+    aleatorio = random.Random(semente)
+    nomes, pesos = list(mistura), list(mistura.values())
+    locais = []
+    try:
+        status, corpo = cliente.entrar()
+    except OSError:
+        status, corpo = 0, b''
+    if status != 200 or b'login-card' in corpo:
+        with trava:
+            resultados['login'].append((0.0, 'login_inicial'))
+        return
+    while time.monotonic() < fim:
+        nome = aleatorio.choices(nomes, pesos)[0]
+        inicio = time.perf_counter()
+        try:
+            status, corpo = CENARIOS[nome](cliente, aleatorio, contexto)
+            erro = classificar_erro(status, corpo)
+        except OSError as excecao:
+            erro = f'conexao_{type(excecao).__name__}'
+        locais.append((nome, time.perf_counter() - inicio, erro))
+        if pausa:
+            time.sleep(aleatorio.uniform(0, 2 * pausa))
+    with trava:
+        for nome, duracao, erro in locais:
+            resultados[nome].append((duracao, erro))
+
+def percentil(valores, p):
+    """Percentil pelo método do posto mais próximo (valores já ordenados)."""
+    if not valores:
+        return None
+    posicao = max(0, min(len(valores) - 1, math.ceil(p / 100 * len(valores)) - 1))
+    return valores[posicao]
+
+def arredondar(valor):
+    return round(valor, 2) if valor is not None else None
+
+def resumir(amostras, duracao):
+    latencias = sorted(d * 1000 for d, erro in amostras if erro is None)
+    erros = defaultdict(int)
+    for _, erro in amostras:
+        if erro is not None:
+            erros[erro] += 1
+    total = len(amostras)
+    return {
+        'requisicoes': total,
+        'sucessos': len(latencias),
+        'erros': sum(erros.values()),
+        'taxa_erro': round(sum(erros.values()) / total, 4) if total else 0.0,
+        'erros_por_tipo': dict(sorted(erros.items())),
+        'vazao_rps': round(total / duracao, 2) if duracao else 0.0,
+        'latencia_ms': {
+            'p50': arredondar(percentil(latencias, 50)),
+            'p95': arredondar(percentil(latencias, 95)),
+            'p99': arredondar(percentil(latencias, 99)),
+            'max': arredondar(latencias[-1] if latencias else None),
+            'media': arredondar(sum(latencias) / len(latencias) if latencias else None),
+        },
+    }
+
+def executar(argumentos):
+    mistura = interpretar_mistura(argumentos.mistura)
+    with tempfile.TemporaryDirectory(prefix='carga_frota_') as instancia:
+        processo, base = iniciar_servidor(argumentos, instancia)
+        try:
+            contexto = json.loads(urllib.request.urlopen(f'{base}/_semeadura', timeout=30).read())
+            resultados = defaultdict(list)
+            trava = threading.Lock()
+            inicio = time.monotonic()
+            fim = inicio + argumentos.duracao
+            clientes = [(Cliente(base, f'supervisor{i}'), mistura) for i in range(1, argumentos.supervisores + 1)]
+            clientes += [(Cliente(base, f'terminal{i}'), {'ponto': 1.0}) for i in range(1, argumentos.terminais + 1)]
+            threads = [
+                threading.Thread(target=executar_cliente, daemon=True,
+                                 args=(cliente, mistura_cliente, fim, argumentos.semente + i, contexto,
+                                       resultados, trava, argumentos.pausa))
+                for i, (cliente, mistura_cliente) in enumerate(clientes)
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            duracao = time.monotonic() - inicio
+        finally:
+            processo.terminate()
+            processo.wait(timeout=30)
+
+    todas = [amostra for amostras in resultados.values() for amostra in amostras]
+    return {
+        'gerado_em': datetime.now().isoformat(timespec='seconds'),
+        'configuracao': {
+            'supervisores': argumentos.supervisores, 'terminais': argumentos.terminais,
+            'duracao_s': argumentos.duracao, 'pausa_s': argumentos.pausa, 'mistura': mistura,
+            'colaboradores': argumentos.colaboradores, 'dias': argumentos.dias, 'semente': argumentos.semente,
+        },
+        'duracao_real_s': round(duracao, 2),
+        'total': resumir(todas, duracao),
+        'cenarios': {nome: resumir(amostras, duracao) for nome, amostras in sorted(resultados.items())},
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='Teste de carga do Sistema de Frota.')
+    parser.add_argument('--supervisores', type=int, default=50)
+    parser.add_argument('--terminais', type=int, default=200)
+    parser.add_argument('--duracao', type=float, default=60, help='segundos de carga')
+    parser.add_argument('--pausa', type=float, default=0.0, help='pausa média entre requisições de um cliente (s)')
+    parser.add_argument('--mistura', default=MISTURA_PADRAO, help='pesos dos cenários dos supervisores')
+    parser.add_argument('--colaboradores', type=int, default=300, help='colaboradores semeados')
+    parser.add_argument('--dias', type=int, default=60, help='dias de histórico semeados')
+    parser.add_argument('--semente', type=int, default=42)
+    parser.add_argument('--espera-servidor', type=float, default=300, help='tempo máximo de inicialização (s)')
+    parser.add_argument('--saida', help='arquivo JSON de saída (padrão: stdout)')
+    parser.add_argument('--servidor', type=int, help=argparse.SUPPRESS)
+    argumentos = parser.parse_args()
+
+    if argumentos.servidor:
+        servir(argumentos.servidor, argumentos.colaboradores, argumentos.dias,
+               argumentos.supervisores, argumentos.terminais)
+        return
+
+    relatorio = json.dumps(executar(argumentos), ensure_ascii=False, indent=2)
+    if argumentos.saida:
+        with open(argumentos.saida, 'w', encoding='utf-8') as arquivo:
+            arquivo.write(relatorio)
+    else:
+        print(relatorio)
+
+if __name__ == '__main__':
+    main()
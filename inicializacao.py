@@ -0,0 +1,161 @@
+"""Benchmark de inicialização de um worker do Sistema de Frota.
+
+Sobe a aplicação repetidas vezes em processos novos, sobre um banco já
+inicializado em um diretório temporário, e mede para cada worker: o tempo até
+responder a primeira requisição, a memória residente (RSS) logo depois dela e
+se o pandas foi carregado. Com --planilha mede também o primeiro download de
+planilha, que carrega o módulo de planilhas sob demanda. Imprime (ou grava) um
+JSON para comparar versões.
+
+Uso:
+    python inicializacao.py --repeticoes 5 --planilha --saida inicializacao.json
+"""
+import argparse
+import http.cookiejar
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from datetime import datetime
+
+from carga import porta_livre
+
+SENHA = 'inicio123'
+
+
+# Servidor
+def servir(porta):
+    """Atende na porta informando, por uma rota de diagnóstico, o estado do processo."""
+    import logging
+    from flask import jsonify
+    from app import app
+
+    @app.route('/_diagnostico_inicializacao')
+    def diagnostico_inicializacao():
+        return jsonify(rss_kb=memoria_residente(os.getpid()), pandas='pandas' in sys.modules)
+
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    app.run(host='127.0.0.1', port=porta, threaded=True, debug=False, use_reloader=False)
+
+def preparar_instancia(instancia):
+    """Cria o schema e o administrador antes das medições (fora do tempo medido)."""
+    script = (
+        'from app import app, db, Usuario, inicializar_banco\n'
+        'from werkzeug.security import generate_password_hash\n'
+        'with app.app_context():\n'
+        '    inicializar_banco()\n'
+        "    db.session.add(Usuario(username='admin', nome='Administrador', email='admin@local', ativo=True,\n"
+        f"                           password_hash=generate_password_hash({SENHA!r})))\n"
+        '    db.session.commit()\n'
+    )
+    subprocess.run([sys.executable, '-c', script], check=True, cwd=os.path.dirname(os.path.abspath(__file__)),
+                   env=dict(os.environ, SISTEMA_FROTA_INSTANCIA=instancia))
+
+def memoria_residente(pid):
+    """RSS do processo em KiB (Linux: /proc; outros sistemas: psutil, se instalado)."""
+    try:
+        with open(f'/proc/{pid}/status') as status:
+            for linha in status:
+                if linha.startswith('VmRSS:'):
+                    return int(linha.split()[1])
+    except OSError:
+        pass
+    try:
+        import psutil
+    except ImportError:
+        return None
+    return psutil.Process(pid).memory_info().rss // 1024
+
+
+# Medição
+def requisitar(abridor, url, dados=None):
+    corpo = urllib.parse.urlencode(dados).encode() if dados is not None else None
+    with abridor.open(url, data=corpo, timeout=60) as resposta:
+        return resposta.read()
+
+def medir_worker(instancia, planilha, espera):
+    porta = porta_livre()
+    base = f'http://127.0.0.1:{porta}'
+    inicio = time.perf_counter()
+    processo = subprocess.Popen(
+        [sys.executable, os.path.abspath(__file__), '--servidor', str(porta)],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        env=dict(os.environ, SISTEMA_FROTA_INSTANCIA=instancia),
+    )
+    try:
+        limite = inicio + espera
+        while True:
+            if processo.poll() is not None:
+                raise RuntimeError(f'O servidor terminou durante a inicialização (código {processo.returncode}).')
+            try:
+                urllib.request.urlopen(f'{base}/login', timeout=2).read()
+                break
+            except (urllib.error.URLError, ConnectionError, TimeoutError):
+                if time.perf_counter() > limite:
+                    raise RuntimeError('O servidor não respondeu a tempo.')
+                time.sleep(0.01)
+        medicao = {'primeira_requisicao_ms': round((time.perf_counter() - inicio) * 1000, 1)}
+        diagnostico = json.loads(urllib.request.urlopen(f'{base}/_diagnostico_inicializacao', timeout=10).read())
+        medicao.update(rss_kb=diagnostico['rss_kb'], pandas_carregado=diagnostico['pandas'])
+
+        if planilha:
+            abridor = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()))
+            requisitar(abridor, f'{base}/login', {'username': 'admin', 'password': SENHA})
+            antes = time.perf_counter()
+            requisitar(abridor, f'{base}/download/template/pontos')
+            medicao['primeira_planilha_ms'] = round((time.perf_counter() - antes) * 1000, 1)
+            diagnostico = json.loads(urllib.request.urlopen(f'{base}/_diagnostico_inicializacao', timeout=10).read())
+            medicao['rss_apos_planilha_kb'] = diagnostico['rss_kb']
+        return medicao
+    finally:
+        processo.terminate()
+        processo.wait(timeout=30)
+
+def resumir(medicoes, campo):
+    valores = [medicao[campo] for medicao in medicoes if medicao.get(campo) is not None]
+    if not valores:
+        return None
+    return {'mediana': statistics.median(valores), 'min': min(valores), 'max': max(valores)}
+
+def executar(argumentos):
+    with tempfile.TemporaryDirectory(prefix='inicializacao_frota_') as instancia:
+        preparar_instancia(instancia)
+        medicoes = [medir_worker(instancia, argumentos.planilha, argumentos.espera_servidor)
+                    for _ in range(argumentos.repeticoes)]
+    campos = ['primeira_requisicao_ms', 'rss_kb', 'primeira_planilha_ms', 'rss_apos_planilha_kb']
+    return {
+        'gerado_em': datetime.now().isoformat(timespec='seconds'),
+        'python': sys.version.split()[0],
+        'repeticoes': argumentos.repeticoes,
+        'resumo': {campo: resumo for campo in campos if (resumo := resumir(medicoes, campo))},
+        'medicoes': medicoes,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark de inicialização de um worker do Sistema de Frota.')
+    parser.add_argument('--repeticoes', type=int, default=5, help='workers iniciados (um por medição)')
+    parser.add_argument('--planilha', action='store_true', help='mede também o primeiro download de planilha (carga do pandas)')
+    parser.add_argument('--espera-servidor', type=float, default=120, help='tempo máximo de inicialização (s)')
+    parser.add_argument('--saida', help='arquivo JSON de saída (padrão: stdout)')
+    parser.add_argument('--servidor', type=int, help=argparse.SUPPRESS)
+    argumentos = parser.parse_args()
+
+    if argumentos.servidor:
+        servir(argumentos.servidor)
+        return
+
+    relatorio = json.dumps(executar(argumentos), ensure_ascii=False, indent=2)
+    if argumentos.saida:
+        with open(argumentos.saida, 'w', encoding='utf-8') as arquivo:
+            arquivo.write(relatorio)
+    else:
+        print(relatorio)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,381 @@
+"""Importação e exportação de planilhas do Sistema de Frota.
+
+Tudo o que depende do pandas fica aqui. O módulo é importado sob demanda pelas
+rotas de importação, exportação e modelos, de modo que os workers não pagam o
+carregamento do pandas/numpy na inicialização.
+"""
+import hashlib
+import io
+from functools import lru_cache
+
+import pandas as pd
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from app import (app, db, Colaborador, Ponto, Frota, Desconto, gerar_descontos_automaticos, gravar_erros_importacao,
+                 executar_por_filial, sessao_relatorios, sem_arquivados, _adicionar_erro)
+
+
+# Importação
+COLUNAS_OBRIGATORIAS = {
+    'colaboradores': ['NOME COMPLETO', 'MATRÍCULA'],
+    'pontos': ['MATRÍCULA DO COLABORADOR', 'DATA E HORA', 'TIPO (entrada ou saida)'],
+    'frota': ['DATA', 'VEÍCULO', 'MATRÍCULA DO MOTORISTA'],
+}
+
+VALORES_FALSOS = {'', '0', '0.0', 'false', 'falso', 'n', 'nao', 'não'}
+
+def detectar_separador(stream):
+    """Identifica se o CSV usa ';' ou ',' a partir do cabeçalho."""
+    cabecalho = stream.readline()
+    stream.seek(0)
+    if isinstance(cabecalho, bytes):
+        cabecalho = cabecalho.decode('utf-8-sig', errors='ignore')
+    return ';' if cabecalho.count(';') > cabecalho.count(',') else ','
+
+def ler_arquivo_em_blocos(arquivo, tamanho_bloco):
+    """Lê o arquivo enviado em blocos de DataFrames com colunas textuais.
+
+    CSV e Parquet são lidos em streaming, mantendo a memória limitada ao bloco.
+    O índice de cada bloco segue a numeração das linhas do arquivo.
+    """
+    nome = arquivo.filename.lower()
+    if nome.endswith('.csv'):
+        separador = detectar_separador(arquivo.stream)
+        yield from pd.read_csv(arquivo.stream, sep=separador, dtype=str, keep_default_na=False,
+                               encoding='utf-8-sig', chunksize=tamanho_bloco)
+    elif nome.endswith('.parquet'):
+        try:
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise ValueError('A importação de arquivos Parquet requer o pacote pyarrow.')
+        inicio = 0
+        for lote in pq.ParquetFile(arquivo.stream).iter_batches(batch_size=tamanho_bloco):
+            bloco = lote.to_pandas()
+            bloco.index = pd.RangeIndex(inicio, inicio + len(bloco))
+            inicio += len(bloco)
+            yield bloco
+    else:
+        yield pd.read_excel(arquivo, dtype=str)
+
+def _texto(serie):
+    """Normaliza a coluna para texto sem espaços, com vazio no lugar de nulos."""
+    return serie.astype('string').fillna('').str.strip()
+
+def converter_datas(serie, formato='ISO8601'):
+    """Converte a coluna inteira para datetime.
+
+    Valores fora do formato principal ainda passam por uma conversão flexível;
+    retorna os valores convertidos e a máscara das células inválidas.
+    """
+    texto = _texto(serie)
+    vazio = texto == ''
+    valores = pd.to_datetime(texto.mask(vazio), format=formato, errors='coerce')
+    pendentes = valores.isna() & ~vazio
+    if pendentes.any():
+        valores = valores.copy()
+        valores[pendentes] = pd.to_datetime(texto[pendentes], format='mixed', errors='coerce')
+    return valores, valores.isna() & ~vazio
+
+def converter_horas(serie):
+    """Converte a coluna de horários (HH:MM:SS ou HH:MM) para datetime.time."""
+    texto = _texto(serie)
+    vazio = texto == ''
+    valores = pd.to_datetime(texto.mask(vazio), format='%H:%M:%S', errors='coerce')
+    pendentes = valores.isna() & ~vazio
+    if pendentes.any():
+        valores = valores.copy()
+        valores[pendentes] = pd.to_datetime(texto[pendentes], format='%H:%M', errors='coerce')
+    erros = valores.isna() & ~vazio
+    return valores.dt.time.astype(object).where(valores.notna(), None), erros
+
+def converter_numeros(serie):
+    """Converte a coluna para float, retornando os valores e a máscara de erros."""
+    texto = _texto(serie).str.replace(',', '.', regex=False)
+    vazio = texto == ''
+    valores = pd.to_numeric(texto.mask(vazio), errors='coerce')
+    return valores, valores.isna() & ~vazio
+
+def _coluna(df, nome):
+    return df[nome] if nome in df.columns else pd.Series('', index=df.index, dtype='string')
+
+def _nulos(serie):
+    return serie.astype(object).where(serie.notna(), None)
+
+
+def _registrar_erros(erros, mascara, coluna, motivo):
+    for indice in mascara[mascara].index:
+        _adicionar_erro(erros, indice, coluna, motivo)
+
+def validar_colunas(df, tipo):
+    faltantes = [c for c in COLUNAS_OBRIGATORIAS[tipo] if c not in df.columns]
+    if faltantes:
+        raise ValueError(f"Colunas obrigatórias ausentes: {', '.join(faltantes)}")
+
+def buscar_colaboradores_por_matricula(matriculas):
+    """Mapeia matrícula -> id em uma única consulta."""
+    unicas = [m for m in set(matriculas) if m]
+    if not unicas:
+        return {}
+    linhas = db.session.query(Colaborador.matricula, Colaborador.id).filter(Colaborador.matricula.in_(unicas)).all()
+    return dict(linhas)
+
+def chaves_de_importacao(*colunas):
+    """SHA-1 da chave natural de cada linha, a partir das colunas de texto já normalizadas."""
+    texto = colunas[0].str.cat(list(colunas[1:]), sep='|')
+    return texto.map(lambda valor: hashlib.sha1(valor.encode('utf-8')).hexdigest())
+
+def descartar_ja_importados(registros, modelo):
+    """Remove do bloco as linhas repetidas no arquivo ou já gravadas; retorna (registros, ignorados).
+
+    A busca usa o índice único parcial de `chave_importacao`, uma consulta por bloco.
+    """
+    unicos = registros.drop_duplicates('chave_importacao')
+    chaves = unicos['chave_importacao'].tolist()
+    gravadas = {chave for (chave,) in db.session.query(modelo.chave_importacao).filter(
+        modelo.chave_importacao.in_(chaves))} if chaves else set()
+    novos = unicos[~unicos['chave_importacao'].isin(gravadas)]
+    return novos, len(registros) - len(novos)
+
+def importar_colaboradores(df, matriculas_importadas, simular=False):
+    """Importa um bloco de colaboradores; retorna (adicionados, ignorados, erros por linha).
+
+    Matrículas já cadastradas são erros, não linhas ignoradas: o cadastro pode ter mudado.
+    """
+    erros = {}
+    matriculas = _texto(df['MATRÍCULA'])
+    nomes = _texto(df['NOME COMPLETO'])
+    vencimento_cnh, erro_vencimento = converter_datas(_coluna(df, 'VENCIMENTO CNH'))
+    ultima_consulta, erro_consulta = converter_datas(_coluna(df, 'ULTIMA CONSULTA'))
+    ativo = _texto(_coluna(df, 'ATIVO')).isin(['1', '1.0'])
+
+    existentes = buscar_colaboradores_por_matricula(matriculas)
+    _registrar_erros(erros, matriculas == '', 'MATRÍCULA', 'Matrícula não informada.')
+    _registrar_erros(erros, nomes == '', 'NOME COMPLETO', 'Nome não informado.')
+    for indice, matricula in matriculas.items():
+        if matricula and (matricula in existentes or matricula in matriculas_importadas):
+            _adicionar_erro(erros, indice, 'MATRÍCULA', f'Colaborador com matrícula {matricula} já existe.')
+    _registrar_erros(erros, erro_vencimento, 'VENCIMENTO CNH', 'Data inválida.')
+    _registrar_erros(erros, erro_consulta, 'ULTIMA CONSULTA', 'Data inválida.')
+
+    validos = ~df.index.isin(list(erros))
+    registros = pd.DataFrame({
+        'nome': nomes,
+        'matricula': matriculas,
+        'cpf': _texto(_coluna(df, 'CPF')).replace('', None),
+        'pis': _texto(_coluna(df, 'PIS')).replace('', None),
+        'telefone': _texto(_coluna(df, 'TELEFONE')),
+        'email': _texto(_coluna(df, 'EMAIL')),
+        'veiculo_vinculado': _texto(_coluna(df, 'VEÍCULO VINCULADO')),
+        'ativo': ativo,
+        'vencimento_cnh': _nulos(vencimento_cnh.dt.date),
+        'ultima_consulta': _nulos(ultima_consulta.dt.date),
+    })[validos]
+
+    matriculas_importadas.update(registros['matricula'])
+    if simular:
+        return len(registros), 0, erros
+
+    for registro in registros.to_dict('records'):
+        db.session.add(Colaborador(**registro))
+    return len(registros), 0, erros
+
+def importar_pontos(df, simular=False):
+    """Importa um bloco de pontos; retorna (adicionados, ignorados, erros por linha)."""
+    erros = {}
+    matriculas = _texto(df['MATRÍCULA DO COLABORADOR'])
+    data_hora, erro_data_hora = converter_datas(df['DATA E HORA'], '%Y-%m-%d %H:%M:%S')
+    tipos = _texto(df['TIPO (entrada ou saida)']).str.lower()
+    extraordinario = ~_texto(_coluna(df, 'EXTRAORDINÁRIO')).str.lower().isin(VALORES_FALSOS)
+
+    colaboradores_ids = matriculas.map(buscar_colaboradores_por_matricula(matriculas))
+    for indice in colaboradores_ids[colaboradores_ids.isna()].index:
+        _adicionar_erro(erros, indice, 'MATRÍCULA DO COLABORADOR', f'Colaborador com matrícula {matriculas[indice]} não encontrado.')
+    _registrar_erros(erros, erro_data_hora | (_texto(df['DATA E HORA']) == ''), 'DATA E HORA', 'Data e hora inválida.')
+    _registrar_erros(erros, ~tipos.isin(['entrada', 'saida']), 'TIPO (entrada ou saida)', "Tipo deve ser 'entrada' ou 'saida'.")
+
+    validos = ~df.index.isin(list(erros))
+    registros = pd.DataFrame({
+        'colaborador_id': colaboradores_ids,
+        'data_hora': _nulos(data_hora),
+        'tipo': tipos,
+        'observacao': _texto(_coluna(df, 'OBSERVACAO')),
+        'extraordinario': extraordinario,
+        'chave_importacao': chaves_de_importacao(matriculas, data_hora.dt.strftime('%Y-%m-%d %H:%M:%S').fillna(''), tipos),
+    })[validos]
+    registros, ignorados = descartar_ja_importados(registros, Ponto)
+    registros['colaborador_id'] = registros['colaborador_id'].astype(int)
+    registros['data_hora'] = registros['data_hora'].map(lambda valor: valor.to_pydatetime())
+
+    if simular:
+        return len(registros), ignorados, erros
+
+    linhas = registros.to_dict('records')
+    if linhas:
+        # O índice único também descarta o que uma importação simultânea acabou de gravar
+        db.session.execute(sqlite_insert(Ponto).on_conflict_do_nothing(
+            index_elements=['chave_importacao'], index_where=db.text('chave_importacao IS NOT NULL')), linhas)
+    return len(linhas), ignorados, erros
+
+def importar_frota(df, simular=False):
+    """Importa um bloco de frota, avaliando descontos; retorna (adicionados, ignorados, erros por linha)."""
+    erros = {}
+    matriculas = _texto(df['MATRÍCULA DO MOTORISTA'])
+    datas, erro_data = converter_datas(df['DATA'], '%Y-%m-%d %H:%M:%S')
+    hora_saida, erro_saida = converter_horas(_coluna(df, 'HORA SAÍDA'))
+    hora_retorno, erro_retorno = converter_horas(_coluna(df, 'HORA RETORNO'))
+    km_inicial, erro_km_inicial = converter_numeros(_coluna(df, 'KM INICIAL'))
+    km_final, erro_km_final = converter_numeros(_coluna(df, 'KM FINAL'))
+    veiculos = _texto(df['VEÍCULO'])
+
+    motoristas_ids = matriculas.map(buscar_colaboradores_por_matricula(matriculas))
+    for indice in motoristas_ids[motoristas_ids.isna()].index:
+        _adicionar_erro(erros, indice, 'MATRÍCULA DO MOTORISTA', f'Motorista com matrícula {matriculas[indice]} não encontrado.')
+    _registrar_erros(erros, erro_data | (_texto(df['DATA']) == ''), 'DATA', 'Data inválida.')
+    _registrar_erros(erros, veiculos == '', 'VEÍCULO', 'Veículo não informado.')
+    _registrar_erros(erros, erro_saida, 'HORA SAÍDA', 'Hora de saída inválida.')
+    _registrar_erros(erros, erro_retorno, 'HORA RETORNO', 'Hora de retorno inválida.')
+    _registrar_erros(erros, erro_km_inicial, 'KM INICIAL', 'KM inicial inválido.')
+    _registrar_erros(erros, erro_km_final, 'KM FINAL', 'KM final inválido.')
+
+    validos = ~df.index.isin(list(erros))
+    registros = pd.DataFrame({
+        'data': _nulos(datas.dt.date),
+        'veiculo': veiculos,
+        'motorista_id': motoristas_ids,
+        'hora_saida': hora_saida,
+        'hora_retorno': hora_retorno,
+        'km_inicial': _nulos(km_inicial),
+        'km_final': _nulos(km_final),
+        'observacao': _texto(_coluna(df, 'OBSERVACAO')),
+        'chave_importacao': chaves_de_importacao(
+            matriculas, veiculos.str.upper(), datas.dt.strftime('%Y-%m-%d').fillna(''),
+            hora_saida.map(lambda hora: hora.strftime('%H:%M:%S') if hora else '').astype('string')),
+    })[validos]
+    registros, ignorados = descartar_ja_importados(registros, Frota)
+    registros['motorista_id'] = registros['motorista_id'].astype(int)
+    if simular:
+        return len(registros), ignorados, erros
+
+    viagens = [Frota(**registro) for registro in registros.to_dict('records')]
+    db.session.add_all(viagens)
+    db.session.flush()
+    # Reavalia status e gera os descontos do bloco em um único upsert
+    criados = gerar_descontos_automaticos(viagens)
+    for viagem in viagens:
+        viagem.status = 'extraordinaria' if viagem.id in criados else 'conforme'
+    return len(registros), ignorados, erros
+
+def importar_planilha(arquivo, tipo, relatorio, simular=False):
+    """Importa uma planilha (xlsx, csv ou parquet) em blocos, confirmando cada um."""
+    matriculas_importadas = set()
+    for bloco in ler_arquivo_em_blocos(arquivo, app.config['IMPORT_CHUNK_SIZE']):
+        validar_colunas(bloco, tipo)
+        if tipo == 'colaboradores':
+            quantidade, ignorados, erros = importar_colaboradores(bloco, matriculas_importadas, simular)
+        elif tipo == 'pontos':
+            quantidade, ignorados, erros = importar_pontos(bloco, simular)
+        else:
+            quantidade, ignorados, erros = importar_frota(bloco, simular)
+
+        # Linha 1 é o cabeçalho; o índice do bloco começa em 0
+        gravar_erros_importacao(relatorio, erros, 2)
+        relatorio.total_linhas += len(bloco)
+        relatorio.linhas_com_erro += len(erros)
+        relatorio.adicionados += quantidade
+        relatorio.ignorados += ignorados
+        db.session.commit()
+
+
+# Exportação
+COLUNAS_TEMPLATE = {
+    'colaboradores': ['NOME COMPLETO', 'MATRÍCULA', 'CPF', 'PIS', 'TELEFONE', 'EMAIL', 'VEÍCULO VINCULADO', 'ATIVO', 'VENCIMENTO CNH', 'ULTIMA CONSULTA'],
+    'pontos': ['MATRÍCULA DO COLABORADOR', 'DATA E HORA', 'TIPO (entrada ou saida)', 'OBSERVACAO', 'EXTRAORDINÁRIO'],
+    'frota': ['DATA', 'VEÍCULO', 'MATRÍCULA DO MOTORISTA', 'HORA SAÍDA', 'HORA RETORNO', 'KM INICIAL', 'KM FINAL', 'OBSERVACAO'],
+}
+
+def dataframe_para_xlsx(df, sheet_name):
+    """Serializa um DataFrame em um arquivo Excel em memória."""
+    output = io.BytesIO()
+    with pd.ExcelWriter(output, engine='openpyxl') as writer:
+        df.to_excel(writer, sheet_name=sheet_name, index=False)
+    return output.getvalue()
+
+@lru_cache(maxsize=None)
+def modelo_importacao(tipo):
+    """Planilha-modelo do tipo; os modelos nunca mudam, então cada um é gerado uma única vez."""
+    return dataframe_para_xlsx(pd.DataFrame(columns=COLUNAS_TEMPLATE[tipo]), 'Modelo')
+
+def relatorio_erros_importacao(erros, formato):
+    """Bytes do relatório de erros [(linha, coluna, motivo)] em CSV ou Excel."""
+    df = pd.DataFrame(erros, columns=['Linha', 'Coluna', 'Motivo'])
+    if formato == 'csv':
+        return df.to_csv(index=False, sep=';').encode('utf-8-sig')
+    return dataframe_para_xlsx(df, 'Erros')
+
+def montar_dados_exportacao(tipo, sessao):
+    """Monta o DataFrame de exportação do tipo informado a partir da sessão."""
+    if tipo == 'colaboradores':
+        data = sessao.query(Colaborador).all()
+        df = pd.DataFrame([{
+            'ID': c.id,
+            'Nome': c.nome,
+            'Matrícula': c.matricula,
+            'CPF': c.cpf,
+            'PIS': c.pis,
+            'Telefone': c.telefone,
+            'Email': c.email,
+            'Veículo': c.veiculo_vinculado,
+            'Ativo': 'Sim' if c.ativo else 'Não',
+            'Vencimento CNH': c.vencimento_cnh,
+            'Última Consulta CNH': c.ultima_consulta
+        } for c in data])
+
+    elif tipo == 'pontos':
+        data = sem_arquivados(sessao.query(Ponto), Ponto.colaborador_id).all()
+        df = pd.DataFrame([{
+            'ID': p.id,
+            'Colaborador': p.colaborador.nome if p.colaborador else '',
+            'Data/Hora': p.data_hora.strftime('%d/%m/%Y %H:%M'),
+            'Tipo': p.tipo,
+            'Extraordinário': 'Sim' if p.extraordinario else 'Não',
+            'Observação': p.observacao
+        } for p in data])
+
+    elif tipo == 'frota':
+        data = sem_arquivados(sessao.query(Frota), Frota.motorista_id).all()
+        df = pd.DataFrame([{
+            'ID': f.id,
+            'Data': f.data.strftime('%d/%m/%Y'),
+            'Veículo': f.veiculo,
+            'Motorista': f.motorista_obj.nome if f.motorista_obj else '',
+            'Hora Saída': f.hora_saida.strftime('%H:%M') if f.hora_saida else '',
+            'Hora Retorno': f.hora_retorno.strftime('%H:%M') if f.hora_retorno else '',
+            'KM Inicial': f.km_inicial,
+            'KM Final': f.km_final,
+            'KM Rodado': (f.km_final - f.km_inicial) if f.km_final and f.km_inicial else 0,
+            'Status': f.status,
+            'Observação': f.observacao
+        } for f in data])
+
+    elif tipo == 'descontos':
+        data = sem_arquivados(sessao.query(Desconto), Desconto.colaborador_id).all()
+        df = pd.DataFrame([{
+            'ID': d.id,
+            'Colaborador': d.colaborador.nome if d.colaborador else '',
+            'Data': d.data.strftime('%d/%m/%Y'),
+            'Motivo': d.motivo,
+            'Valor': f'R$ {d.valor:.2f}',
+            'Status': d.status,
+            'Automático': 'Sim' if d.automatico else 'Não'
+        } for d in data])
+
+    return df
+
+def gerar_planilha_exportacao(tipo, filiais):
+    """Consulta as filiais em paralelo e retorna os bytes da planilha consolidada."""
+    quadros = executar_por_filial(lambda: montar_dados_exportacao(tipo, sessao_relatorios()), filiais)
+    if len(quadros) == 1:
+        return dataframe_para_xlsx(next(iter(quadros.values())), 'Dados')
+    for codigo, quadro in quadros.items():
+        quadro.insert(0, 'Filial', app.config['FILIAIS'][codigo])
+    return dataframe_para_xlsx(pd.concat(quadros.values(), ignore_index=True), 'Dados')
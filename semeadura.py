@@ -0,0 +1,120 @@
+"""Dados sintéticos do Sistema de Frota para testes de carga e de planos de consulta.
+
+Módulo de desenvolvimento: a aplicação não o importa e não expõe comando para
+semear. `semear_banco` recusa uma filial que já tenha colaboradores, e a
+verificação de planos abaixo cria o próprio banco em um diretório temporário,
+como carga.py e inicializacao.py.
+
+Uso (verificação dos planos das consultas quentes sobre dados sintéticos):
+    python semeadura.py --colaboradores 200 --dias 30 --detalhado
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+from datetime import date, datetime, timedelta
+
+
+def semear_banco(colaboradores=300, dias=60, supervisores=0, terminais=0, senha='carga123', semente=42):
+    """Popula a filial corrente (vazia) com colaboradores, pontos, viagens e descontos sintéticos.
+
+    Cria também os usuários `supervisorN` e `terminalN` (todos com a mesma senha).
+    Retorna as quantidades geradas e os ids dos colaboradores criados.
+    """
+    # Importado aqui: quem chama define SISTEMA_FROTA_INSTANCIA antes de carregar a aplicação
+    from werkzeug.security import generate_password_hash
+    from app import (db, Usuario, Colaborador, Ponto, Frota, Desconto, filial_atual, popular_veiculos,
+                     reconstruir_resumo_diario)
+
+    if Colaborador.query.first() is not None:
+        raise RuntimeError(f'A filial {filial_atual()} já tem colaboradores: dados sintéticos só em banco vazio.')
+
+    aleatorio = random.Random(semente)
+    hoje = date.today()
+    agora = datetime.utcnow()
+
+    senha_hash = generate_password_hash(senha)
+    existentes = {u for (u,) in db.session.query(Usuario.username)}
+    usuarios = [
+        {'username': nome, 'password_hash': senha_hash, 'nome': nome.capitalize(),
+         'email': f'{nome}@carga.local', 'ativo': True, 'filial': filial_atual(), 'criado_em': agora}
+        for nome in [f'supervisor{i}' for i in range(1, supervisores + 1)] + [f'terminal{i}' for i in range(1, terminais + 1)]
+        if nome not in existentes
+    ]
+    if usuarios:
+        db.session.execute(db.insert(Usuario), usuarios)
+
+    db.session.execute(db.insert(Colaborador), [{
+        'nome': f'Colaborador {i + 1:05d}',
+        'matricula': f'C{i + 1:06d}',
+        'veiculo_vinculado': f'CRG{i % 50:04d}',
+        'ativo': aleatorio.random() > 0.05,
+        'vencimento_cnh': hoje + timedelta(days=aleatorio.randint(-60, 900)),
+        'ultima_consulta': hoje - timedelta(days=aleatorio.randint(0, 365)),
+        'criado_em': agora,
+    } for i in range(colaboradores)])
+    ids = [id_ for (id_,) in db.session.query(Colaborador.id).order_by(Colaborador.id)]
+
+    pontos, viagens = [], []
+    for dia in (hoje - timedelta(days=d) for d in range(dias)):
+        for colaborador_id in ids:
+            entrada = datetime.combine(dia, datetime.min.time()) + timedelta(hours=7, minutes=aleatorio.randint(0, 90))
+            pontos.append({'colaborador_id': colaborador_id, 'data_hora': entrada, 'tipo': 'entrada', 'criado_em': agora})
+            pontos.append({'colaborador_id': colaborador_id, 'data_hora': entrada + timedelta(hours=9),
+                           'tipo': 'saida', 'criado_em': agora})
+            if aleatorio.random() < 0.3:
+                saida = entrada + timedelta(hours=aleatorio.randint(1, 7))
+                km_inicial = aleatorio.randint(1000, 90000)
+                viagens.append({
+                    'data': dia, 'veiculo': f'CRG{aleatorio.randint(0, 49):04d}', 'motorista_id': colaborador_id,
+                    'hora_saida': saida.time(), 'hora_retorno': (saida + timedelta(minutes=aleatorio.randint(20, 240))).time(),
+                    'km_inicial': km_inicial, 'km_final': km_inicial + aleatorio.randint(5, 200),
+                    'status': 'conforme', 'criado_em': agora,
+                })
+    db.session.execute(db.insert(Ponto), pontos)
+    db.session.execute(db.insert(Frota), viagens)
+    db.session.flush()
+
+    # Cadastro de veículos, descontos e resumo diário seguem o mesmo caminho das cargas reais
+    popular_veiculos()
+    amostra = Frota.query.order_by(db.func.random()).limit(len(viagens) // 5).all()
+    db.session.execute(db.insert(Desconto), [{
+        'colaborador_id': f.motorista_id, 'data': f.data, 'motivo': f'Uso excedente de veículo - Veículo {f.veiculo}',
+        'valor': 50.0, 'status': aleatorio.choice(['pendente', 'aprovado', 'descontado', 'cancelado']),
+        'frota_id': f.id, 'automatico': True, 'criado_em': agora,
+    } for f in amostra])
+    db.session.commit()
+    reconstruir_resumo_diario()
+    return {'colaboradores': len(ids), 'pontos': len(pontos), 'viagens': len(viagens), 'descontos': len(amostra),
+            'ids_colaboradores': ids}
+
+
+# Verificação dos planos de consulta
+def verificar_consultas(colaboradores, dias, detalhado):
+    """Semeia um banco temporário e verifica os planos das consultas quentes; retorna as consultas com falha."""
+    with tempfile.TemporaryDirectory(prefix='consultas_frota_') as instancia:
+        os.environ['SISTEMA_FROTA_INSTANCIA'] = instancia
+        from app import app, db, inicializar_banco, verificar_planos_consultas, relatar_planos_consultas
+
+        with app.app_context():
+            inicializar_banco()
+            semear_banco(colaboradores, dias)
+            falhas = relatar_planos_consultas(verificar_planos_consultas(), detalhado, print)
+            # Fecha as conexões antes de remover o diretório
+            db.session.remove()
+            for engine in db.engines.values():
+                engine.dispose()
+    return falhas
+
+def main():
+    parser = argparse.ArgumentParser(description='Verifica os planos das consultas quentes sobre dados sintéticos.')
+    parser.add_argument('--colaboradores', type=int, default=200)
+    parser.add_argument('--dias', type=int, default=30, help='dias de histórico semeados')
+    parser.add_argument('--detalhado', action='store_true', help='mostra o plano completo de cada consulta')
+    argumentos = parser.parse_args()
+    if verificar_consultas(argumentos.colaboradores, argumentos.dias, argumentos.detalhado):
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
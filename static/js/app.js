@@ -0,0 +1,166 @@
+document.getElementById("menu-toggle").addEventListener("click", function(e) {
+    e.preventDefault();
+    document.getElementById("wrapper").classList.toggle("toggled");
+});
+
+const modeToggle = document.getElementById('mode-toggle');
+const body = document.body;
+const icon = modeToggle.querySelector('i');
+
+function setMode(mode) {
+    if (mode === 'dark') {
+        body.classList.add('dark-mode');
+        icon.classList.remove('fa-moon');
+        icon.classList.add('fa-sun');
+    } else {
+        body.classList.remove('dark-mode');
+        icon.classList.remove('fa-sun');
+        icon.classList.add('fa-moon');
+    }
+}
+
+modeToggle.addEventListener('click', () => {
+    if (body.classList.contains('dark-mode')) {
+        setMode('light');
+        localStorage.setItem('theme', 'light');
+    } else {
+        setMode('dark');
+        localStorage.setItem('theme', 'dark');
+    }
+});
+
+// Check for saved theme preference on page load
+const savedTheme = localStorage.getItem('theme');
+if (savedTheme) {
+    setMode(savedTheme);
+} else if (window.matchMedia && window.matchMedia('(prefers-color-scheme: dark)').matches) {
+    // Check for OS dark mode preference
+    setMode('dark');
+} else {
+    setMode('light');
+}
+
+// Barras de progresso de tarefas em segundo plano (ex.: geração de extratos)
+document.querySelectorAll('[data-progresso]').forEach((elemento) => {
+    const barra = elemento.querySelector('.progress-bar');
+    const consultar = () => {
+        fetch(elemento.dataset.progresso)
+            .then((resposta) => resposta.json())
+            .then((dados) => {
+                if (dados.status === 'concluido' || dados.status === 'erro') {
+                    window.location.reload();
+                    return;
+                }
+                barra.style.width = (dados.total ? Math.floor(dados.processados * 100 / dados.total) : 0) + '%';
+                barra.textContent = dados.processados + '/' + dados.total;
+                setTimeout(consultar, 2000);
+            });
+    };
+    setTimeout(consultar, 2000);
+});
+
+// Atualização ao vivo do dashboard e das listagens: o servidor publica as alterações por server-sent events
+document.querySelectorAll('[data-eventos]').forEach((raiz) => {
+    const filiais = raiz.dataset.filiais ? JSON.parse(raiz.dataset.filiais) : null;
+    const lista = (nome) => raiz.dataset.lista === nome ? raiz : raiz.querySelector('[data-lista="' + nome + '"]');
+
+    const elemento = (tag, classes, texto) => {
+        const novo = document.createElement(tag);
+        if (classes) novo.className = classes;
+        if (texto !== undefined) novo.textContent = texto;
+        return novo;
+    };
+    const dataHora = (iso) => iso.slice(8, 10) + '/' + iso.slice(5, 7) + '/' + iso.slice(0, 4) + iso.slice(10).replace('T', ' ');
+    const badgeFilial = (dados) => filiais ? elemento('span', 'badge bg-secondary', filiais[dados.filial]) : '';
+    const badgeTipo = (tipo) => elemento('span', 'badge bg-' + (tipo === 'entrada' ? 'success' : 'danger'),
+                                         tipo === 'entrada' ? 'Entrada' : (lista('pontos') ? 'Saída' : 'Saida'));
+
+    const remover = (alvo, id) => {
+        const existente = alvo && alvo.querySelector('[data-id="' + CSS.escape(id) + '"]');
+        if (existente) existente.remove();
+    };
+    // Insere pela data/hora (mais recentes primeiro), mantendo no máximo `limite` itens
+    const inserir = (alvo, item, limite) => {
+        remover(alvo, item.dataset.id);
+        alvo.querySelectorAll('[data-vazio]').forEach((vazio) => vazio.remove());
+        const seguinte = item.dataset.hora
+            ? Array.from(alvo.children).find((atual) => atual.dataset.hora < item.dataset.hora)
+            : alvo.firstElementChild;
+        alvo.insertBefore(item, seguinte || null);
+        while (limite && alvo.children.length > limite) alvo.lastElementChild.remove();
+    };
+
+    const tratadores = {
+        recarregar: () => window.location.reload(),
+        contadores: (dados) => {
+            Object.entries(dados).forEach(([chave, delta]) => {
+                const contador = raiz.querySelector('[data-contador="' + chave + '"]');
+                if (contador) contador.textContent = parseInt(contador.textContent, 10) + delta;
+            });
+        },
+        ponto: (dados) => {
+            const ultimos = lista('ultimos_pontos');
+            if (ultimos) {
+                const item = elemento('li', 'list-group-item d-flex justify-content-between align-items-center');
+                item.dataset.id = dados.filial + ':' + dados.id;
+                item.dataset.hora = dados.data_hora;
+                const descricao = elemento('span');
+                descricao.append(elemento('i', 'fas fa-user me-2'), dados.colaborador + ' - ', badgeFilial(dados), ' ', badgeTipo(dados.tipo));
+                item.append(descricao, elemento('small', 'text-muted', dataHora(dados.data_hora)));
+                inserir(ultimos, item, 5);
+            }
+            const tabela = lista('pontos');
+            if (tabela) {
+                const linha = elemento('tr');
+                linha.dataset.id = String(dados.id);
+                linha.dataset.hora = dados.data_hora;
+                const extraordinario = dados.extraordinario ? elemento('span', 'badge bg-warning', 'Sim') : elemento('span', '', 'Não');
+                const editar = elemento('a', 'btn btn-sm btn-outline-warning');
+                editar.href = tabela.dataset.urlEditar.replace(/0$/, dados.id);
+                editar.title = 'Editar';
+                editar.append(elemento('i', 'fas fa-edit'));
+                const excluir = elemento('a', 'btn btn-sm btn-outline-danger');
+                excluir.href = tabela.dataset.urlExcluir.replace(/0$/, dados.id);
+                excluir.title = 'Excluir';
+                excluir.onclick = () => confirm('Tem certeza que deseja excluir este registro?');
+                excluir.append(elemento('i', 'fas fa-trash'));
+                const celulas = [dados.colaborador, dataHora(dados.data_hora), badgeTipo(dados.tipo), extraordinario, dados.observacao];
+                celulas.forEach((conteudo) => {
+                    const celula = elemento('td');
+                    celula.append(conteudo);
+                    linha.append(celula);
+                });
+                const acoes = elemento('td');
+                acoes.append(editar, ' ', excluir);
+                linha.append(acoes);
+                inserir(tabela, linha);
+            }
+        },
+        ponto_removido: (dados) => {
+            remover(lista('ultimos_pontos'), dados.filial + ':' + dados.id);
+            remover(lista('pontos'), String(dados.id));
+        },
+        desconto: (dados) => {
+            const pendentes = lista('descontos_pendentes');
+            if (!pendentes || dados.status !== 'pendente') return;
+            const item = elemento('li', 'list-group-item');
+            item.dataset.id = dados.filial + ':' + dados.id;
+            const cabecalho = elemento('div', 'd-flex w-100 justify-content-between');
+            const titulo = elemento('h6', 'mb-1', dados.colaborador + ' - R$ ' + Number(dados.valor).toFixed(2) + ' ');
+            titulo.append(badgeFilial(dados));
+            cabecalho.append(titulo, elemento('small', 'text-muted', dataHora(dados.data)));
+            item.append(cabecalho, elemento('p', 'mb-1 text-muted', dados.motivo));
+            inserir(pendentes, item, 5);
+        },
+        status: (dados) => {
+            if (dados.tabela === 'desconto' && dados.de === 'pendente') {
+                remover(lista('descontos_pendentes'), dados.filial + ':' + dados.id);
+            }
+        },
+    };
+
+    const fonte = new EventSource(raiz.dataset.eventos);
+    Object.entries(tratadores).forEach(([tipo, tratar]) => {
+        fonte.addEventListener(tipo, (evento) => tratar(JSON.parse(evento.data)));
+    });
+});